@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Accounting', '0001_squashed_0023_alter_splitcontab_options_alter_vocespesa_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='impegno',
+            name='mandati_pagato',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
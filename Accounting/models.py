@@ -96,6 +96,7 @@ class Impegno(models.Model):
     doc_residui = models.FloatField(default=0.0)
     pagato_competenza = models.FloatField(default=0.0)
     pagato_residui = models.FloatField(default=0.0)
+    mandati_pagato = models.FloatField(null=True, blank=True)  # Pagato when the mandati were last synced with SIGLA
 
     def __str__(self):
         return "{0:d}/{1:d}: {2:s} (Totale: {3:.2f} Pagato: {4:.2f})".format(self.numero, self.esercizio_orig, self.description, self.im_competenza+self.im_residui, self.pagato_competenza+self.pagato_residui)
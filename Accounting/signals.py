@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# Sent after the accounting data of a GAE has been written in bulk (bulk writes do not send model signals)
+# Arguments: gae, esercizio
+funds_updated = Signal()
@@ -0,0 +1,254 @@
+import logging
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Q, F
+
+from .models import VoceSpesa, Stanziamento, Variazione, Impegno, Mandato
+from .signals import funds_updated
+
+
+# Bulk writer of SIGLA data
+# =========================
+#
+# The data downloaded from SIGLA for a GAE and a year (stanziamenti with the residui of the following years,
+# variazioni and impegni) is merged in memory with the rows already in the database, with the same rules of the
+# row by row update. Only new and changed rows are written: new rows with bulk_create() (upsert on the unique
+# constraint of the model), changed rows with bulk_update(), stanziamenti not returned by SIGLA are deleted.
+# All the writes of a GAE and a year are done in a single transaction. The voci di spesa are cached in memory.
+# The mandati of an impegno are synced in the same way (without deleting the mandati of the other impegni);
+# only the impegni of the open years and those paid since the last sync need to be checked (see mandati_to_sync).
+# Bulk writes do not send model signals: funds_updated is sent after each transaction that changed some rows.
+
+STANZIAMENTO_FIELDS = ['stanziamento', 'var_piu', 'var_meno', 'assestato', 'impegnato', 'residuo', 'pagato', 'da_pagare']
+VARIAZIONE_FIELDS = ['tipo', 'stato', 'riferimenti', 'descrizione', 'cdrSrc', 'cdrDst', 'importo']
+IMPEGNO_FIELDS = ['description', 'im_competenza', 'im_residui', 'doc_competenza', 'doc_residui', 'pagato_competenza', 'pagato_residui']
+MANDATO_FIELDS = ['description', 'id_terzo', 'terzo', 'importo', 'data']
+
+
+def _values(obj, fields):
+    return tuple(getattr(obj, f) for f in fields)
+
+
+def mandati_to_sync(impegni, current_year):
+    """ Filter the impegni whose mandati must be synced: impegni of the open years and impegni
+    whose pagato changed since the last sync of the mandati (or never synced)
+    """
+    return impegni.filter(
+        Q(esercizio__gte=current_year) |
+        Q(mandati_pagato__isnull=True) |
+        ~Q(mandati_pagato=F('pagato_competenza') + F('pagato_residui'))
+    )
+
+
+class FundsWriter(object):
+    """ Writer of the data of a GAE downloaded from SIGLA
+     - current_year: data of the previous years is not updated if already present (variazioni and impegni)
+     - stats: counter of the rows created, updated, unchanged and deleted for each model
+    """
+
+    def __init__(self, current_year, logger=None):
+        self.current_year = current_year
+        self.logger = logger if logger is not None else logging.getLogger('UpdateFunds')
+        self.stats = Counter()
+        self.load_voci()
+
+    def changes(self):
+        return sum([v for k, v in self.stats.items() if not k.endswith('.unchanged')])
+
+    def load_voci(self):
+        self.voci = {v.voce: v for v in VoceSpesa.objects.all()}
+
+    def voce(self, voce, description):
+        """ Return the VoceSpesa (created if missing)
+        """
+        if voce not in self.voci:
+            self.voci[voce] = VoceSpesa.objects.create(voce=voce, description=description)
+            self.stats['VoceSpesa.created'] += 1
+        return self.voci[voce]
+
+    def write(self, gae, y, competenza=None, residui=None, variazioni=None, impegni=None):
+        """ Write the data of a GAE for the year y. Sections that are None are not updated
+         - competenza: output of SIGLA.getCompetenza(gae, y)
+         - residui: list of outputs of SIGLA.getResidui(gae, res_y) for the years following y
+         - variazioni: output of SIGLA.getVariazioni(gae, y)
+         - impegni: output of SIGLA.getImpegni(gae, y)
+        """
+        changes = self.changes()
+        try:
+            with transaction.atomic():
+                if competenza is not None:
+                    self.write_stanziamenti(gae, y, competenza, residui or [])
+                if variazioni is not None:
+                    self.write_variazioni(gae, y, variazioni)
+                if impegni is not None:
+                    self.write_impegni(gae, y, impegni)
+        except Exception:
+            # Voci created in the transaction have been rolled back
+            self.load_voci()
+            raise
+        if self.changes() != changes:
+            funds_updated.send(sender=self.__class__, gae=gae, esercizio=y)
+
+    def _apply(self, model, fields, unique_fields, new, changed, unchanged):
+        name = model.__name__
+        if len(new):
+            model.objects.bulk_create(new, update_conflicts=True, unique_fields=unique_fields, update_fields=fields)
+        if len(changed):
+            model.objects.bulk_update(changed, fields)
+        self.stats[f"{name}.created"] += len(new)
+        self.stats[f"{name}.updated"] += len(changed)
+        self.stats[f"{name}.unchanged"] += unchanged
+
+    def write_stanziamenti(self, gae, y, competenza, residui):
+        # Stanziamenti of competenza
+        values = {}
+        for k, v in competenza.items():
+            voce = self.voce(k, v['descrizione'])
+            values[voce.pk] = [v['stanziamento'], v['var_piu'], v['var_meno'], v['assestato'], v['impegnato'], v['residuo'], v['pagato'], v['dapagare']]
+
+        # Changes from the residui of the following years
+        for r in residui:
+            for k, v in r.items():
+                if y not in v['esercizi']:
+                    continue
+                voce = self.voce(k, v['descrizione'])
+                s = values.setdefault(voce.pk, [0.0] * len(STANZIAMENTO_FIELDS))
+                e = v['esercizi'][y]
+                s[1] += e['var_piu_imp']
+                s[2] += e['var_meno_imp']
+                s[3] += e['var_piu_imp'] - e['var_meno_imp']
+                s[4] += e['var_piu_obblpro'] - e['var_meno_obblpro'] + e['impegnato']
+                s[5] = e['residuo']
+                s[6] += e['pagato']
+                s[7] = e['dapagare']
+
+        existing = {s.voce_id: s for s in Stanziamento.objects.filter(gae=gae, esercizio=y)}
+        new, changed, unchanged = [], [], 0
+        for voce_id, v in values.items():
+            s = existing.get(voce_id)
+            if s is None:
+                new.append(Stanziamento(gae=gae, esercizio=y, voce_id=voce_id, **dict(zip(STANZIAMENTO_FIELDS, v))))
+            elif _values(s, STANZIAMENTO_FIELDS) != tuple(v):
+                for f, value in zip(STANZIAMENTO_FIELDS, v):
+                    setattr(s, f, value)
+                changed.append(s)
+            else:
+                unchanged += 1
+        self._apply(Stanziamento, STANZIAMENTO_FIELDS, ['gae', 'esercizio', 'voce'], new, changed, unchanged)
+
+        # Delete the stanziamenti not returned by SIGLA
+        stale = [s.pk for voce_id, s in existing.items() if voce_id not in values]
+        if len(stale):
+            Stanziamento.objects.filter(pk__in=stale).delete()
+            self.stats['Stanziamento.deleted'] += len(stale)
+
+    def write_variazioni(self, gae, y, variazioni):
+        existing = {
+            (v.data, v.numero, v.voce_id): v
+            for v in Variazione.objects.filter(gae=gae, numero__in=set([var['numero'] for var in variazioni]))
+        }
+        new, changed, seen = {}, {}, set()
+        for var in variazioni:
+            # NOTE: the voce may be missing when the variazione is for an external GAE (e.g. transfers)
+            voce = self.voce(var['voce'], 'N.D.')
+            key = (var['data'], var['numero'], voce.pk)
+            v = existing.get(key)
+            if v is None:
+                v = Variazione(
+                    gae=gae,
+                    esercizio=var['es_residuo'] if var['tipo'] == 'Residuo' else y,
+                    numero=var['numero'],
+                    voce=voce,
+                    data=var['data'],
+                )
+                existing[key] = new[key] = v
+            else:
+                if key not in new:
+                    seen.add(key)
+                if y < self.current_year:
+                    # Variazioni of past years cannot be changed
+                    continue
+            old = _values(v, VARIAZIONE_FIELDS)
+            v.tipo = var['tipo']
+            v.stato = var['stato']
+            v.riferimenti = var['riferimenti'] if var['riferimenti'] is not None else "None"
+            v.descrizione = var['descrizione'] if var['descrizione'] is not None else "None"
+            v.cdrSrc = var['cdr_prop']
+            v.cdrDst = var['cdr_ass']
+            v.importo = var['importo']
+            if key not in new and old != _values(v, VARIAZIONE_FIELDS):
+                changed[key] = v
+        unchanged = len(seen - set(changed.keys()))
+        self._apply(Variazione, VARIAZIONE_FIELDS, ['gae', 'data', 'numero', 'voce'], list(new.values()), list(changed.values()), unchanged)
+
+    def write_impegni(self, gae, y, impegni):
+        existing = {(im.esercizio_orig, im.numero): im for im in Impegno.objects.filter(gae=gae, esercizio=y)}
+        new, changed, seen = {}, {}, set()
+        for el in impegni:
+            if el['voce'] not in self.voci:
+                # The voce should have been added with the stanziamenti
+                self.logger.error(f"La voce {el['voce']} non esiste nel database. Questo non dovrebbe essere possibile (GAE: {gae.name}, esercizio: {y:d}, impegno: {el['impegno']:d})")
+                continue
+            key = (el['esercizio_orig'], el['impegno'])
+            im = existing.get(key)
+            if im is None:
+                im = Impegno(gae=gae, esercizio=y, esercizio_orig=el['esercizio_orig'], numero=el['impegno'], voce=self.voci[el['voce']])
+                existing[key] = new[key] = im
+            else:
+                if key not in new:
+                    seen.add(key)
+                if y < self.current_year:
+                    # Impegni of past years cannot be changed
+                    continue
+            old = _values(im, IMPEGNO_FIELDS)
+            im.description = el['descrizione']
+            im.im_competenza = el['competenza']
+            im.im_residui = el['residui']
+            im.doc_competenza = el['doc_competenza']
+            im.doc_residui = el['doc_residuo']
+            im.pagato_competenza = el['pagato_competenza']
+            im.pagato_residui = el['pagato_residuo']
+            if key not in new and old != _values(im, IMPEGNO_FIELDS):
+                changed[key] = im
+        unchanged = len(seen - set(changed.keys()))
+        self._apply(Impegno, IMPEGNO_FIELDS, ['gae', 'esercizio_orig', 'esercizio', 'numero'], list(new.values()), list(changed.values()), unchanged)
+
+    def write_mandati(self, impegno, mandati):
+        """ Sync the mandati of an impegno with the output of SIGLA.getMandati(numero, esercizio_orig, esercizio)
+        """
+        values = {}
+        for m in mandati:
+            # Mandati without date are not paid yet, mandati with stato A are cancelled
+            if m['data'] is None or m['stato'] == 'A':
+                continue
+            if m['numero'] in values:
+                # The same mandato pays more invoices of the impegno: the amounts are summed
+                values[m['numero']][3] += m['importo']
+            else:
+                values[m['numero']] = [m['descrizione'], m['id_terzo'], m['terzo'], m['importo'], m['data']]
+
+        existing = {m.numero: m for m in Mandato.objects.filter(impegno=impegno)}
+        new, changed, unchanged = [], [], 0
+        for numero, v in values.items():
+            m = existing.get(numero)
+            if m is None:
+                new.append(Mandato(impegno=impegno, numero=numero, **dict(zip(MANDATO_FIELDS, v))))
+            elif _values(m, MANDATO_FIELDS) != tuple(v):
+                for f, value in zip(MANDATO_FIELDS, v):
+                    setattr(m, f, value)
+                changed.append(m)
+            else:
+                unchanged += 1
+        stale = [m.pk for numero, m in existing.items() if numero not in values]
+
+        changes = self.changes()
+        with transaction.atomic():
+            self._apply(Mandato, MANDATO_FIELDS, ['impegno', 'numero'], new, changed, unchanged)
+            if len(stale):
+                Mandato.objects.filter(pk__in=stale).delete()
+                self.stats['Mandato.deleted'] += len(stale)
+            impegno.mandati_pagato = impegno.pagato_competenza + impegno.pagato_residui
+            Impegno.objects.filter(pk=impegno.pk).update(mandati_pagato=impegno.mandati_pagato)
+        if self.changes() != changes:
+            funds_updated.send(sender=self.__class__, gae=impegno.gae, esercizio=impegno.esercizio)
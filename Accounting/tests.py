@@ -1,3 +1,89 @@
+import datetime
 from django.test import TestCase
 
-# Create your tests here.
+from Projects.models import Project
+from .models import GAE, VoceSpesa, Stanziamento, Variazione, Impegno, Mandato
+from .sync import FundsWriter, mandati_to_sync
+
+
+def competenza(stanziamento, voci=('13012', )):
+    return {
+        v: dict(descrizione=f"Voce {v}", stanziamento=stanziamento, var_piu=0.0, var_meno=0.0, assestato=stanziamento, impegnato=0.0, residuo=stanziamento, pagato=0.0, dapagare=0.0)
+        for v in voci
+    }
+
+
+def impegno(esercizio, numero, importo, voce='13012'):
+    return dict(esercizio=esercizio, esercizio_orig=esercizio, impegno=numero, descrizione=f"Impegno {numero:d}", voce=voce, competenza=importo, residui=0.0, doc_competenza=0.0, doc_residuo=0.0, pagato_competenza=0.0, pagato_residuo=0.0)
+
+
+def mandato(numero, importo, data=datetime.date(2023, 5, 1), stato='P'):
+    return dict(numero=numero, descrizione=f"Mandato {numero:d}", id_terzo=1, terzo="Fornitore", importo=importo, voce='13012', stato=stato, data=data, annullamento=None)
+
+
+class FundsWriterTest(TestCase):
+
+    def setUp(self):
+        prj = Project.objects.create(name='Alpha', agency='MUR', reference='PRIN')
+        self.gae = GAE.objects.create(project=prj, name='P0001', description='GAE')
+
+    def test_stanziamenti(self):
+        writer = FundsWriter(2024)
+        residui = [{'13012': {'descrizione': "Voce 13012", 'esercizi': {
+            2023: dict(var_piu_imp=10.0, var_meno_imp=2.0, var_piu_obblpro=0.0, var_meno_obblpro=0.0, impegnato=5.0, residuo=3.0, pagato=4.0, dapagare=1.0),
+        }}}]
+        writer.write(self.gae, 2023, competenza=competenza(100.0, ('13012', '22010')), residui=residui)
+        s = Stanziamento.objects.get(gae=self.gae, esercizio=2023, voce__voce='13012')
+        self.assertEqual((s.stanziamento, s.var_piu, s.var_meno, s.assestato, s.impegnato, s.residuo, s.pagato), (100.0, 10.0, 2.0, 108.0, 5.0, 3.0, 4.0))
+        self.assertEqual(VoceSpesa.objects.count(), 2)
+        self.assertEqual(writer.stats['Stanziamento.created'], 2)
+
+        # Unchanged rows are not written, rows not returned are deleted
+        writer.write(self.gae, 2023, competenza=competenza(100.0), residui=residui)
+        self.assertEqual(writer.stats['Stanziamento.unchanged'], 1)
+        self.assertEqual(writer.stats['Stanziamento.deleted'], 1)
+        self.assertEqual(list(Stanziamento.objects.filter(gae=self.gae).values_list('voce__voce', flat=True)), ['13012'])
+
+    def test_impegni_variazioni(self):
+        writer = FundsWriter(2024)
+        writer.write(self.gae, 2023, competenza=competenza(100.0), impegni=[impegno(2023, 1, 10.0), impegno(2023, 2, 5.0, voce='99999')])
+        self.assertEqual(list(Impegno.objects.values_list('numero', 'im_competenza')), [(1, 10.0)])
+
+        # Impegni of past years are not updated, of the current year are
+        writer.write(self.gae, 2023, impegni=[impegno(2023, 1, 20.0)])
+        writer.write(self.gae, 2024, impegni=[impegno(2024, 1, 20.0)])
+        writer.write(self.gae, 2024, impegni=[impegno(2024, 1, 30.0)])
+        self.assertEqual(list(Impegno.objects.order_by('esercizio').values_list('esercizio', 'im_competenza')), [(2023, 10.0), (2024, 30.0)])
+        self.assertEqual(writer.stats['Impegno.updated'], 1)
+
+        var = dict(tipo='Residuo', numero=3, stato='D', riferimenti=None, descrizione='Var', cdr_prop='A', cdr_ass='B', es_residuo=2023, importo=1.0, voce='13012', data=None)
+        writer.write(self.gae, 2024, variazioni=[var])
+        writer.write(self.gae, 2024, variazioni=[dict(var, importo=2.0)])
+        v = Variazione.objects.get()
+        self.assertEqual((v.esercizio, v.importo, v.riferimenti, v.data), (2023, 2.0, "None", None))
+
+    def test_mandati(self):
+        writer = FundsWriter(2024)
+        writer.write(self.gae, 2023, competenza=competenza(100.0), impegni=[impegno(2023, 1, 10.0), impegno(2023, 2, 10.0)])
+        writer.write(self.gae, 2024, impegni=[impegno(2024, 3, 10.0)])
+        im1, im2, im3 = Impegno.objects.order_by('numero')
+
+        # Never synced
+        self.assertEqual(list(mandati_to_sync(Impegno.objects.all(), 2024)), [im1, im2, im3])
+
+        writer.write_mandati(im1, [mandato(1, 2.0), mandato(1, 3.0), mandato(2, 4.0, data=None), mandato(3, 1.0, stato='A'), mandato(4, 1.0)])
+        writer.write_mandati(im2, [])
+        writer.write_mandati(im3, [mandato(5, 1.0)])
+        self.assertEqual(list(Mandato.objects.filter(impegno=im1).order_by('numero').values_list('numero', 'importo')), [(1, 5.0), (4, 1.0)])
+
+        # Only the impegni of the open years and with new payments
+        self.assertEqual(list(mandati_to_sync(Impegno.objects.all(), 2024)), [im3])
+        Impegno.objects.filter(pk=im2.pk).update(pagato_competenza=3.0)
+        self.assertEqual(list(mandati_to_sync(Impegno.objects.order_by('numero'), 2024)), [im2, im3])
+
+        # Diff with the stored mandati
+        pk = Mandato.objects.get(impegno=im1, numero=1).pk
+        writer.write_mandati(im1, [mandato(1, 2.0), mandato(1, 4.0), mandato(6, 1.0)])
+        self.assertEqual(list(Mandato.objects.filter(impegno=im1).order_by('numero').values_list('numero', 'importo')), [(1, 6.0), (6, 1.0)])
+        self.assertEqual(Mandato.objects.get(impegno=im1, numero=1).pk, pk)
+        self.assertEqual((writer.stats['Mandato.created'], writer.stats['Mandato.updated'], writer.stats['Mandato.deleted']), (4, 1, 1))
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.utils.module_loading import autodiscover_modules
+
+
+class JobsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'Jobs'
+
+    def ready(self):
+        # Register tasks defined in the tasks.py modules of all the apps
+        autodiscover_modules('tasks')
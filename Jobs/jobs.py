@@ -0,0 +1,263 @@
+import os
+import time
+import shutil
+import socket
+import logging
+import datetime
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Job
+
+
+logger = logging.getLogger(__name__)
+
+
+# Task registry
+# =============
+#
+# Tasks are functions registered with the @task decorator in the tasks.py module of any app (they are
+# discovered at startup). A task receives a JobContext and the keyword arguments given to enqueue() and
+# returns a JSON encodable result. Files produced by the task should be stored with JobContext.set_result_file().
+
+_tasks = {}
+
+
+def task(name):
+    """ Decorator to register a task
+    """
+    def decorator(func):
+        _tasks[name] = func
+        return func
+    return decorator
+
+
+def get_task(name):
+    return _tasks[name]
+
+
+def enqueue(name, user=None, input_file=None, input_name="input", **kwargs):
+    """ Submit a job. The optional input_file (file-like object) is copied in the job directory.
+    Return the Job
+    """
+    if name not in _tasks:
+        raise KeyError(f"Task {name} is not registered")
+    # Job is created as running to avoid being picked before the input is ready
+    job = Job.objects.create(task=name, args=kwargs, user=user if user is not None and user.is_authenticated else None, state=Job.RUNNING)
+    if input_file is not None:
+        try:
+            with open(os.path.join(job.get_dir(), input_name), 'wb') as f:
+                shutil.copyfileobj(input_file, f)
+        except Exception:
+            shutil.rmtree(job.get_dir(), ignore_errors=True)
+            job.delete()
+            raise
+        job.input_file = os.path.join("{0:d}".format(job.pk), input_name)
+    job.state = Job.PENDING
+    job.save()
+    return job
+
+
+class JobContext(object):
+    """ Interface of a running job for the task
+    """
+    def __init__(self, job):
+        self.job = job
+
+    @property
+    def input_path(self):
+        return self.job.get_input_path()
+
+    def progress(self, value, message=None):
+        """ Update progress (from 0 to 1) and optionally the message
+        """
+        self.job.progress = value
+        fields = {'progress': value}
+        if message is not None:
+            self.job.message = message[:256]
+            fields['message'] = self.job.message
+        Job.objects.filter(pk=self.job.pk).update(**fields)
+
+    def result_path(self, name):
+        """ Path where to write a result file
+        """
+        return os.path.join(self.job.get_dir(), name)
+
+    def set_result_file(self, name, download_name=None):
+        """ Set the result file (written in result_path(name)) and the name to be used for the download
+        """
+        self.job.result_file = os.path.join("{0:d}".format(self.job.pk), name)
+        self.job.result_name = download_name if download_name is not None else name
+
+
+def execute_job(pk):
+    """ Execute a claimed job and store its result
+    """
+    job = Job.objects.get(pk=pk)
+    context = JobContext(job)
+    try:
+        job.result = get_task(job.task)(context, **job.args)
+        job.state = Job.DONE
+        job.progress = 1.0
+    except Exception:
+        job.state = Job.FAILED
+        job.error = traceback.format_exc()
+        logger.error(f"Job {job.pk} ({job.task}) failed: {job.error}")
+    job.finished = timezone.now()
+    job.save()
+    return pk
+
+
+def _execute_job_thread(pk):
+    # Close the connections of the thread when done
+    try:
+        return execute_job(pk)
+    finally:
+        connections.close_all()
+
+
+def claim_job(worker):
+    """ Claim the oldest pending job
+    Return the job pk or None
+    """
+    with transaction.atomic():
+        pk = (
+            Job.objects
+            .select_for_update(skip_locked=True)
+            .filter(state=Job.PENDING)
+            .order_by('created')
+            .values_list('pk', flat=True)
+            .first()
+        )
+        if pk is None:
+            return None
+        # Conditional update, for backends without row locking
+        if not Job.objects.filter(pk=pk, state=Job.PENDING).update(state=Job.RUNNING, started=timezone.now(), worker=worker):
+            return None
+    return pk
+
+
+def worker_name():
+    return "{0:s}:{1:d}".format(socket.gethostname(), os.getpid())
+
+
+def fail_orphan_jobs():
+    """ Mark as failed the jobs left running by dead workers on this host
+    """
+    host = socket.gethostname()
+    for job in Job.objects.filter(state=Job.RUNNING, worker__startswith=host + ":"):
+        try:
+            pid = int(job.worker.split(":")[-1])
+            os.kill(pid, 0)
+            continue
+        except (ValueError, ProcessLookupError):
+            pass
+        except PermissionError:
+            continue
+        job.state = Job.FAILED
+        job.error = "Worker died"
+        job.finished = timezone.now()
+        job.save()
+
+
+# Cleanup
+# =======
+#
+# Finished jobs (done or failed) older than the expiry time are deleted together with their directory
+# (input and result files). The cleanup is run periodically by the workers and by the cleanup_jobs command.
+#
+# Settings:
+#  - JOBS_EXPIRY: expiry time of finished jobs in seconds (default: 7 days)
+
+CLEANUP_INTERVAL = 3600
+
+
+def cleanup_jobs():
+    """ Delete the expired finished jobs and their files
+    Return the number of deleted jobs
+    """
+    limit = timezone.now() - datetime.timedelta(seconds=getattr(settings, 'JOBS_EXPIRY', 7 * 24 * 3600))
+    expired = list(Job.objects.filter(state__in=[Job.DONE, Job.FAILED], finished__lt=limit).values_list('pk', flat=True))
+    for pk in expired:
+        shutil.rmtree(os.path.join(Job.root(), "{0:d}".format(pk)), ignore_errors=True)
+    Job.objects.filter(pk__in=expired).delete()
+    return len(expired)
+
+
+def _cleanup(last):
+    # Run the cleanup if the last one is older than CLEANUP_INTERVAL, return the time of the last cleanup
+    if time.monotonic() - last < CLEANUP_INTERVAL:
+        return last
+    try:
+        n = cleanup_jobs()
+        if n:
+            logger.info(f"Deleted {n} expired jobs")
+    except Exception as e:
+        logger.error(f"Failed to delete expired jobs: {e}")
+    return time.monotonic()
+
+
+def run_worker(workers=1, mode='thread', poll=1.0, once=False):
+    """ Execute the pending jobs in a pool of threads or processes ('inline' executes them in the current thread)
+    If once is True return when there are no more pending jobs
+    Return the number of executed jobs
+    """
+    name = worker_name()
+    fail_orphan_jobs()
+    last_cleanup = _cleanup(-CLEANUP_INTERVAL)
+    done = 0
+
+    if mode == 'inline':
+        while True:
+            pk = claim_job(name)
+            if pk is None:
+                if once:
+                    return done
+                last_cleanup = _cleanup(last_cleanup)
+                time.sleep(poll)
+                continue
+            execute_job(pk)
+            done += 1
+
+    if mode == 'process':
+        # Connections must not be shared with forked processes
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=workers)
+        run = execute_job
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        run = _execute_job_thread
+
+    running = {}
+    with pool:
+        while True:
+            # Fill the pool
+            while len(running) < workers:
+                pk = claim_job(name)
+                if pk is None:
+                    break
+                if mode == 'process':
+                    connections.close_all()
+                running[pool.submit(run, pk)] = pk
+
+            if not len(running):
+                if once:
+                    return done
+                last_cleanup = _cleanup(last_cleanup)
+                time.sleep(poll)
+                continue
+
+            finished, _ = wait(running.keys(), timeout=poll, return_when=FIRST_COMPLETED)
+            for f in finished:
+                pk = running.pop(f)
+                try:
+                    f.result()
+                except Exception as e:
+                    # The job could not store its result (i.e. the process died)
+                    logger.error(f"Worker failure on job {pk}: {e}")
+                    Job.objects.filter(pk=pk, state=Job.RUNNING).update(state=Job.FAILED, error=f"Worker failure: {e}", finished=timezone.now())
+                done += 1
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from Jobs.jobs import cleanup_jobs
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired background jobs and their files'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Deleted {0:d} jobs".format(cleanup_jobs()))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from Jobs.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Execute background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Number of jobs executed in parallel')
+        parser.add_argument('--mode', choices=['thread', 'process', 'inline'], default='thread', help='Execute jobs in threads, processes or in the main thread')
+        parser.add_argument('--poll', type=float, default=1.0, help='Polling interval in seconds')
+        parser.add_argument('--once', action='store_true', help='Exit when there are no more pending jobs')
+
+    def handle(self, *args, **options):
+        done = run_worker(options['workers'], options['mode'], options['poll'], options['once'])
+        self.stdout.write("Executed {0:d} jobs".format(done))
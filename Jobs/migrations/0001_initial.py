@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=128)),
+                ('args', models.JSONField(blank=True, default=dict)),
+                ('state', models.CharField(choices=[('PE', 'Pending'), ('RU', 'Running'), ('DO', 'Done'), ('FA', 'Failed')], default='PE', max_length=2)),
+                ('progress', models.FloatField(default=0.0)),
+                ('message', models.CharField(blank=True, default='', max_length=256)),
+                ('input_file', models.CharField(blank=True, default='', max_length=256)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('result_file', models.CharField(blank=True, default='', max_length=256)),
+                ('result_name', models.CharField(blank=True, default='', max_length=256)),
+                ('error', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'permissions': [('job_view', 'View all jobs')],
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['state', 'created'], name='Jobs_job_state_6f46ad_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,73 @@
+import os
+from django.db import models
+from django.conf import settings
+
+
+class Job(models.Model):
+    """ Background job, executed by the 'runworker' command
+    """
+    # Task name (see registry in jobs.py)
+    task = models.CharField(max_length=128)
+    # Task arguments
+    args = models.JSONField(default=dict, blank=True)
+    # User that submitted the job
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+
+    PENDING = "PE"
+    RUNNING = "RU"
+    DONE = "DO"
+    FAILED = "FA"
+    STATES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+    state = models.CharField(max_length=2, choices=STATES, default=PENDING)
+    # Progress (from 0 to 1) and message
+    progress = models.FloatField(default=0.0)
+    message = models.CharField(max_length=256, blank=True, default="")
+    # Input file (path relative to JOBS_ROOT)
+    input_file = models.CharField(max_length=256, blank=True, default="")
+    # Result (JSON encodable) and result file (path relative to JOBS_ROOT)
+    result = models.JSONField(null=True, blank=True)
+    result_file = models.CharField(max_length=256, blank=True, default="")
+    result_name = models.CharField(max_length=256, blank=True, default="")
+    # Traceback of failed jobs
+    error = models.TextField(blank=True, default="")
+    # Worker running the job (hostname:pid)
+    worker = models.CharField(max_length=128, blank=True, default="")
+    # Timestamps
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "Job {0:d} ({1:s}): {2:s}".format(self.pk, self.task, self.get_state_display())
+
+    class Meta:
+        ordering = ["-created"]
+        indexes = [
+            models.Index(fields=['state', 'created']),
+        ]
+        default_permissions = ()
+        permissions = [
+            ('job_view', 'View all jobs'),
+        ]
+
+    @staticmethod
+    def root():
+        return str(getattr(settings, 'JOBS_ROOT', os.path.join(settings.BASE_DIR, 'jobs')))
+
+    def get_dir(self):
+        """ Directory for input and result files of the job
+        """
+        path = os.path.join(self.root(), "{0:d}".format(self.pk))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get_input_path(self):
+        return os.path.join(self.root(), self.input_file) if self.input_file else None
+
+    def get_result_path(self):
+        return os.path.join(self.root(), self.result_file) if self.result_file else None
@@ -0,0 +1,109 @@
+import io
+import os
+import datetime
+import tempfile
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .jobs import task, enqueue, claim_job, cleanup_jobs, run_worker
+from .models import Job
+
+
+@task('Jobs.test_echo')
+def echo(job, value):
+    with open(job.input_path, 'r') as f:
+        data = f.read()
+    job.progress(0.5, "Half done")
+    with open(job.result_path('echo.txt'), 'w') as f:
+        f.write(data * value)
+    job.set_result_file('echo.txt', 'result.txt')
+    return {'length': len(data) * value}
+
+
+@task('Jobs.test_fail')
+def fail(job):
+    raise ValueError("Failed on purpose")
+
+
+class JobQueueTest(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings = override_settings(JOBS_ROOT=self.tmp.name)
+        self.settings.enable()
+        self.user = get_user_model().objects.create_user(username='mrossi', password='x')
+        self.other = get_user_model().objects.create_user(username='gbianchi', password='x')
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmp.cleanup()
+
+    def test_execute(self):
+        job = enqueue('Jobs.test_echo', user=self.user, input_file=io.BytesIO(b"abc"), value=2)
+        self.assertEqual(job.state, Job.PENDING)
+        self.assertEqual(run_worker(mode='inline', once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.DONE)
+        self.assertEqual(job.progress, 1.0)
+        self.assertEqual(job.result, {'length': 6})
+        with open(job.get_result_path(), 'r') as f:
+            self.assertEqual(f.read(), "abcabc")
+
+        # Nothing left to do
+        self.assertIsNone(claim_job('test'))
+
+    def test_failure(self):
+        job = enqueue('Jobs.test_fail', user=self.user)
+        run_worker(mode='inline', once=True)
+        job.refresh_from_db()
+        self.assertEqual(job.state, Job.FAILED)
+        self.assertIn("Failed on purpose", job.error)
+
+    def test_cleanup(self):
+        old = enqueue('Jobs.test_echo', user=self.user, input_file=io.BytesIO(b"abc"), value=1)
+        new = enqueue('Jobs.test_echo', user=self.user, input_file=io.BytesIO(b"abc"), value=1)
+        pending = enqueue('Jobs.test_echo', user=self.user, input_file=io.BytesIO(b"abc"), value=1)
+        Job.objects.filter(pk=pending.pk).update(state=Job.RUNNING)
+        run_worker(mode='inline', once=True)
+        Job.objects.filter(pk=old.pk).update(finished=timezone.now() - datetime.timedelta(days=8))
+
+        # Only the expired finished jobs are deleted, with their directory
+        self.assertEqual(cleanup_jobs(), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), set([new.pk, pending.pk]))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, str(old.pk))))
+        new.refresh_from_db()
+        self.assertTrue(os.path.exists(new.get_result_path()))
+
+        # Directory of a job whose input could not be copied
+        class Broken(io.RawIOBase):
+            def read(self, *args):
+                raise OSError("Broken input")
+        with self.assertRaises(OSError):
+            enqueue('Jobs.test_echo', user=self.user, input_file=Broken(), value=1)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), sorted([str(new.pk), str(pending.pk)]))
+
+    def test_unknown_task(self):
+        with self.assertRaises(KeyError):
+            enqueue('Jobs.missing')
+
+    def test_views(self):
+        job = enqueue('Jobs.test_echo', user=self.user, input_file=io.BytesIO(b"xy"), value=1)
+        self.client.force_login(self.user)
+        r = self.client.get(reverse('job_status', kwargs={'pk': job.pk}))
+        self.assertEqual(r.json()['state'], Job.PENDING)
+        self.assertEqual(self.client.get(reverse('job_result', kwargs={'pk': job.pk})).status_code, 404)
+
+        run_worker(mode='inline', once=True)
+        r = self.client.get(reverse('job_status', kwargs={'pk': job.pk}))
+        self.assertEqual(r.json()['result'], {'length': 2})
+        r = self.client.get(r.json()['result_url'])
+        self.assertEqual(b"".join(r.streaming_content), b"xy")
+        r.close()
+        self.assertEqual(len(self.client.get(reverse('job_list')).json()['jobs']), 1)
+
+        # Other users cannot access the job
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(reverse('job_status', kwargs={'pk': job.pk})).status_code, 403)
+        self.assertEqual(len(self.client.get(reverse('job_list')).json()['jobs']), 0)
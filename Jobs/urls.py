@@ -0,0 +1,10 @@
+from django.urls import path
+
+from . import views
+
+
+urlpatterns = [
+    path('', views.JobList.as_view(), name='job_list'),
+    path('<int:pk>/status', views.JobStatus.as_view(), name='job_status'),
+    path('<int:pk>/result', views.JobResult.as_view(), name='job_result'),
+]
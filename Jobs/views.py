@@ -0,0 +1,74 @@
+import os
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.http import JsonResponse, Http404, FileResponse
+from django.views import View
+from django.contrib.auth.mixins import PermissionRequiredMixin
+
+from .models import Job
+
+
+def job_status(job):
+    """ JSON encodable status of a job
+    """
+    out = {
+        'id': job.pk,
+        'task': job.task,
+        'state': job.state,
+        'state_display': job.get_state_display(),
+        'progress': job.progress,
+        'message': job.message,
+        'created': job.created,
+        'started': job.started,
+        'finished': job.finished,
+        'status_url': reverse('job_status', kwargs={'pk': job.pk}),
+    }
+    if job.state == Job.DONE:
+        out['result'] = job.result
+        if job.result_file:
+            out['result_url'] = reverse('job_result', kwargs={'pk': job.pk})
+    if job.state == Job.FAILED:
+        out['error'] = job.error.strip().split("\n")[-1] if job.error else ""
+    return out
+
+
+class JobPermissionMixin(PermissionRequiredMixin):
+    """ Jobs can be accessed by the user that submitted them or by users with the job_view permission
+    """
+    def has_permission(self):
+        self.job = get_object_or_404(Job, pk=self.kwargs['pk'])
+        if self.request.user.has_perm('Jobs.job_view'):
+            return True
+        return self.request.user.is_authenticated and self.job.user_id == self.request.user.pk
+
+
+class JobList(PermissionRequiredMixin, View):
+    http_method_names = ['get', ]
+
+    def has_permission(self):
+        return self.request.user.is_authenticated
+
+    def get(self, request, *args, **kwargs):
+        jobs = Job.objects.all()
+        if not request.user.has_perm('Jobs.job_view'):
+            jobs = jobs.filter(user=request.user)
+        return JsonResponse({'jobs': [job_status(j) for j in jobs[:50]]})
+
+
+class JobStatus(JobPermissionMixin, View):
+    http_method_names = ['get', ]
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(job_status(self.job))
+
+
+class JobResult(JobPermissionMixin, View):
+    http_method_names = ['get', ]
+
+    def get(self, request, *args, **kwargs):
+        if self.job.state != Job.DONE or not self.job.result_file:
+            raise Http404('Result not available')
+        path = self.job.get_result_path()
+        if not os.path.exists(path):
+            raise Http404('Result not available')
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=self.job.result_name)
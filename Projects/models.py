@@ -34,11 +34,12 @@ class Researcher(models.Model):
         if year >= 2021 and is_horizon_eu:
             return 1548
         else:
-            d1 = (datetime.date(year,1,1) - self.researcherrole_set.order_by('start_date').first().start_date).days
+            start_date = self.researcherrole_set.order_by('start_date').first().start_date
+            d1 = (datetime.date(year,1,1) - start_date).days
             if d1 / 365.0 > 3:
                 return 1506
             else:
-                d2 = (datetime.date(year,12,31) - self.researcherrole_set.order_by('start_date').first().start_date).days
+                d2 = (datetime.date(year,12,31) - start_date).days
                 if d2 / 365 <= 3:
                     return 1520
                 else:
@@ -0,0 +1,159 @@
+import datetime
+import calendar
+import numpy as np
+
+from .models import EpasCode, ReportedWork
+from .timesheets import TimesheetDataLoader, SaveTimesheetData, status_tracker
+from .utils import ReportingError
+
+
+# Automatic allocation of timesheets
+# ==================================
+#
+# The hours reported on each project (or on each WP, for projects splitted on WPs) are spread over the
+# editable days of the month (working days without absence codes, within the reporting period) in proportion
+# to the hours available in each day, so that the total of each day never exceeds the worked hours.
+# Hours are allocated in steps of 0.1h. When the reported hours are not a multiple of 0.1h the residual
+# is added to a single day, so that the total matches exactly the reported hours.
+
+def allocate_hours(targets, masks, capacity):
+    """ Split the target hours of each line over the days allowed by its mask, within the daily capacity
+     - targets: array (nlines) of hours
+     - masks: boolean array (nlines, ndays) of the days allowed for each line
+     - capacity: array (ndays) of hours available in each day
+    Return an array (nlines, ndays) with the allocated hours
+    Raise ReportingError if the hours do not fit in the available days
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    masks = np.asarray(masks, dtype=bool)
+
+    # Work in tenths of hour
+    tenths = np.floor(targets * 10.0 + 1e-6).astype(np.int64)
+    residuals = targets - tenths / 10.0
+    residuals[residuals < 1e-6] = 0.0
+    remaining = np.floor(np.asarray(capacity, dtype=np.float64) * 10.0 + 1e-6).astype(np.int64)
+
+    out = np.zeros(masks.shape, dtype=np.float64)
+
+    # Most constrained lines first
+    for l in np.argsort(masks.sum(axis=1), kind='stable'):
+        available = np.where(masks[l], remaining, 0)
+        total = available.sum()
+        needed = tenths[l] + (1 if residuals[l] > 0 else 0)
+        if needed > total:
+            raise ReportingError("Cannot allocate {0:.1f} hours on {1:d} days with {2:.1f} available hours".format(targets[l], int(masks[l].sum()), total / 10.0))
+
+        alloc = np.zeros(available.shape, dtype=np.int64)
+        if tenths[l] > 0:
+            # Split in proportion to the available hours
+            share = available * (tenths[l] / total)
+            alloc = np.floor(share).astype(np.int64)
+
+            # Largest remainder method for the tenths left
+            missing = tenths[l] - alloc.sum()
+            if missing > 0:
+                frac = share - alloc
+                frac[alloc >= available] = -1.0
+                alloc[np.argsort(-frac, kind='stable')[:missing]] += 1
+
+        remaining -= alloc
+        out[l] = alloc / 10.0
+
+        if residuals[l] > 0:
+            # Add the residual to the day with most hours among the ones with at least 0.1h left
+            d = np.argmax(np.where(masks[l] & (remaining > 0), alloc, -1))
+            remaining[d] -= 1
+            out[l, d] += residuals[l]
+
+    return out
+
+
+def allocate_timesheet(loader, month, max_daily=None):
+    """ Allocate the hours reported by a researcher in a month (data from a TimesheetDataLoader)
+    Optionally the hours allocated in a day can be capped to max_daily
+    Return a tuple (projects, workpackages) in the format expected by SaveTimesheetData
+    Raise ReportingError if the allocation is not possible
+    """
+    year = loader.year
+    ndays = calendar.monthrange(year, month)[1]
+    start = datetime.date(year, month, 1)
+    end = datetime.date(year, month, ndays)
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1)
+
+    # Hours available in editable days
+    capacity = np.zeros(ndays, dtype=np.float64)
+    for day, hours, ts_code in loader.presences[month]:
+        if hours > 0 and (ts_code is None or ts_code == EpasCode.NONE):
+            capacity[day.day - 1] = round(hours * 10.0) / 10.0
+    capacity[loader.calendar.holiday[loader.calendar.range(start, end)]] = 0.0
+    if max_daily is not None:
+        capacity = np.minimum(capacity, max_daily)
+
+    # Lines to allocate
+    keys = []
+    targets = []
+    masks = []
+    for w in loader.work[month]:
+        mask = (capacity > 0) & (days >= np.datetime64(w.period.rp_start, 'D')) & (days <= np.datetime64(w.period.rp_end, 'D'))
+        wps = loader.fractions[w.pk]
+        if len(wps):
+            for wp in wps:
+                keys.append(('workpackages', wp['wp_pk']))
+                targets.append(wp['hours'])
+                masks.append(mask)
+        else:
+            keys.append(('projects', w.period.project_id))
+            targets.append(w.hours)
+            masks.append(mask)
+
+    out = {'projects': {}, 'workpackages': {}}
+    if not len(keys):
+        return (out['projects'], out['workpackages'])
+
+    try:
+        alloc = allocate_hours(targets, np.array(masks), capacity)
+    except ReportingError as e:
+        raise ReportingError("Failed to allocate timesheet of RID {0!s} for {1:d}/{2:d} (Error: {3!s})".format(loader.rid, month, year, e))
+
+    for (kind, pk), line in zip(keys, alloc):
+        hours = out[kind].setdefault(pk, {})
+        for d in np.nonzero(line)[0]:
+            hours[datetime.date(year, month, int(d) + 1)] = float(line[d])
+
+    return (out['projects'], out['workpackages'])
+
+
+def allocate_timesheets(year, rids=None, months=None, max_daily=None, force=False, save=True):
+    """ Allocate the timesheets of a year for many researchers (all the researchers with reported work if rids is None)
+    Months with consistent timesheets are skipped, unless force is True
+    Return a dictionary rid -> month -> tuple (projects, workpackages) or the ReportingError raised
+    """
+    if rids is None:
+        rids = list(
+            ReportedWork.objects
+            .filter(year=year)
+            .order_by('researcher')
+            .values_list('researcher', flat=True)
+            .distinct()
+        )
+
+    out = {}
+    for rid in rids:
+        out[rid] = {}
+        loader = TimesheetDataLoader(rid, year, months)
+        # Refresh the timesheet status only once for each researcher
+        with status_tracker.deferred():
+            for month in loader.months:
+                if not len(loader.work[month]):
+                    continue
+                if not force and loader.check(month)[0]:
+                    continue
+                try:
+                    projects, workpackages = allocate_timesheet(loader, month, max_daily)
+                    if save:
+                        SaveTimesheetData(rid, year, month, projects, workpackages)
+                    out[rid][month] = (projects, workpackages)
+                except ReportingError as e:
+                    out[rid][month] = e
+
+    return out
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ReportingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Reporting'
+
+    def ready(self):
+        # Connect signals
+        from . import signals  # noqa: F401
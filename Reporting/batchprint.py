@@ -0,0 +1,161 @@
+import io
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils.text import slugify
+
+from Projects.models import Researcher
+from .models import ReportedWork, ReportedMission
+from .pdfcache import PrintCachedPDFTimesheet
+from .timesheets import GetTimesheetPrintContext
+
+
+# Batch printing of timesheets
+# ============================
+#
+# The context of each document is built in the calling process (it needs the DB), while the PDFs are
+# rendered in a pool of processes. Contexts are built only when a process is about to be free, so that
+# just a few of them are held in memory. The documents are streamed in a ZIP archive as soon as they are
+# ready. Failures are collected in an 'errors.txt' file added at the end of the archive.
+# When the archive is streamed in a web request the pool is kept small and large batches are printed by
+# a background job (see the print_timesheets task).
+#
+# Settings:
+#  - TIMESHEET_PRINT_WORKERS: processes rendering the PDFs in a web request (default: 2)
+#  - TIMESHEET_PRINT_JOB_WORKERS: processes rendering the PDFs in a background job (default: 2, as the job
+#    worker may already run many jobs in parallel)
+#  - TIMESHEET_PRINT_INLINE_MAX: maximum number of timesheets printed in a web request (default: 20)
+
+def timesheet_print_jobs(year=None, period=None):
+    """ List of the timesheets to print, for all the researchers with reported work or missions in a year
+    or in a reporting period (in this case only the timesheets of the project are printed)
+    Return a list of tuples (filename, researcher, year, months, project), with months None for the whole year
+    """
+    work = ReportedWork.objects
+    missions = ReportedMission.objects
+    if period is not None:
+        work = work.filter(period=period)
+        missions = missions.filter(period=period)
+    else:
+        work = work.filter(year=year)
+        missions = missions.for_year(year)
+
+    # Months by researcher and year
+    months = {}
+    for r, y, m in work.order_by().values_list('researcher', 'year', 'month').distinct():
+        months.setdefault((r, y), set()).add(m)
+    missions = (
+        missions
+        .annotate(year=ExtractYear('day__day'), month=ExtractMonth('day__day'))
+        .order_by()
+        .values_list('day__researcher', 'year', 'month')
+        .distinct()
+    )
+    for r, y, m in missions:
+        months.setdefault((r, y), set()).add(m)
+
+    researchers = Researcher.objects.in_bulk(set([r for r, y in months.keys()]))
+    project = period.project if period is not None else None
+
+    jobs = []
+    for (r, y), m in sorted(months.items(), key=lambda k: (str(researchers[k[0][0]]), k[0][1])):
+        researcher = researchers[r]
+        filename = slugify(f"{researcher.surname} {researcher.name} {y}") + ".pdf"
+        if project is not None:
+            filename = slugify(project.name) + "/" + filename
+        jobs.append((filename, researcher, y, sorted(m) if project is not None else None, project))
+    return jobs
+
+
+def render_timesheet(contextes):
+    """ Render the timesheet PDF (executed in the process pool)
+    """
+    return PrintCachedPDFTimesheet(contextes).getvalue()
+
+
+class ZipStream(object):
+    """ Write-only file object collecting the data written by ZipFile (not seekable, so that the archive is
+    written sequentially)
+    """
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        return data
+
+
+def print_workers():
+    """ Number of processes rendering the PDFs in a web request
+    """
+    return getattr(settings, 'TIMESHEET_PRINT_WORKERS', 2)
+
+
+def print_job_workers():
+    """ Number of processes rendering the PDFs in a background job
+    """
+    return getattr(settings, 'TIMESHEET_PRINT_JOB_WORKERS', 2)
+
+
+def print_inline(jobs):
+    """ Check if the jobs are few enough to be printed in a web request
+    """
+    return len(jobs) <= getattr(settings, 'TIMESHEET_PRINT_INLINE_MAX', 20)
+
+
+def iter_timesheets_zip(jobs, max_workers=None, errors=None):
+    """ Render the timesheets of the given jobs (see timesheet_print_jobs) and yield the chunks of a ZIP archive
+    Errors are appended to the errors list, if given, as tuples (filename, message)
+    """
+    if errors is None:
+        errors = []
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    jobs = iter(jobs)
+
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+
+            def submit():
+                # Build the context of the next job and submit it (False when there are no more jobs)
+                for filename, researcher, year, months, project in jobs:
+                    try:
+                        _, contextes = GetTimesheetPrintContext(researcher, year, months, project)
+                    except Exception as e:
+                        errors.append((filename, f"{researcher} {year}: {e}"))
+                        continue
+                    futures[pool.submit(render_timesheet, contextes)] = (filename, researcher, year)
+                    return True
+                return False
+
+            # Keep a document queued for each process, besides the one being rendered
+            while len(futures) < 2 * max_workers and submit():
+                pass
+
+            while len(futures):
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename, researcher, year = futures.pop(future)
+                    try:
+                        archive.writestr(filename, future.result())
+                    except Exception as e:
+                        errors.append((filename, f"{researcher} {year}: {e}"))
+                    submit()
+                    yield stream.pop()
+
+        if len(errors):
+            archive.writestr('errors.txt', "\n".join([f"{f}: {msg}" for f, msg in errors]) + "\n")
+
+    yield stream.pop()
@@ -0,0 +1,154 @@
+import numpy as np
+
+from django.core.cache import cache
+from django.db.models import Min
+
+from Projects.models import ResearcherRole
+from .models import PersonnelCost
+
+
+# Personnel costs
+# ===============
+#
+# Productive hours and hourly rates of all the researchers for all the years with a personnel cost are
+# computed at once as matrices (researchers x years) from the first role of each researcher and the
+# personnel costs, loaded with one query each. The rules are the same of Researcher.get_productive_hours():
+#  - Horizon Europe projects (from 2021): 1548 hours
+#  - otherwise 1520 hours in the first three years from the first role, 1506 hours after, with the year
+#    crossing the three years linearly interpolated.
+# The matrix is cached (with the Django cache, shared by all the processes) and invalidated by the signals
+# in signals.py.
+
+CACHE_KEY = 'Reporting.costs'
+CACHE_TIMEOUT = 3600
+
+HORIZON_EU_AGENCIES = ('EU-HorizonEu', )
+HORIZON_EU_HOURS = 1548
+HORIZON_EU_START = 2021
+
+
+def is_horizon_eu(project):
+    return project.agency in HORIZON_EU_AGENCIES
+
+
+def productive_hours(first_start, years, is_horizon_eu=False):
+    """ Productive hours for researchers whose first role started on first_start (array of dates, NaT if
+    unknown) in the given years. Return a matrix (researchers x years), NaN where the start is unknown
+    """
+    first_start = np.asarray(first_start, dtype='datetime64[D]')[:, np.newaxis]
+    years = np.asarray(years, dtype=np.int64)[np.newaxis, :]
+    year_start = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    year_end = (years - 1970 + 1).astype('datetime64[Y]').astype('datetime64[D]') - np.timedelta64(1, 'D')
+
+    d1 = (year_start - first_start).astype(np.float64) / 365.0
+    d2 = (year_end - first_start).astype(np.float64) / 365.0
+    with np.errstate(invalid='ignore'):
+        hours = np.where(d1 > 3, 1506.0, np.where(d2 <= 3, 1520.0, np.round(1520 * (1 - (d2 - 3)) + 1506 * (d2 - 3))))
+    hours[np.isnat(np.broadcast_to(first_start, hours.shape))] = np.nan
+    if is_horizon_eu:
+        hours = np.where(np.broadcast_to(years >= HORIZON_EU_START, hours.shape), float(HORIZON_EU_HOURS), hours)
+    return hours
+
+
+class CostMatrix(object):
+    """ Personnel costs, productive hours and hourly rates by researcher and year
+    """
+
+    def __init__(self, researchers, years, first_start, costs):
+        # researchers: list of pks, years: list of years, first_start: dates of first role, costs: matrix (NaN if missing)
+        self.researchers = list(researchers)
+        self.years = list(years)
+        self.first_start = np.asarray(first_start, dtype='datetime64[D]')
+        self.costs = np.asarray(costs, dtype=np.float64).reshape((len(self.researchers), len(self.years)))
+        self._rindex = {pk: i for i, pk in enumerate(self.researchers)}
+        self._yindex = {y: i for i, y in enumerate(self.years)}
+
+        self.hours = productive_hours(self.first_start, self.years)
+        self.hours_heu = productive_hours(self.first_start, self.years, is_horizon_eu=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.rates = np.round(self.costs / self.hours * 100.0) / 100.0
+            self.rates_heu = np.round(self.costs / self.hours_heu * 100.0) / 100.0
+
+    def _lookup(self, matrix, researchers, years):
+        researchers = np.atleast_1d(researchers)
+        years = np.atleast_1d(years)
+        ri = np.array([self._rindex.get(r, -1) for r in researchers], dtype=np.int64)
+        yi = np.array([self._yindex.get(y, -1) for y in years], dtype=np.int64)
+        ri, yi = np.broadcast_arrays(ri, yi)
+        out = np.full(ri.shape, np.nan)
+        good = (ri >= 0) & (yi >= 0)
+        out[good] = matrix[ri[good], yi[good]]
+        return out
+
+    def hourly_rates(self, researchers, years, is_horizon_eu=False):
+        """ Hourly rates for arrays of researcher pks and years (NaN if not available)
+        """
+        return self._lookup(self.rates_heu if is_horizon_eu else self.rates, researchers, years)
+
+    def hourly_rate(self, researcher, year, is_horizon_eu=False):
+        """ Hourly rate of a researcher in a year (None if not available)
+        """
+        rate = self.hourly_rates(researcher, year, is_horizon_eu)[0]
+        return None if np.isnan(rate) else float(rate)
+
+    def price(self, researchers, years, hours, is_horizon_eu=False):
+        """ Cost of the given hours (arrays of researcher pks, years and hours). NaN where the rate is not available
+        """
+        return self.hourly_rates(researchers, years, is_horizon_eu) * np.asarray(hours, dtype=np.float64)
+
+    def as_dict(self):
+        """ Matrices as a dictionary of lists (missing values are None)
+        """
+        def tolist(m):
+            return [[None if np.isnan(v) else float(v) for v in row] for row in m]
+
+        return {
+            'researchers': self.researchers,
+            'years': self.years,
+            'costs': tolist(self.costs),
+            'productive_hours': tolist(self.hours),
+            'productive_hours_heu': tolist(self.hours_heu),
+            'hourly_rates': tolist(self.rates),
+            'hourly_rates_heu': tolist(self.rates_heu),
+        }
+
+
+def build_cost_matrix(years=None):
+    """ Build the cost matrix for all the researchers with a role or a cost
+    If years is None, all the years with a personnel cost are included
+    """
+    first_start = dict(
+        ResearcherRole.objects
+        .order_by()
+        .values('researcher')
+        .annotate(first=Min('start_date'))
+        .values_list('researcher', 'first')
+    )
+    costs = list(PersonnelCost.objects.order_by().values_list('researcher', 'year', 'cost'))
+
+    if years is None:
+        years = sorted(set([y for r, y, c in costs]))
+    researchers = sorted(set(first_start.keys()) | set([r for r, y, c in costs]))
+    rindex = {pk: i for i, pk in enumerate(researchers)}
+    yindex = {y: i for i, y in enumerate(years)}
+
+    matrix = np.full((len(researchers), len(years)), np.nan)
+    for r, y, c in costs:
+        if y in yindex:
+            matrix[rindex[r], yindex[y]] = c
+    start = np.array([first_start.get(r, None) or 'NaT' for r in researchers], dtype='datetime64[D]')
+    return CostMatrix(researchers, years, start, matrix)
+
+
+def get_cost_matrix():
+    """ Cost matrix from the cache (built if needed)
+    """
+    matrix = cache.get(CACHE_KEY)
+    if matrix is None:
+        matrix = build_cost_matrix()
+        cache.set(CACHE_KEY, matrix, CACHE_TIMEOUT)
+    return matrix
+
+
+def invalidate_cost_matrix():
+    cache.delete(CACHE_KEY)
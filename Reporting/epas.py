@@ -0,0 +1,306 @@
+import io
+import os
+import re
+import csv
+import zipfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from Tags.templatetags.tr_month import month_num2it
+
+from .utils import ReportingError, ConvertApostrophe2Accent
+from .workcalendar import holiday_mask
+
+
+# Parser of EPAS exports
+# ======================
+#
+# The file is read once and kept in memory: the sheet names are available immediately (to validate the
+# file) while the sheets are read in streaming mode only when parsed. XLS files are read with xlrd, XLSX
+# with openpyxl (read-only mode), ODS with pandas (requires odfpy) and CSV files with the csv module (a CSV
+# file is a single sheet named after the file, e.g. "Rossi Mario_aprile2023.csv").
+# Sheets are parsed serially by default, as the file is usually parsed in a web request (forking a pool of
+# processes there costs more than it saves). Batch imports parallelize on files instead (see ingest.py).
+# With more workers the sheets are split over a pool of processes, each opening the file once.
+#
+# Settings:
+#  - EPAS_PARSER_WORKERS: maximum number of processes used to parse the sheets of a file (default: 1)
+
+# Sheet names of EPAS exports (researcher_monthYEAR) and of the old format (N or N-MONTH)
+EPAS_SHEET_RE = re.compile(r"([a-zA-Z \']+)_([a-z]+)(\d+)")
+OLD_SHEET_RE = re.compile(r"\d+\-(\d+)|(\d+)")
+
+# Codes of the old format
+OLD_CODES = {
+    "Ferie": "32",
+    "ferie": "32",
+    "RF": "91",
+    "Missione": "92",
+    "missione": "92",
+    "Malattia": "111",
+    "malattia": "111",
+}
+
+
+def detect_format(data):
+    """ Detect the format of a file from its content
+    """
+    if data[:4] == b'\xd0\xcf\x11\xe0':
+        return 'xls'
+    if data[:2] == b'PK':
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                if 'mimetype' in z.namelist() and z.read('mimetype').startswith(b'application/vnd.oasis.opendocument.spreadsheet'):
+                    return 'ods'
+                if '[Content_Types].xml' in z.namelist():
+                    return 'xlsx'
+        except zipfile.BadZipFile:
+            pass
+        raise ReportingError("File is not a valid spreadsheet")
+    try:
+        data[:4096].decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            data[:4096].decode('latin-1')
+        except UnicodeDecodeError:
+            raise ReportingError("File is not a valid spreadsheet")
+    return 'csv'
+
+
+class EpasFile(object):
+    """ EPAS export in XLS, XLSX, ODS or CSV format
+    """
+
+    def __init__(self, file, name=None):
+        if isinstance(file, bytes):
+            self.data = file
+        elif hasattr(file, 'read'):
+            if hasattr(file, 'seek'):
+                file.seek(0)
+            self.data = file.read()
+        else:
+            with open(file, 'rb') as f:
+                self.data = f.read()
+        if name is None:
+            if isinstance(file, (str, os.PathLike)):
+                name = str(file)
+            elif not isinstance(file, bytes):
+                name = getattr(file, 'name', None)
+        self.name = os.path.basename(name) if name else "presences"
+        self.format = detect_format(self.data)
+        self._book = None
+        self._ods = None
+
+        if self.format == 'xlsx':
+            import openpyxl
+            self._book = openpyxl.load_workbook(io.BytesIO(self.data), read_only=True, data_only=True)
+            self.sheet_names = list(self._book.sheetnames)
+        elif self.format == 'xls':
+            import xlrd
+            try:
+                self._book = xlrd.open_workbook(file_contents=self.data, on_demand=True)
+            except xlrd.XLRDError as e:
+                raise ReportingError(f"File is not a valid Excel file ({e})")
+            self.sheet_names = list(self._book.sheet_names())
+        elif self.format == 'ods':
+            try:
+                self._ods = pd.read_excel(io.BytesIO(self.data), engine='odf', sheet_name=None, header=None)
+            except ImportError:
+                raise ReportingError("Reading ODS files requires the odfpy package")
+            self.sheet_names = list(self._ods.keys())
+        else:
+            self.sheet_names = [os.path.splitext(self.name)[0], ]
+
+    def close(self):
+        if self.format == 'xlsx':
+            self._book.close()
+        elif self.format == 'xls':
+            self._book.release_resources()
+
+    def is_old_format(self):
+        return 'Riassunto RF' in self.sheet_names
+
+    def sheets(self, researcher):
+        """ List of the sheets with data of the researcher, as tuples (sheet name, year, month)
+        Year is None for the old format (it is taken from the data)
+        """
+        out = []
+        if self.is_old_format():
+            for n in self.sheet_names:
+                m = OLD_SHEET_RE.match(n)
+                if m is not None:
+                    month = [int(el) for el in m.groups() if el is not None]
+                    out.append((n, None, month_num2it(month[0])))
+        else:
+            for n in self.sheet_names:
+                m = EPAS_SHEET_RE.match(n)
+                if m is not None and ConvertApostrophe2Accent(str(m.groups()[0])) == researcher:
+                    out.append((n, int(m.groups()[2]), str(m.groups()[1])))
+        return out
+
+    def rows(self, sheet):
+        """ Read the rows of a sheet (as a list of tuples)
+        """
+        if self.format == 'xlsx':
+            return list(self._book[sheet].iter_rows(values_only=True))
+
+        elif self.format == 'xls':
+            import xlrd
+            s = self._book.sheet_by_name(sheet)
+            rows = []
+            for i in range(s.nrows):
+                row = []
+                for ctype, value in zip(s.row_types(i), s.row_values(i)):
+                    if ctype == xlrd.XL_CELL_DATE:
+                        value = xlrd.xldate.xldate_as_datetime(value, self._book.datemode)
+                    elif ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                        value = None
+                    row.append(value)
+                rows.append(tuple(row))
+            self._book.unload_sheet(sheet)
+            return rows
+
+        elif self.format == 'ods':
+            df = self._ods[sheet]
+            return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+
+        else:
+            try:
+                text = self.data.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                text = self.data.decode('latin-1')
+            try:
+                dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            return [tuple(v if v != "" else None for v in row) for row in csv.reader(io.StringIO(text), dialect)]
+
+    def parse(self, researcher, max_workers=None):
+        """ Parse the presences of a researcher
+        Return a dictionary year -> month (italian name) -> DataFrame with columns Date, Hours and Code
+        """
+        sheets = self.sheets(researcher)
+        old = self.is_old_format()
+
+        if max_workers is None:
+            max_workers = getattr(settings, 'EPAS_PARSER_WORKERS', 1)
+        max_workers = min(max_workers or 1, len(sheets))
+
+        if max_workers > 1:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(self.data, self.name)) as pool:
+                frames = list(pool.map(_parse_worker, [n for n, y, m in sheets], [old] * len(sheets)))
+        else:
+            frames = [parse_sheet(self.rows(n), old) for n, y, m in sheets]
+
+        out = {}
+        for (n, year, month), df in zip(sheets, frames):
+            if old:
+                if not len(df):
+                    continue
+                year = df['Date'].iloc[0].year
+                # Add 7.2 hours to missions (but only on working days!)
+                working_days = ~holiday_mask(df['Date'])
+                df.loc[(df['Code'] == "92").to_numpy() & working_days, 'Hours'] = 7.2
+            out.setdefault(year, {})[month] = df
+        return out
+
+
+# Parsing of single sheets
+# ========================
+
+def _column(df, name):
+    if name not in df.columns:
+        raise ReportingError(f"Missing column '{name}'")
+    return df[name]
+
+
+def parse_dates(values):
+    """ Convert dates (datetime or strings, with the day first)
+    """
+    values = pd.Series(values, dtype=object)
+    if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'mixed'):
+        return pd.to_datetime(values, errors='coerce', dayfirst=True)
+    return pd.to_datetime(values, errors='coerce')
+
+
+def parse_hours(values):
+    """ Convert worked hours ('hh:mm' strings or times) to float hours
+    """
+    text = pd.Series(values, dtype=object).astype(str).str.strip()
+    text = text.str.replace(r"^(\d+):(\d+)$", r"\1:\2:00", regex=True)
+    return (pd.to_timedelta(text, errors='coerce') / np.timedelta64(1, 'h')).fillna(0.0)
+
+
+def parse_codes(values):
+    """ Convert absence codes to strings. For days with multiple codes (separated by ';') a single code is
+    selected: the mission codes (92E, 92, 92M in order) or the first one
+    """
+    values = pd.Series(values, dtype=object)
+    numbers = pd.to_numeric(values, errors='coerce')
+    integers = (numbers.notna() & (numbers == np.floor(numbers))).to_numpy()
+
+    codes = values.astype(str).str.strip()
+    codes[integers] = numbers[integers].astype(np.int64).astype(str)
+    codes[values.isna().to_numpy() | codes.isin(['nan', 'None']).to_numpy()] = ""
+
+    multi = codes.str.contains(";", regex=False).to_numpy()
+    if multi.any():
+        delimited = ";" + codes[multi] + ";"
+        codes[multi] = np.select(
+            [
+                delimited.str.contains(";92E;", regex=False),
+                delimited.str.contains(";92;", regex=False),
+                delimited.str.contains(";92M;", regex=False),
+            ],
+            ["92E", "92", "92M"],
+            default=codes[multi].str.split(";").str[0],
+        )
+    return codes
+
+
+def parse_sheet(rows, old=False):
+    """ Parse the rows of a sheet
+    Return a DataFrame with columns Date, Hours and Code
+    """
+    if old:
+        # Old format: header on the fourth row, data in the first four columns
+        if len(rows) < 4:
+            return pd.DataFrame({'Date': pd.to_datetime([]), 'Hours': [], 'Code': []})
+        header = [str(h) if h is not None else "" for h in rows[3][:4]]
+        df = pd.DataFrame([r[:4] for r in rows[4:]], columns=header)
+        dates = parse_dates(_column(df, 'Giorno'))
+        good = dates.notna().to_numpy()
+        hours = pd.to_numeric(_column(df, 'Ore lavorate'), errors='coerce').fillna(0.0)
+        codes = _column(df, 'Ferie/Missione').where(_column(df, 'Ferie/Missione').notna(), "").replace(OLD_CODES)
+        return pd.DataFrame({
+            'Date': dates[good].reset_index(drop=True),
+            'Hours': hours[good].reset_index(drop=True).astype(np.float64),
+            'Code': codes[good].reset_index(drop=True).astype(str),
+        })
+
+    # Skip empty rows
+    rows = [r for r in rows if any([v is not None for v in r])]
+    if not len(rows):
+        return pd.DataFrame({'Date': pd.to_datetime([]), 'Hours': [], 'Code': []})
+    header = [str(h).strip() if h is not None else "" for h in rows[0]]
+    df = pd.DataFrame(rows[1:], columns=header)
+    return pd.DataFrame({
+        'Date': parse_dates(_column(df, 'Data')),
+        'Hours': parse_hours(_column(df, 'Lavoro effettivo (hh:mm)')),
+        'Code': parse_codes(_column(df, 'Tutti i codici di assenza')),
+    })
+
+
+# Process pool workers
+_worker_file = None
+
+
+def _init_worker(data, name):
+    global _worker_file
+    _worker_file = EpasFile(data, name)
+
+
+def _parse_worker(sheet, old):
+    return parse_sheet(_worker_file.rows(sheet), old)
@@ -0,0 +1,172 @@
+import csv
+import tempfile
+
+from django.db.models import Value
+from django.db.models.functions import Concat
+
+from .models import PresenceData, ReportedWork, ReportedMission, TimesheetHours
+
+
+# Exports of reporting data
+# =========================
+#
+# Raw data (presences, reported work with the split on workpackages, reported missions and timesheet hours)
+# can be exported as CSV or XLSX, filtered by researcher, project and year. Rows are fetched in chunks with
+# QuerySet.iterator() (server-side cursors on PostgreSQL) and written as they arrive: CSV files are streamed
+# directly to the response, XLSX files are written with the write-only mode of openpyxl to a temporary file.
+
+CHUNK_SIZE = 2000
+
+
+def _researcher(prefix=''):
+    return Concat(f"{prefix}researcher__surname", Value(' '), f"{prefix}researcher__name")
+
+
+class Export(object):
+    """ Definition of an export
+     - model: exported model
+     - permission: permission needed to export
+     - columns: list of tuples (header, field or expression)
+     - researcher, project: fields used to filter by researcher and project (None if the filter does not apply)
+     - order: ordering of the rows
+    Filtering by year uses for_year() on date based models, or the year field
+    """
+
+    def __init__(self, model, permission, columns, researcher, project, order):
+        self.model = model
+        self.permission = permission
+        self.columns = columns
+        self.researcher = researcher
+        self.project = project
+        self.order = order
+
+    @property
+    def headers(self):
+        return [h for h, f in self.columns]
+
+    def queryset(self, researcher=None, project=None, year=None):
+        qs = self.model.objects.all()
+        if year is not None:
+            qs = qs.for_year(year) if hasattr(qs, 'for_year') else qs.filter(year=year)
+        if researcher is not None:
+            qs = qs.filter(**{self.researcher: researcher})
+        if project is not None:
+            if self.project is None:
+                raise ValueError("Filter by project is not available for this export")
+            qs = qs.filter(**{self.project: project})
+
+        fields = []
+        expressions = {}
+        for i, (h, f) in enumerate(self.columns):
+            if isinstance(f, str):
+                fields.append(f)
+            else:
+                expressions[f"col{i:d}"] = f
+                fields.append(f"col{i:d}")
+        return qs.annotate(**expressions).order_by(*self.order).values_list(*fields)
+
+
+EXPORTS = {
+    'presences': Export(
+        PresenceData,
+        'Reporting.presences_view',
+        [
+            ('Researcher', _researcher()),
+            ('Date', 'day'),
+            ('Hours', 'hours'),
+            ('Code', 'code__code'),
+            ('TS code', 'ts_code'),
+        ],
+        researcher='researcher',
+        project=None,
+        order=('researcher__surname', 'researcher__name', 'day'),
+    ),
+    'work': Export(
+        ReportedWork,
+        'Reporting.rp_work_view',
+        [
+            ('Researcher', _researcher()),
+            ('Project', 'period__project__name'),
+            ('Period start', 'period__rp_start'),
+            ('Period end', 'period__rp_end'),
+            ('Year', 'year'),
+            ('Month', 'month'),
+            ('Hours', 'hours'),
+            ('Workpackage', 'workpackages__workpackage__name'),
+            ('WP fraction', 'workpackages__fraction'),
+            ('WP hours', 'workpackages__hours'),
+        ],
+        researcher='researcher',
+        project='period__project',
+        order=('researcher__surname', 'researcher__name', 'year', 'month', 'period__project__name', 'workpackages__workpackage__name'),
+    ),
+    'missions': Export(
+        ReportedMission,
+        'Reporting.rp_mission_view',
+        [
+            ('Researcher', _researcher('day__')),
+            ('Date', 'day__day'),
+            ('Hours', 'day__hours'),
+            ('Project', 'period__project__name'),
+            ('Period start', 'period__rp_start'),
+            ('Workpackage', 'workpackage__name'),
+        ],
+        researcher='day__researcher',
+        project='period__project',
+        order=('day__researcher__surname', 'day__researcher__name', 'day__day'),
+    ),
+    'timesheets': Export(
+        TimesheetHours,
+        'Reporting.timesheet_view',
+        [
+            ('Researcher', _researcher('report__')),
+            ('Date', 'day'),
+            ('Project', 'report__period__project__name'),
+            ('Workpackage', 'report_wp__workpackage__name'),
+            ('Hours', 'hours'),
+        ],
+        researcher='report__researcher',
+        project='report__period__project',
+        order=('report__researcher__surname', 'report__researcher__name', 'day', 'report__period__project__name'),
+    ),
+}
+
+
+def iter_export_rows(name, researcher=None, project=None, year=None, chunk_size=CHUNK_SIZE):
+    """ Iterate over the rows of an export (the first row is the header)
+    """
+    export = EXPORTS[name]
+    qs = export.queryset(researcher, project, year)
+    yield export.headers
+    for row in qs.iterator(chunk_size=chunk_size):
+        yield row
+
+
+class _Echo(object):
+    """ File-like object returning what is written (to stream CSV rows)
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    """ Iterate over the lines of a CSV file
+    """
+    writer = csv.writer(_Echo())
+    for row in rows:
+        yield writer.writerow(["" if v is None else v for v in row])
+
+
+def write_xlsx(rows, title='Export'):
+    """ Write rows to a temporary XLSX file (write-only mode). Return the file object, rewound
+    """
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=title)
+    for row in rows:
+        ws.append(list(row))
+    out = tempfile.TemporaryFile()
+    wb.save(out)
+    out.seek(0)
+    return out
@@ -1,14 +1,16 @@
 import re
-import pandas as pd
+import zipfile
 
 from django import forms
+from django.db import transaction
 from django.db.models import Q
-from django.db.models.functions import ExtractYear
 from django.core.exceptions import ValidationError
 
 from Projects.models import Researcher, WorkPackage
 from Reporting.models import EpasCode, PresenceData, ReportedWork, ReportedMission, ReportedWorkWorkpackage
-from Reporting.utils import ConvertApostrophe2Accent
+from Reporting.utils import ReportingError
+from Reporting.epas import EpasFile
+from Reporting.timesheets import status_tracker
 
 
 class EpasCodeUpdateForm(forms.Form):
@@ -39,28 +41,33 @@ class PresenceInputForm(forms.Form):
 
     def clean_file(self):
         file = self.cleaned_data['file']
+        name = f"{self.cleaned_data['researcher'].surname} {self.cleaned_data['researcher'].name}"
         try:
-            name = f"{self.cleaned_data['researcher'].surname} {self.cleaned_data['researcher'].name}"
-            xls = pd.ExcelFile(file)
-            good_sheets = 0
-            # Check if is an old format file
-            if 'Riassunto RF' in xls.sheet_names:
-                # TODO: any check for old files?
-                pass
-            else:
-                # Check that the file matches the selected researcher
-                for n in xls.sheet_names:
-                    m = re.match(r"([a-zA-Z \']+)_([a-z]+)(\d+)", n)
-                    if m is not None:
-                        if ConvertApostrophe2Accent(m.groups()[0]) == name:
-                            good_sheets += 1
-                if good_sheets == 0:
-                    raise ValidationError("Excel file does not contain data for the selected researcher")
-
-            return self.cleaned_data['file']
-
-        except ValueError:
-            raise ValidationError("File is not a valid Excel file")
+            # The file is opened once here and then parsed by the view
+            epas = EpasFile(file)
+        except ReportingError as e:
+            raise ValidationError(f"File is not a valid EPAS export ({e})")
+        except Exception:
+            raise ValidationError("File is not a valid EPAS export")
+
+        # Check that the file matches the selected researcher
+        # TODO: any check for old files?
+        if not epas.is_old_format() and not len(epas.sheets(name)):
+            raise ValidationError("File does not contain data for the selected researcher")
+
+        self.cleaned_data['epas'] = epas
+        return file
+
+
+class PresenceBulkInputForm(forms.Form):
+    file = forms.FileField(help_text="ZIP archive with the EPAS exports (XLS, XLSX, ODS or CSV) of many researchers")
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not zipfile.is_zipfile(file):
+            raise ValidationError("File is not a valid ZIP archive")
+        file.seek(0)
+        return file
 
 
 class ReportedWorkForm(forms.ModelForm):
@@ -149,14 +156,16 @@ class ReportedWorkForm(forms.ModelForm):
     def save(self, commit=True):
         instance = super().save(commit=False)
         if commit:
-            instance.save()
-            saved_pks = []
-            for rwp in self.reported_workpackages:
-                rwp.report = instance
-                rwp.save()
-                saved_pks.append(rwp.pk)
-            # Delete reported WP that are not included in the save
-            ReportedWorkWorkpackage.objects.filter(Q(report=self.instance) & ~Q(pk__in=saved_pks)).delete()
+            # Save the report and its workpackages together, refreshing the timesheet status once
+            with transaction.atomic(), status_tracker.deferred():
+                instance.save()
+                saved_pks = []
+                for rwp in self.reported_workpackages:
+                    rwp.report = instance
+                    rwp.save()
+                    saved_pks.append(rwp.pk)
+                # Delete reported WP that are not included in the save
+                ReportedWorkWorkpackage.objects.filter(Q(report=self.instance) & ~Q(pk__in=saved_pks)).delete()
         return instance
 
 
@@ -198,7 +207,7 @@ class AddReportedMissionForm(forms.Form):
 
         # Filter mission by year if needed
         if self.year is not None:
-            missions = missions.annotate(year=ExtractYear('day')).filter(year=self.year)
+            missions = missions.for_year(self.year)
 
         # Add workpackage selection
         wps = WorkPackage.objects.filter(project=self.period.project)
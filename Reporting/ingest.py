@@ -0,0 +1,170 @@
+import os
+import zipfile
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from Projects.models import Researcher
+from .epas import EpasFile, EPAS_SHEET_RE
+from .presences import import_presences
+from .utils import ReportingError, ConvertApostrophe2Accent
+
+
+# Bulk ingestion of EPAS exports
+# ==============================
+#
+# A directory or a ZIP archive with the EPAS exports of many researchers is ingested in one run. The files
+# are parsed in a pool of processes, the sheets are mapped to the researchers by name (as done for single
+# imports, "surname name") and the presences of each researcher are stored with import_presences.
+# Files in the old format cannot be mapped to researchers and are reported as errors.
+# When the archive is ingested in a web request the pool is kept small (or not used at all) and large
+# archives are ingested by a background job (see the ingest_presences task).
+#
+# Settings:
+#  - PRESENCE_INGEST_WORKERS: processes parsing the files in a web request (default: 1, no pool)
+#  - PRESENCE_INGEST_JOB_WORKERS: processes parsing the files in a background job (default: 2, as the job
+#    worker may already run many jobs in parallel)
+#  - PRESENCE_INGEST_INLINE_MAX: maximum number of files ingested in a web request (default: 20)
+
+EXTENSIONS = ('.xls', '.xlsx', '.ods', '.csv')
+
+
+def _is_epas_file(name):
+    base = os.path.basename(name)
+    return base.lower().endswith(EXTENSIONS) and not base.startswith('.') and not base.startswith('~$')
+
+
+def iter_epas_files(source):
+    """ Yield tuples (name, data) for the EPAS exports in a directory or in a ZIP archive (path or file object)
+    """
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for f in sorted(files):
+                if _is_epas_file(f):
+                    path = os.path.join(root, f)
+                    with open(path, 'rb') as fh:
+                        yield (os.path.relpath(path, source), fh.read())
+    else:
+        try:
+            with zipfile.ZipFile(source) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _is_epas_file(info.filename) and not info.filename.startswith('__MACOSX/'):
+                        yield (info.filename, archive.read(info))
+        except zipfile.BadZipFile:
+            raise ReportingError("Source is not a directory or a valid ZIP archive")
+
+
+def count_epas_files(source):
+    """ Number of EPAS exports in a directory or in a ZIP archive (without reading them)
+    """
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        return sum([len([f for f in files if _is_epas_file(f)]) for root, dirs, files in os.walk(source)])
+    try:
+        with zipfile.ZipFile(source) as archive:
+            return len([info for info in archive.infolist() if not info.is_dir() and _is_epas_file(info.filename) and not info.filename.startswith('__MACOSX/')])
+    except zipfile.BadZipFile:
+        raise ReportingError("Source is not a directory or a valid ZIP archive")
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+
+def ingest_workers():
+    """ Number of processes parsing the files in a web request
+    """
+    return getattr(settings, 'PRESENCE_INGEST_WORKERS', 1)
+
+
+def ingest_job_workers():
+    """ Number of processes parsing the files in a background job
+    """
+    return getattr(settings, 'PRESENCE_INGEST_JOB_WORKERS', 2)
+
+
+def ingest_inline(source):
+    """ Check if the archive has few enough files to be ingested in a web request
+    """
+    return count_epas_files(source) <= getattr(settings, 'PRESENCE_INGEST_INLINE_MAX', 20)
+
+
+def parse_epas_file(name, data):
+    """ Parse the presences of all the researchers in an EPAS export (executed in the process pool)
+    Return a dictionary researcher name -> presences (as returned by EpasFile.parse)
+    """
+    epas = EpasFile(data, name)
+    try:
+        if epas.is_old_format():
+            raise ReportingError("Files in the old format cannot be mapped to researchers")
+        names = []
+        for n in epas.sheet_names:
+            m = EPAS_SHEET_RE.match(n)
+            if m is not None:
+                rname = ConvertApostrophe2Accent(str(m.groups()[0]))
+                if rname not in names:
+                    names.append(rname)
+        return {rname: epas.parse(rname, max_workers=1) for rname in names}
+    finally:
+        epas.close()
+
+
+def _parse_epas_files(source, max_workers):
+    # Yield tuples (name, presences or exception), parsing in this process when max_workers is 1
+    if max_workers == 1:
+        for name, data in iter_epas_files(source):
+            try:
+                yield (name, parse_epas_file(name, data))
+            except Exception as e:
+                yield (name, e)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(parse_epas_file, name, data): name for name, data in iter_epas_files(source)}
+        for future in as_completed(futures):
+            try:
+                yield (futures[future], future.result())
+            except Exception as e:
+                yield (futures[future], e)
+
+
+def ingest_presences(source, max_workers=None):
+    """ Ingest the EPAS exports in a directory or in a ZIP archive (max_workers: processes parsing the files,
+    default: number of CPUs, 1 to parse in this process)
+    Return a dictionary with:
+     - researchers: list of import reports (see import_presences) with also researcher name, pk and files
+     - unknown: dictionary name -> files, for names not matching any researcher
+     - errors: list of tuples (file, message) for files that could not be parsed
+    """
+    researchers = {f"{r.surname} {r.name}".casefold(): r for r in Researcher.objects.all()}
+
+    frames = {}
+    files = {}
+    unknown = {}
+    errors = []
+    for name, parsed in _parse_epas_files(source, max_workers):
+        if isinstance(parsed, Exception):
+            errors.append((name, str(parsed)))
+            continue
+        if not len(parsed):
+            errors.append((name, "No EPAS sheets found"))
+        for rname, presences in parsed.items():
+            r = researchers.get(rname.casefold())
+            if r is None:
+                unknown.setdefault(rname, []).append(name)
+                continue
+            files.setdefault(r.pk, []).append(name)
+            for year, v1 in presences.items():
+                for month, df in v1.items():
+                    frames.setdefault(r.pk, []).append(df)
+
+    out = {'researchers': [], 'unknown': {k: sorted(v) for k, v in unknown.items()}, 'errors': sorted(errors)}
+    by_pk = {r.pk: r for r in researchers.values()}
+    for pk in sorted(frames.keys(), key=lambda k: str(by_pk[k])):
+        # The same days may be in more files (i.e. overlapping exports)
+        data = pd.concat(frames[pk], ignore_index=True).drop_duplicates()
+        report = import_presences(by_pk[pk], data)
+        report['researcher'] = str(by_pk[pk])
+        report['pk'] = pk
+        report['files'] = sorted(files[pk])
+        out['researchers'].append(report)
+    return out
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from Reporting.allocation import allocate_timesheets
+from Reporting.utils import ReportingError
+
+
+class Command(BaseCommand):
+    help = 'Automatically allocate the reported hours on the timesheets of a year'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--researcher', type=int, action='append', help='Researcher ID (can be repeated, default all researchers with reported work)')
+        parser.add_argument('--month', type=int, action='append', help='Month (can be repeated, default all months)')
+        parser.add_argument('--max-daily', type=float, default=None, help='Maximum hours allocated in a single day')
+        parser.add_argument('--force', action='store_true', help='Allocate also months with consistent timesheets')
+        parser.add_argument('--dry-run', action='store_true', help='Do not save the allocated timesheets')
+
+    def handle(self, *args, **options):
+        out = allocate_timesheets(
+            options['year'],
+            rids=options['researcher'],
+            months=options['month'],
+            max_daily=options['max_daily'],
+            force=options['force'],
+            save=not options['dry_run'],
+        )
+
+        errors = 0
+        for rid, months in out.items():
+            for month, result in months.items():
+                if isinstance(result, ReportingError):
+                    errors += 1
+                    self.stderr.write(str(result))
+                else:
+                    self.stdout.write("RID {0!s}: allocated {1:d}/{2:d}".format(rid, month, options['year']))
+
+        self.stdout.write("Allocated {0:d} months, {1:d} errors".format(sum([len(v) for v in out.values()]) - errors, errors))
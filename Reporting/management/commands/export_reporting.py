@@ -0,0 +1,38 @@
+import shutil
+from django.core.management.base import BaseCommand, CommandError
+from Reporting.exports import EXPORTS, iter_export_rows, iter_csv, write_xlsx
+
+
+class Command(BaseCommand):
+    help = 'Export presences, reported work, reported missions or timesheet hours as CSV or XLSX'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS.keys()), help='Data to export')
+        parser.add_argument('output', help='Output file (format from the extension, .csv or .xlsx)')
+        parser.add_argument('--researcher', type=int, default=None, help='Export only the data of the researcher with the given ID')
+        parser.add_argument('--project', type=int, default=None, help='Export only the data of the project with the given ID')
+        parser.add_argument('--year', type=int, default=None, help='Export only the data of the given year')
+
+    def handle(self, *args, **options):
+        if options['project'] is not None and EXPORTS[options['export']].project is None:
+            raise CommandError("Filter by project is not available for this export")
+
+        rows = iter_export_rows(options['export'], researcher=options['researcher'], project=options['project'], year=options['year'])
+        n = 0
+
+        def count(rows):
+            nonlocal n
+            for row in rows:
+                n += 1
+                yield row
+
+        if options['output'].lower().endswith('.xlsx'):
+            with write_xlsx(count(rows), options['export']) as src, open(options['output'], 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        elif options['output'].lower().endswith('.csv'):
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                for line in iter_csv(count(rows)):
+                    f.write(line)
+        else:
+            raise CommandError("Output file should be a .csv or .xlsx file")
+        self.stdout.write("Exported {0:d} rows".format(max(n - 1, 0)))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from Reporting.ingest import ingest_presences
+from Reporting.utils import ReportingError
+
+
+class Command(BaseCommand):
+    help = 'Import the presences of many researchers from a directory or a ZIP archive of EPAS exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory or ZIP archive')
+        parser.add_argument('--jobs', type=int, default=None, help='Number of parallel processes (default: number of CPUs)')
+
+    def handle(self, *args, **options):
+        try:
+            out = ingest_presences(options['source'], max_workers=options['jobs'])
+        except ReportingError as e:
+            raise CommandError(str(e))
+
+        for r in out['researchers']:
+            self.stdout.write("{0:s}: {1:d} new, {2:d} updated, {3:d} unchanged, {4:d} rejected ({5:s})".format(r['researcher'], r['created'], r['updated'], r['unchanged'], len(r['rejected']), ", ".join(r['files'])))
+            for row in r['rejected']:
+                self.stderr.write("  Rejected {0:s}: {1:s}".format(row['date'], row['reason']))
+            if len(r['missing_codes']):
+                self.stderr.write("  Unknown codes: {0:s}".format(", ".join(r['missing_codes'])))
+
+        for name, files in sorted(out['unknown'].items()):
+            self.stderr.write("Unknown researcher '{0:s}' in {1:s}".format(name, ", ".join(files)))
+        for name, message in out['errors']:
+            self.stderr.write("Failed to parse {0:s}: {1:s}".format(name, message))
+
+        self.stdout.write("Imported {0:d} researchers, {1:d} unknown, {2:d} errors".format(len(out['researchers']), len(out['unknown']), len(out['errors'])))
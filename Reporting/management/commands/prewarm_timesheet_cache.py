@@ -0,0 +1,39 @@
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from Projects.models import Researcher
+from Reporting.pdfcache import render_month
+from Reporting.timesheets import GetTimesheetStatus, GetTimesheetPrintContext
+from Reporting.utils import ReportingError
+
+
+class Command(BaseCommand):
+    help = 'Render in the PDF cache the timesheets of the closed months (consistent and before the current month)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int, nargs='+')
+        parser.add_argument('--jobs', type=int, default=None, help='Number of rendering processes (default: number of CPUs)')
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+
+        contextes = []
+        for year in options['year']:
+            status = GetTimesheetStatus(year)
+            researchers = Researcher.objects.in_bulk(list(status.keys()))
+            for rid, months in status.items():
+                # Closed months with something to report
+                closed = [m for m, (ok, reported, projects) in months.items() if ok and reported and (year, m) < (today.year, today.month)]
+                if not len(closed):
+                    continue
+                try:
+                    contextes += GetTimesheetPrintContext(researchers[rid], year, sorted(closed))[1]
+                except ReportingError as e:
+                    self.stderr.write("{0!s} {1:d}: {2!s}".format(researchers[rid], year, e))
+
+        with ProcessPoolExecutor(max_workers=options['jobs']) as pool:
+            for _ in pool.map(render_month, contextes):
+                pass
+
+        self.stdout.write("Rendered {0:d} months".format(len(contextes)))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from Reporting.models import ReportingPeriod
+from Reporting.batchprint import timesheet_print_jobs, iter_timesheets_zip
+
+
+class Command(BaseCommand):
+    help = 'Print all the timesheets of a year or of a reporting period in a ZIP archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Output ZIP file')
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument('--year', type=int, help='Print the timesheets of all researchers for the year')
+        group.add_argument('--period', type=int, help='Print the timesheets of the project for the reporting period with the given ID')
+        parser.add_argument('--jobs', type=int, default=None, help='Number of rendering processes (default: number of CPUs)')
+
+    def handle(self, *args, **options):
+        if options['period'] is not None:
+            try:
+                period = ReportingPeriod.objects.get(pk=options['period'])
+            except ReportingPeriod.DoesNotExist:
+                raise CommandError("Reporting period {0:d} does not exist".format(options['period']))
+            jobs = timesheet_print_jobs(period=period)
+        else:
+            jobs = timesheet_print_jobs(year=options['year'])
+
+        if not len(jobs):
+            raise CommandError("Nothing to report")
+
+        errors = []
+        with open(options['output'], 'wb') as f:
+            for chunk in iter_timesheets_zip(jobs, options['jobs'], errors):
+                f.write(chunk)
+
+        for filename, msg in errors:
+            self.stderr.write(msg)
+        self.stdout.write("Printed {0:d} timesheets, {1:d} errors".format(len(jobs) - len(errors), len(errors)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from Reporting.summary import rebuild_reporting_summary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild from scratch the summary of reporting data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append', help='Rebuild only the given year (can be repeated)')
+
+    def handle(self, *args, **options):
+        # Without years, all years with data are rebuilt (and stale years are removed)
+        for year, lines in rebuild_reporting_summary(options['year'] or None).items():
+            self.stdout.write("Updated reporting summary for year {0:d}: {1:d} rows".format(year, lines))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from Reporting.models import TimesheetStatus
+from Reporting.timesheets import TimesheetYears, UpdateTimesheetStatus
+
+
+class Command(BaseCommand):
+    help = 'Rebuild from scratch the table with the status of timesheets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, action='append', help='Rebuild only the given year (can be repeated)')
+
+    def handle(self, *args, **options):
+        years = options['year']
+        if not years:
+            # All years with reported work or missions
+            years = TimesheetYears()
+            # Remove also stale years
+            TimesheetStatus.objects.exclude(year__in=years).delete()
+
+        for year in sorted(years):
+            UpdateTimesheetStatus(year)
+            self.stdout.write("Updated timesheet status for year {0:d}: {1:d} rows".format(year, TimesheetStatus.objects.filter(year=year).count()))
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Projects', '0001_squashed_0015_conflictofinterest_end_date'),
+        ('Reporting', '0001_squashed_0010_alter_bankholiday_options_alter_epascode_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimesheetStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('reported_hours', models.FloatField(default=0.0)),
+                ('ts_hours', models.FloatField(default=0.0)),
+                ('presence_hours', models.FloatField(default=0.0)),
+                ('ok', models.BooleanField(default=False)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timesheet_status', to='Projects.project')),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timesheet_status', to='Projects.researcher')),
+            ],
+            options={
+                'ordering': ['researcher', 'year', 'month'],
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['year', 'month'], name='Reporting_t_year_76e0e1_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='timesheetstatus',
+            constraint=models.UniqueConstraint(fields=('researcher', 'year', 'month', 'project'), name='reporting_timesheetstatus_unique'),
+        ),
+    ]
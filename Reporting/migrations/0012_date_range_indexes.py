@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Reporting', '0011_timesheetstatus'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reportedwork',
+            index=models.Index(fields=['researcher', 'year', 'month'], name='Reporting_r_researc_542673_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='timesheethours',
+            index=models.Index(fields=['report', 'day'], name='Reporting_t_report__d66313_idx'),
+        ),
+    ]
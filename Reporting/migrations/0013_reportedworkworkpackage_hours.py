@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:58
+
+from django.db import migrations, models
+
+
+def compute_workpackages_hours(apps, schema_editor):
+    ReportedWorkWorkpackage = apps.get_model('Reporting', 'ReportedWorkWorkpackage')
+    wps_by_report = {}
+    for wp in ReportedWorkWorkpackage.objects.select_related('report').order_by('workpackage__name'):
+        wps_by_report.setdefault(wp.report_id, []).append(wp)
+    for wps in wps_by_report.values():
+        total = sum([wp.fraction for wp in wps])
+        for wp in wps:
+            wp.hours = (wp.fraction / total) * wp.report.hours if total != 0 else 0.0
+    ReportedWorkWorkpackage.objects.bulk_update([wp for wps in wps_by_report.values() for wp in wps], ['hours'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Reporting', '0012_date_range_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportedworkworkpackage',
+            name='hours',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.RunPython(compute_workpackages_hours, migrations.RunPython.noop),
+    ]
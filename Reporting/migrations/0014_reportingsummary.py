@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import ExtractYear, ExtractMonth
+
+
+def mark_reporting_summary(apps, schema_editor):
+    # Mark all the researcher-months with data, the summary is computed when first read (or with rebuild_reporting_summary)
+    PresenceData = apps.get_model('Reporting', 'PresenceData')
+    ReportedWork = apps.get_model('Reporting', 'ReportedWork')
+    ReportedMission = apps.get_model('Reporting', 'ReportedMission')
+    TimesheetHours = apps.get_model('Reporting', 'TimesheetHours')
+    ReportingSummaryPending = apps.get_model('Reporting', 'ReportingSummaryPending')
+
+    def keys(qs, researcher, day):
+        return set(qs.annotate(y=ExtractYear(day), m=ExtractMonth(day)).order_by().values_list(researcher, 'y', 'm').distinct())
+
+    pending = set(ReportedWork.objects.order_by().values_list('researcher', 'year', 'month').distinct())
+    pending |= keys(PresenceData.objects, 'researcher', 'day')
+    pending |= keys(ReportedMission.objects, 'day__researcher', 'day__day')
+    pending |= keys(TimesheetHours.objects, 'report__researcher', 'day')
+    ReportingSummaryPending.objects.bulk_create([
+        ReportingSummaryPending(researcher_id=r, year=y, month=m) for r, y, m in pending
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Projects', '0001_squashed_0015_conflictofinterest_end_date'),
+        ('Reporting', '0013_reportedworkworkpackage_hours'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportingSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('worked_hours', models.FloatField(default=0.0)),
+                ('usable_hours', models.FloatField(default=0.0)),
+                ('half_days', models.IntegerField(default=0)),
+                ('epas_missions', models.IntegerField(default=0)),
+                ('reported_hours', models.FloatField(default=0.0)),
+                ('missions', models.IntegerField(default=0)),
+                ('mission_hours', models.FloatField(default=0.0)),
+                ('ts_hours', models.FloatField(default=0.0)),
+                ('period', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reporting_summary', to='Reporting.reportingperiod')),
+                ('project', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reporting_summary', to='Projects.project')),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reporting_summary', to='Projects.researcher')),
+                ('workpackage', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reporting_summary', to='Projects.workpackage')),
+            ],
+            options={
+                'ordering': ['researcher', 'year', 'month'],
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['researcher', 'year', 'month'], name='Reporting_r_researc_c53dc9_idx'), models.Index(fields=['project', 'year', 'month'], name='Reporting_r_project_39887b_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ReportingSummaryPending',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('month', models.IntegerField()),
+                ('researcher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reporting_summary_pending', to='Projects.researcher')),
+            ],
+            options={
+                'default_permissions': (),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='reportingsummarypending',
+            constraint=models.UniqueConstraint(fields=('researcher', 'year', 'month'), name='reporting_reportingsummarypending_unique'),
+        ),
+        migrations.RunPython(mark_reporting_summary, migrations.RunPython.noop),
+    ]
@@ -8,6 +8,98 @@ from Projects import models as PrjModels
 # Financial reporting models
 # ==========================
 
+class DateRangeQuerySet(models.QuerySet):
+    """ QuerySet with filters on months, years and reporting periods. Filters are expressed as half-open
+    ranges on the date field (instead of filters on ExtractYear/ExtractMonth annotations) so that the
+    indexes on the date can be used.
+    """
+    # Date field (may span relations)
+    date_field = 'day'
+
+    def for_dates(self, start, end):
+        """ Filter dates in the range [start, end)
+        """
+        return self.filter(**{
+            f"{self.date_field}__gte": start,
+            f"{self.date_field}__lt": end,
+        })
+
+    def for_month(self, year, month):
+        start = datetime.date(year, month, 1)
+        return self.for_dates(start, start + datetime.timedelta(days=calendar.monthrange(year, month)[1]))
+
+    def for_year(self, year, months=None):
+        """ Filter a year, optionally only some months of it (consecutive months are merged in a single range)
+        """
+        if months is None:
+            return self.for_dates(datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1))
+
+        months = sorted(set(months))
+        if not len(months):
+            return self.none()
+        ranges = []
+        for m in months:
+            if len(ranges) and ranges[-1][1] == m - 1:
+                ranges[-1][1] = m
+            else:
+                ranges.append([m, m])
+        q = models.Q()
+        for first, last in ranges:
+            end = datetime.date(year, last, 1) + datetime.timedelta(days=calendar.monthrange(year, last)[1])
+            q |= models.Q(**{
+                f"{self.date_field}__gte": datetime.date(year, first, 1),
+                f"{self.date_field}__lt": end,
+            })
+        return self.filter(q)
+
+    def for_period(self, period):
+        """ Filter the days of a reporting period (ends included)
+        """
+        return self.for_dates(period.rp_start, period.rp_end + datetime.timedelta(days=1))
+
+
+class MissionQuerySet(DateRangeQuerySet):
+    date_field = 'day__day'
+
+
+class ReportingSummaryQuerySet(models.QuerySet):
+    """ QuerySet of the reporting summary, with filters on months and periods and roll-ups on dimensions
+    """
+    DIMENSIONS = ('researcher', 'project', 'period', 'workpackage', 'year', 'month')
+    MEASURES = ('worked_hours', 'usable_hours', 'half_days', 'epas_missions', 'reported_hours', 'missions', 'mission_hours', 'ts_hours')
+
+    def for_year(self, year, months=None):
+        qs = self.filter(year=year)
+        if months is not None:
+            qs = qs.filter(month__in=months)
+        return qs
+
+    def for_period(self, period):
+        """ Filter the months of a reporting period (also the presences, that are not bound to a period)
+        """
+        q = models.Q()
+        for year in range(period.rp_start.year, period.rp_end.year + 1):
+            first = period.rp_start.month if year == period.rp_start.year else 1
+            last = period.rp_end.month if year == period.rp_end.year else 12
+            q |= models.Q(year=year, month__gte=first, month__lte=last)
+        return self.filter(q)
+
+    def rollup(self, *dimensions, measures=None):
+        """ Sum the measures grouping by the given dimensions
+        Return a values() queryset ordered by the dimensions
+        """
+        for d in dimensions:
+            if d.split('__')[0] not in self.DIMENSIONS:
+                raise ValueError(f"Unknown dimension '{d}'")
+        measures = self.MEASURES if measures is None else measures
+        return (
+            self
+            .order_by(*dimensions)
+            .values(*dimensions)
+            .annotate(**{m: models.Sum(m) for m in measures})
+        )
+
+
 class BankHoliday(models.Model):
     """ List of bank holidays
     """
@@ -111,6 +203,8 @@ class PresenceData(models.Model):
     # Absence code for ts
     ts_code = models.CharField(max_length=2, choices=EpasCode.CHOICES, default=EpasCode.NONE)
 
+    objects = DateRangeQuerySet.as_manager()
+
     def __str__(self):
         if self.code is None or self.code.ts_code == EpasCode.NONE:
             return "{0!s} on {1!s} worked for {2:.1f} hours".format(self.researcher, self.day, self.hours)
@@ -194,6 +288,9 @@ class ReportedWork(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['period', 'researcher', 'year', 'month'], name="%(app_label)s_%(class)s_unique"),
         ]
+        indexes = [
+            models.Index(fields=['researcher', 'year', 'month']),
+        ]
         default_permissions = ()
         permissions = [
             ('rp_work_view', 'View reported work'),
@@ -218,6 +315,8 @@ class ReportedMission(models.Model):
     # Mission day
     day = models.ForeignKey(PresenceData, on_delete=models.PROTECT, related_name='reported_missions')
 
+    objects = MissionQuerySet.as_manager()
+
     def __str__(self):
         return "Reported mission on {0:s} for {1!s}: {2!s}".format(self.period.project.name, self.day.researcher, self.day.day)
 
@@ -247,6 +346,8 @@ class ReportedWorkWorkpackage(models.Model):
     workpackage = models.ForeignKey(PrjModels.WorkPackage, on_delete=models.CASCADE, related_name='reported_work')
     fraction = models.FloatField()
     # NOTE: the fraction can be any number, even the actual hours. The hours of the period will be split normalizing at the sum
+    hours = models.FloatField(default=0.0)
+    # NOTE: hours of the report on the workpackage (normalized fraction), updated by signals with update_workpackages_hours()
 
     def __str__(self):
         return "Reported work on {0:s} for {1!s} period {2:d}/{3:d} splitted on {4:s}".format(self.report.period.project.name, self.report.researcher, self.report.month, self.report.year, self.workpackage.name)
@@ -272,6 +373,8 @@ class TimesheetHours(models.Model):
     day = models.DateField()
     hours = models.FloatField()
 
+    objects = DateRangeQuerySet.as_manager()
+
     def __str__(self):
         if self.report_wp is not None:
             return "Hours worked by {0!s} on {1:s}/{2:s}, day {3!s}, {4:.1f} hours".format(self.report.researcher, self.report.period.project.name, self.report_wp.workpackage.name, self.day, self.hours)
@@ -282,6 +385,9 @@ class TimesheetHours(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['report', 'report_wp', 'day'], name="%(app_label)s_%(class)s_unique"),
         ]
+        indexes = [
+            models.Index(fields=['report', 'day']),
+        ]
         default_permissions = ()
         permissions = [
             ('timesheet_view', 'View timesheets'),
@@ -289,3 +395,94 @@ class TimesheetHours(models.Model):
             ('timesheet_manage', 'Manage timesheets'),
             ('timesheet_manage_own', 'Manage own timesheets'),
         ]
+
+
+class TimesheetStatus(models.Model):
+    """ Materialized status of the timesheets of a researcher for each month and project
+        Maintained incrementally by the signals in signals.py (see also UpdateTimesheetStatus)
+    """
+    researcher = models.ForeignKey(PrjModels.Researcher, on_delete=models.CASCADE, related_name='timesheet_status')
+    year = models.IntegerField()
+    month = models.IntegerField()
+    project = models.ForeignKey(PrjModels.Project, on_delete=models.CASCADE, related_name='timesheet_status')
+    # Hours reported on the project
+    reported_hours = models.FloatField(default=0.0)
+    # Hours recorded on the timesheet for the project
+    ts_hours = models.FloatField(default=0.0)
+    # Hours worked in the month (from presences)
+    presence_hours = models.FloatField(default=0.0)
+    # True if timesheet hours are consistent with the reported work
+    ok = models.BooleanField(default=False)
+
+    def __str__(self):
+        return "Timesheet of {0!s} on {1:s} for {2:d}/{3:d}: {4:s}".format(self.researcher, self.project.name, self.month, self.year, "ok" if self.ok else "incomplete")
+
+    class Meta:
+        ordering = ["researcher", "year", "month"]
+        constraints = [
+            models.UniqueConstraint(fields=['researcher', 'year', 'month', 'project'], name="%(app_label)s_%(class)s_unique"),
+        ]
+        indexes = [
+            models.Index(fields=['year', 'month']),
+        ]
+        default_permissions = ()
+
+
+class ReportingSummary(models.Model):
+    """ Pre-aggregated reporting data by researcher, project, period, workpackage and month
+        Presences are stored on lines without project, period and workpackage. Reported work without a
+        split on workpackages, missions without workpackage and timesheet hours of projects without
+        workpackages are stored on lines without workpackage.
+        The researcher-months changed by the signals in signals.py are marked with ReportingSummaryPending
+        and refreshed before reading (see refresh_reporting_summary)
+    """
+    researcher = models.ForeignKey(PrjModels.Researcher, on_delete=models.CASCADE, related_name='reporting_summary')
+    project = models.ForeignKey(PrjModels.Project, on_delete=models.CASCADE, null=True, blank=True, related_name='reporting_summary')
+    period = models.ForeignKey(ReportingPeriod, on_delete=models.CASCADE, null=True, blank=True, related_name='reporting_summary')
+    workpackage = models.ForeignKey(PrjModels.WorkPackage, on_delete=models.CASCADE, null=True, blank=True, related_name='reporting_summary')
+    year = models.IntegerField()
+    month = models.IntegerField()
+    # Hours worked (from presences, days without absence codes)
+    worked_hours = models.FloatField(default=0.0)
+    # Hours usable for timesheets (at most 7.2 per day) and half days worked (3.6 hours each)
+    usable_hours = models.FloatField(default=0.0)
+    half_days = models.IntegerField(default=0)
+    # Days with a mission code (from presences)
+    epas_missions = models.IntegerField(default=0)
+    # Hours reported (split on workpackages)
+    reported_hours = models.FloatField(default=0.0)
+    # Reported missions (days and hours)
+    missions = models.IntegerField(default=0)
+    mission_hours = models.FloatField(default=0.0)
+    # Hours recorded on timesheets
+    ts_hours = models.FloatField(default=0.0)
+
+    objects = ReportingSummaryQuerySet.as_manager()
+
+    def __str__(self):
+        return "Summary of {0!s} for {1:d}/{2:d}".format(self.researcher, self.month, self.year)
+
+    class Meta:
+        ordering = ["researcher", "year", "month"]
+        indexes = [
+            models.Index(fields=['researcher', 'year', 'month']),
+            models.Index(fields=['project', 'year', 'month']),
+        ]
+        default_permissions = ()
+
+
+class ReportingSummaryPending(models.Model):
+    """ Researcher-months whose lines of the reporting summary must be refreshed
+    """
+    researcher = models.ForeignKey(PrjModels.Researcher, on_delete=models.CASCADE, related_name='reporting_summary_pending')
+    year = models.IntegerField()
+    month = models.IntegerField()
+
+    def __str__(self):
+        return "Pending summary of {0!s} for {1:d}/{2:d}".format(self.researcher, self.month, self.year)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['researcher', 'year', 'month'], name="%(app_label)s_%(class)s_unique"),
+        ]
+        default_permissions = ()
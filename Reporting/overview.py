@@ -0,0 +1,126 @@
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db.models import Count, Sum, F, Value
+from django.db.models.functions import Concat, Coalesce
+
+from .models import ReportingPeriod, ReportedWork, ReportedMission
+
+
+# Overview of reporting
+# =====================
+#
+# Work and missions reported in all the reporting periods, grouped by project and by researcher. The
+# overview is built with three queries (periods, work and missions aggregated by period and researcher)
+# and merged in memory. The full overview is cached (with the Django cache, shared by all the processes)
+# and invalidated by the signals in signals.py; the filter for users that can see only their own data is
+# applied afterwards.
+
+CACHE_KEY = 'Reporting.overview'
+CACHE_TIMEOUT = 600
+
+
+def build_reporting_overview():
+    """ Build the overview of reporting
+    Return an OrderedDict project name -> {'project': {...}, 'periods': [...]}, where each period is a
+    dictionary {'rp': {...}, 'researchers': OrderedDict name -> {'name', 'rid', 'hours', 'missions', 'mission_hours'}}
+    """
+    periods = list(
+        ReportingPeriod.objects
+        .select_related('project__pi')
+        .order_by('project__name', 'rp_start')
+    )
+
+    work = (
+        ReportedWork.objects
+        .order_by('period', 'researcher')
+        .values('period', 'researcher')
+        .annotate(
+            fullname=Concat(F('researcher__name'), Value(' '), F('researcher__surname')),
+            total=Sum('hours'),
+        )
+    )
+    researchers = {}
+    for w in work:
+        researchers.setdefault(w['period'], OrderedDict())[w['fullname']] = {
+            'name': w['fullname'],
+            'rid': w['researcher'],
+            'hours': w['total'],
+            'missions': 0,
+            'mission_hours': 0.0,
+        }
+
+    missions = (
+        ReportedMission.objects
+        .order_by('period', 'day__researcher')
+        .values('period', 'day__researcher')
+        .annotate(
+            fullname=Concat(F('day__researcher__name'), Value(' '), F('day__researcher__surname')),
+            missions=Count('day'),
+            mission_hours=Coalesce(Sum('day__hours'), Value(0.0)),
+        )
+    )
+    for m in missions:
+        line = researchers.setdefault(m['period'], OrderedDict()).setdefault(m['fullname'], {
+            'name': m['fullname'],
+            'rid': m['day__researcher'],
+            'hours': 0.0,
+            'missions': 0,
+            'mission_hours': 0.0,
+        })
+        line['missions'] = m['missions']
+        line['mission_hours'] = m['mission_hours']
+
+    projects = OrderedDict()
+    for rp in periods:
+        project = rp.project
+        if project.name not in projects:
+            projects[project.name] = {
+                'project': {
+                    'pk': project.pk,
+                    'name': project.name,
+                    'pi': project.pi_id,
+                    'pi_user': project.pi.username_id if project.pi is not None else None,
+                },
+                'periods': [],
+            }
+        projects[project.name]['periods'].append({
+            'rp': {
+                'pk': rp.pk,
+                'rp_start': rp.rp_start,
+                'rp_end': rp.rp_end,
+            },
+            'researchers': researchers.get(rp.pk, OrderedDict()),
+        })
+    return projects
+
+
+def get_reporting_overview():
+    """ Overview of reporting from the cache (built if needed)
+    """
+    projects = cache.get(CACHE_KEY)
+    if projects is None:
+        projects = build_reporting_overview()
+        cache.set(CACHE_KEY, projects, CACHE_TIMEOUT)
+    return projects
+
+
+def invalidate_reporting_overview():
+    cache.delete(CACHE_KEY)
+
+
+def filter_reporting_overview(projects, user, rid):
+    """ Restrict the overview to the researcher rid, except for the projects where the user is the PI
+    Periods without data for the researcher and projects left without periods are removed
+    """
+    out = OrderedDict()
+    for name, p in projects.items():
+        is_own = (p['project']['pi_user'] is not None and p['project']['pi_user'] == user.pk)
+        periods = []
+        for period in p['periods']:
+            researchers = OrderedDict([(k, v) for k, v in period['researchers'].items() if is_own or v['rid'] == rid])
+            if len(researchers):
+                periods.append({'rp': period['rp'], 'researchers': researchers})
+        if len(periods):
+            out[name] = {'project': p['project'], 'periods': periods}
+    return out
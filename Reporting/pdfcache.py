@@ -0,0 +1,165 @@
+import io
+import os
+import json
+import hashlib
+import tempfile
+
+from django.conf import settings
+from pypdf import PdfReader, PdfWriter
+
+from .print import PrintPFDTimesheet
+
+
+# Cache of rendered timesheets
+# ============================
+#
+# Each month is rendered as a separate PDF and stored on disk, addressed by the SHA256 digest of its
+# context (timesheet data, signatures, director, role, sign day, ...) and of the source of the renderer,
+# so that any change to the data or to the layout produces a new entry. Documents with more months are
+# assembled from the cached months. When the cache exceeds its maximum size the least recently used
+# entries are removed. The cache directory is not scanned on every write: each process keeps an estimate
+# of the size (from the last scan plus its own writes) and scans again only when the estimate exceeds the
+# maximum size or after EVICT_INTERVAL writes (to account for the writes of the other processes).
+#
+# Settings:
+#  - TIMESHEET_PDF_CACHE_DIR: cache directory (default: BASE_DIR/cache/timesheets)
+#  - TIMESHEET_PDF_CACHE_SIZE: maximum size of the cache in bytes (default: 512 MB)
+
+EVICT_INTERVAL = 256
+
+# Estimated size and writes since the last scan, by cache directory
+_usage = {}
+
+def _renderer_digest():
+    # Digest of the renderer source, to invalidate the cache when the layout changes
+    from . import print as renderer
+    with open(renderer.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class TimesheetPDFCache(object):
+    """ Content-addressed disk cache of the PDF of single months
+    """
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = getattr(settings, 'TIMESHEET_PDF_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'timesheets'))
+        if max_size is None:
+            max_size = getattr(settings, 'TIMESHEET_PDF_CACHE_SIZE', 512 * 1024 * 1024)
+        self.root = str(path)
+        self.max_size = max_size
+        self.renderer = _renderer_digest()
+
+    def key(self, context):
+        """ Stable digest of a month context
+        """
+        data = json.dumps(context, sort_keys=True, default=str, separators=(',', ':'))
+        return hashlib.sha256((self.renderer + data).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + ".pdf")
+
+    def get(self, key):
+        """ Return the cached PDF or None
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Update access time for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """ Store a PDF (atomically, as the cache can be shared by many processes)
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+        usage = _usage.get(self.root)
+        if usage is None or usage[1] >= EVICT_INTERVAL or usage[0] + len(data) > self.max_size:
+            self.evict()
+        else:
+            usage[0] += len(data)
+            usage[1] += 1
+
+    def evict(self):
+        """ Remove the least recently used entries if the cache is too large
+        """
+        entries = []
+        total = 0
+        for d in os.scandir(self.root):
+            if not d.is_dir():
+                continue
+            for f in os.scandir(d.path):
+                if f.name.endswith('.pdf'):
+                    st = f.stat()
+                    entries.append((st.st_mtime, st.st_size, f.path))
+                    total += st.st_size
+        _usage[self.root] = [total, 0]
+        if total <= self.max_size:
+            return
+
+        # Remove oldest entries down to 90% of maximum size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        _usage[self.root] = [total, 0]
+
+    def render(self, context):
+        """ Return the PDF of a single month, from the cache if available
+        """
+        key = self.key(context)
+        data = self.get(key)
+        if data is None:
+            data = PrintPFDTimesheet([context, ]).getvalue()
+            self.put(key, data)
+        return data
+
+
+def PrintCachedPDFTimesheet(contextes, cache=None):
+    """ Same as PrintPFDTimesheet, but the months are rendered through the cache and then merged
+    """
+    if cache is None:
+        cache = TimesheetPDFCache()
+
+    months = [cache.render(context) for context in contextes]
+    if len(months) == 1:
+        return io.BytesIO(months[0])
+
+    # Merge months
+    writer = PdfWriter()
+    for data in months:
+        writer.append(PdfReader(io.BytesIO(data)))
+    # Fonts and images are embedded in every month, drop duplicates
+    writer.compress_identical_objects()
+    writer.add_metadata({'/Title': f"H2020 TimeSheets for {contextes[0]['researcher']}"})
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def render_month(context):
+    """ Render a single month in the cache (to be used in a process pool)
+    """
+    TimesheetPDFCache().render(context)
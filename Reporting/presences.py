@@ -0,0 +1,111 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+from django.db import transaction
+
+from .models import EpasCode, PresenceData
+from .timesheets import status_tracker
+from .overview import invalidate_reporting_overview
+
+
+# Import of presence data
+# =======================
+#
+# The presences parsed from the EPAS files are validated and compared with the data already stored for
+# the same dates with a single query, then the new and modified days are written with a bulk upsert on
+# (researcher, day) in a single transaction. Invalid rows are rejected and returned in the report.
+
+def import_presences(researcher, data):
+    """ Store the presences of a researcher
+     - data: DataFrame with columns Date, Hours and Code (as the months returned by EpasFile.parse)
+    Existing days are updated only if hours or code changed. Unknown codes are stored as no code (as
+    before) and listed in the report. The TS code of existing days is changed only if the code changed.
+    Return a dictionary with the number of created, updated and unchanged days, the list of rejected rows
+    (dictionaries with date, hours, code and reason) and the list of unknown codes
+    """
+    report = {'created': 0, 'updated': 0, 'unchanged': 0, 'rejected': [], 'missing_codes': []}
+    if not len(data):
+        return report
+
+    df = pd.DataFrame({
+        'Date': pd.to_datetime(data['Date'], errors='coerce'),
+        'Hours': pd.to_numeric(data['Hours'], errors='coerce'),
+        'Code': data['Code'].fillna("").astype(str).str.strip(),
+    })
+
+    # Validation
+    reason = pd.Series("", index=df.index, dtype=object)
+    reason[~((df['Hours'] >= 0) & (df['Hours'] <= 24))] = "Invalid hours"
+    reason[df['Date'].isna()] = "Invalid date"
+    reason[(reason == "") & df['Date'].duplicated(keep=False)] = "Duplicated date"
+    rejected = (reason != "").values
+    for i in np.nonzero(rejected)[0]:
+        row = data.iloc[i]
+        report['rejected'].append({
+            'date': str(row['Date']),
+            'hours': row['Hours'],
+            'code': row['Code'],
+            'reason': reason.iloc[i],
+        })
+    df = df[~rejected]
+    if not len(df):
+        return report
+    df['day'] = df['Date'].dt.date
+
+    # EPAS codes
+    codes = pd.DataFrame(list(EpasCode.objects.order_by().values_list('code', 'pk', 'ts_code')), columns=['Code', 'code_id', 'code_ts'])
+    df = df.merge(codes, on='Code', how='left')
+    report['missing_codes'] = sorted(set(df.loc[df['code_id'].isna() & (df['Code'] != ""), 'Code']))
+
+    # Existing data in the date range
+    existing = (
+        PresenceData.objects
+        .filter(researcher=researcher)
+        .for_dates(df['day'].min(), df['day'].max() + datetime.timedelta(days=1))
+        .order_by()
+        .values_list('day', 'hours', 'code', 'ts_code')
+    )
+    existing = pd.DataFrame(list(existing), columns=['day', 'old_hours', 'old_code', 'old_ts'])
+    df = df.merge(existing, on='day', how='left', indicator=True)
+
+    new = (df['_merge'] == 'left_only').values
+    code_changed = (df['code_id'].fillna(-1) != df['old_code'].fillna(-1)).values
+    hours_changed = (df['Hours'] != df['old_hours']).values
+    changed = new | code_changed | hours_changed
+
+    # TS code from the new code, if it has one
+    has_ts = (df['code_id'].notna() & df['code_ts'].fillna(EpasCode.NONE).ne(EpasCode.NONE)).values
+    ts_code = np.where(has_ts & (new | code_changed), df['code_ts'].fillna(EpasCode.NONE), df['old_ts'].fillna(EpasCode.NONE))
+
+    report['created'] = int(new.sum())
+    report['updated'] = int((changed & ~new).sum())
+    report['unchanged'] = int((~changed).sum())
+
+    objs = [
+        PresenceData(
+            researcher=researcher,
+            day=day,
+            hours=float(hours),
+            code_id=int(code) if not pd.isna(code) else None,
+            ts_code=ts,
+        )
+        for day, hours, code, ts in zip(df['day'][changed], df['Hours'][changed], df['code_id'][changed], ts_code[changed])
+    ]
+    if not len(objs):
+        return report
+
+    with transaction.atomic():
+        PresenceData.objects.bulk_create(
+            objs,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['researcher', 'day'],
+            update_fields=['hours', 'code', 'ts_code'],
+        )
+        # Bulk operations do not send signals
+        for year, month in set([(o.day.year, o.day.month) for o in objs]):
+            status_tracker.mark(researcher.pk, year, month)
+        invalidate_reporting_overview()
+
+    return report
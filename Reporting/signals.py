@@ -0,0 +1,105 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from Accounting.models import GAE, VoceSpesa, Impegno, Mandato
+from Accounting.signals import funds_updated
+from Projects.models import Project, Researcher, ResearcherRole, WorkPackage
+from .models import BankHoliday, PersonnelCost, PresenceData, ReportingPeriod, ReportedWork, ReportedWorkWorkpackage, ReportedMission, TimesheetHours
+from .timesheets import status_tracker
+from .workcalendar import invalidate_calendar
+from .costs import invalidate_cost_matrix
+from .overview import invalidate_reporting_overview
+from .statement import invalidate_statements
+from .utils import update_workpackages_hours
+
+
+@receiver([post_save, post_delete], sender=BankHoliday)
+def bankholiday_changed(sender, instance, **kwargs):
+    # Bank holidays changed, drop cached calendars (all of them, the year may have been changed too)
+    invalidate_calendar()
+
+
+@receiver([post_save, post_delete], sender=Project)
+@receiver([post_save, post_delete], sender=Researcher)
+@receiver([post_save, post_delete], sender=ReportingPeriod)
+@receiver([post_save, post_delete], sender=ReportedWork)
+@receiver([post_save, post_delete], sender=ReportedMission)
+@receiver([post_save, post_delete], sender=PresenceData)
+def reporting_changed(sender, instance, **kwargs):
+    # Reporting overview is cached (mission hours come from presences)
+    invalidate_reporting_overview()
+
+
+@receiver([post_save, post_delete], sender=PersonnelCost)
+@receiver([post_save, post_delete], sender=ResearcherRole)
+def costs_changed(sender, instance, **kwargs):
+    # Hourly rates depend on costs and on the first role of the researcher
+    invalidate_cost_matrix()
+    invalidate_statements()
+
+
+@receiver([post_save, post_delete], sender=Project)
+@receiver([post_save, post_delete], sender=Researcher)
+@receiver([post_save, post_delete], sender=WorkPackage)
+@receiver([post_save, post_delete], sender=ReportingPeriod)
+@receiver([post_save, post_delete], sender=ReportedWork)
+@receiver([post_save, post_delete], sender=ReportedWorkWorkpackage)
+@receiver([post_save, post_delete], sender=GAE)
+@receiver([post_save, post_delete], sender=VoceSpesa)
+@receiver([post_save, post_delete], sender=Impegno)
+@receiver([post_save, post_delete], sender=Mandato)
+def statement_changed(sender, instance, **kwargs):
+    # Statements are cached: change the cache version
+    invalidate_statements()
+
+
+@receiver(funds_updated)
+def funds_changed(sender, **kwargs):
+    # Accounting data written in bulk by updatefunds
+    invalidate_statements()
+
+
+@receiver(post_save, sender=ReportedWork)
+@receiver([post_save, post_delete], sender=ReportedWorkWorkpackage)
+def workpackages_changed(sender, instance, **kwargs):
+    # Hours or split changed: update the hours stored on the workpackages of the report
+    # NOTE: saving the hours with bulk_update() does not trigger this signal again
+    update_workpackages_hours([instance.pk if sender is ReportedWork else instance.report_id, ])
+
+
+# Timesheet status
+# ================
+#
+# Changes to reported work, timesheets, missions and presences mark the affected researcher-months,
+# that are refreshed once the transaction is committed.
+# NOTE: bulk operations (QuerySet.update(), bulk_create() and bulk_update()) do not send signals, so the
+# code using them should mark the changed researcher-months explicitly through status_tracker.
+
+@receiver(pre_save, sender=ReportedWork)
+def reportedwork_changing(sender, instance, **kwargs):
+    # Researcher, year or month may be changed: mark also the old researcher-month
+    if instance.pk is not None:
+        old = ReportedWork.objects.filter(pk=instance.pk).values_list('researcher', 'year', 'month').first()
+        if old is not None and old != (instance.researcher_id, instance.year, instance.month):
+            status_tracker.mark(*old)
+
+
+@receiver([post_save, post_delete], sender=ReportedWork)
+def reportedwork_changed(sender, instance, **kwargs):
+    status_tracker.mark(instance.researcher_id, instance.year, instance.month)
+
+
+@receiver([post_save, post_delete], sender=ReportedWorkWorkpackage)
+@receiver([post_save, post_delete], sender=TimesheetHours)
+def report_changed(sender, instance, **kwargs):
+    status_tracker.mark_report(instance.report_id)
+
+
+@receiver([post_save, post_delete], sender=ReportedMission)
+def reportedmission_changed(sender, instance, **kwargs):
+    status_tracker.mark_presence(instance.day_id)
+
+
+@receiver([post_save, post_delete], sender=PresenceData)
+def presence_changed(sender, instance, **kwargs):
+    status_tracker.mark(instance.researcher_id, instance.day.year, instance.day.month)
@@ -0,0 +1,139 @@
+import os
+import re
+import time
+import uuid
+import tempfile
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+
+from .utils import ReportingError
+
+
+# Staging of imported presences
+# =============================
+#
+# The presences parsed from EPAS files are staged on disk, in a compressed NumPy archive identified by a
+# random token, until the user confirms the import. Only the token is kept in the session. The archive
+# stores the columns of all the months concatenated, plus the list of (year, month, rows) to split them back.
+# Staged imports older than the expiry time are removed.
+#
+# Settings:
+#  - PRESENCE_STAGING_DIR: staging directory (default: BASE_DIR/cache/presences)
+#  - PRESENCE_STAGING_EXPIRY: expiry time in seconds (default: 1 day)
+
+TOKEN_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _staging_dir():
+    return str(getattr(settings, 'PRESENCE_STAGING_DIR', os.path.join(settings.BASE_DIR, 'cache', 'presences')))
+
+
+def _staging_expiry():
+    return getattr(settings, 'PRESENCE_STAGING_EXPIRY', 24 * 3600)
+
+
+def _staging_path(token):
+    if not isinstance(token, str) or TOKEN_RE.match(token) is None:
+        raise ReportingError("Invalid import token")
+    return os.path.join(_staging_dir(), token + ".npz")
+
+
+def stage_presences(presences, researcher):
+    """ Stage the presences of a researcher (as returned by EpasFile.parse)
+    Return the import token
+    """
+    cleanup_staged_presences()
+
+    keys_year = []
+    keys_month = []
+    counts = []
+    dates = []
+    hours = []
+    codes = []
+    for year, v1 in presences.items():
+        for month, v2 in v1.items():
+            keys_year.append(year)
+            keys_month.append(month)
+            counts.append(len(v2))
+            dates.append(pd.to_datetime(v2['Date']).to_numpy(dtype='datetime64[D]'))
+            hours.append(v2['Hours'].to_numpy(dtype=np.float64))
+            codes.append(v2['Code'].astype(str).to_numpy(dtype=str))
+
+    token = uuid.uuid4().hex
+    path = _staging_path(token)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(
+                f,
+                researcher=np.int64(researcher.pk),
+                keys_year=np.array(keys_year, dtype=np.int64),
+                keys_month=np.array(keys_month, dtype=str),
+                counts=np.array(counts, dtype=np.int64),
+                dates=np.concatenate(dates) if len(dates) else np.array([], dtype='datetime64[D]'),
+                hours=np.concatenate(hours) if len(hours) else np.array([], dtype=np.float64),
+                codes=np.concatenate(codes) if len(codes) else np.array([], dtype=str),
+            )
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return token
+
+
+def load_staged_presences(token):
+    """ Load staged presences
+    Return a tuple (researcher pk, presences) with presences in the same format returned by EpasFile.parse
+    Raise ReportingError if the token is not valid or the staged import has expired
+    """
+    path = _staging_path(token)
+    try:
+        if os.path.getmtime(path) < time.time() - _staging_expiry():
+            discard_staged_presences(token)
+            raise ReportingError("Staged import has expired")
+        with np.load(path, allow_pickle=False) as data:
+            researcher = int(data['researcher'])
+            keys = zip(data['keys_year'].tolist(), data['keys_month'].tolist(), data['counts'].tolist())
+            dates = data['dates']
+            hours = data['hours']
+            codes = data['codes']
+    except FileNotFoundError:
+        raise ReportingError("Staged import not found or expired")
+
+    presences = {}
+    i = 0
+    for year, month, n in keys:
+        presences.setdefault(year, {})[month] = pd.DataFrame({
+            'Date': pd.to_datetime(dates[i:i + n]),
+            'Hours': hours[i:i + n],
+            'Code': codes[i:i + n].astype(object),
+        })
+        i += n
+    return (researcher, presences)
+
+
+def discard_staged_presences(token):
+    """ Remove a staged import
+    """
+    try:
+        os.unlink(_staging_path(token))
+    except (FileNotFoundError, ReportingError):
+        pass
+
+
+def cleanup_staged_presences():
+    """ Remove the expired staged imports
+    """
+    root = _staging_dir()
+    if not os.path.isdir(root):
+        return
+    limit = time.time() - _staging_expiry()
+    for f in os.scandir(root):
+        try:
+            if f.stat().st_mtime < limit:
+                os.unlink(f.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,197 @@
+import io
+import uuid
+import datetime
+import numpy as np
+import pandas as pd
+
+from django.core.cache import cache
+from django.db.models import F
+
+from Accounting.models import Impegno, Mandato
+from .costs import get_cost_matrix, is_horizon_eu
+from .models import ReportedWork, ReportedWorkWorkpackage
+
+
+# Financial statement of a reporting period
+# =========================================
+#
+# The statement of a reporting period joins:
+#  - the personnel costs: hours reported on the period split by workpackage (stored hours of the split)
+#    priced with the hourly rates of the cost matrix (Horizon Europe rates for Horizon Europe projects)
+#  - the direct costs on the GAEs of the project by voce: the commitments originated in the years of the
+#    period (competence of the first year) and the payments (mandati) dated within the period.
+# Each part is loaded with a single query and aggregated with pandas. Statements are cached (with the
+# Django cache, shared by all the processes): the signals in signals.py change the cache version when any
+# of the inputs change, including the funds_updated signal sent by the updatefunds command.
+
+CACHE_KEY = 'Reporting.statement'
+CACHE_TIMEOUT = 3600
+
+PERSONNEL_COLUMNS = ['Researcher', 'Year', 'Month', 'Workpackage', 'Hours', 'Rate', 'Cost']
+DIRECT_COLUMNS = ['Voce', 'Description', 'Committed', 'Paid']
+
+
+class Statement(object):
+    """ Financial statement of a reporting period
+     - personnel: DataFrame with a line for each researcher, month and workpackage (empty for projects without WPs)
+     - direct: DataFrame with committed and paid amounts by voce
+     - missing_rates: list of (researcher, year) without an hourly rate (their cost is not included)
+    """
+
+    def __init__(self, period, personnel, direct, missing_rates):
+        self.period = {
+            'pk': period.pk,
+            'project': period.project.name,
+            'rp_start': period.rp_start,
+            'rp_end': period.rp_end,
+        }
+        self.personnel = personnel
+        self.direct = direct
+        self.missing_rates = missing_rates
+
+    def personnel_by(self, column):
+        """ Personnel hours and costs grouped by column (e.g. Researcher or Workpackage)
+        """
+        return self.personnel.groupby(column, sort=True)[['Hours', 'Cost']].sum(min_count=1).reset_index()
+
+    def summary(self):
+        personnel = float(np.nansum(self.personnel['Cost']))
+        committed = float(self.direct['Committed'].sum())
+        paid = float(self.direct['Paid'].sum())
+        return {
+            'hours': float(self.personnel['Hours'].sum()),
+            'personnel': personnel,
+            'committed': committed,
+            'paid': paid,
+            'total': personnel + paid,
+        }
+
+    def to_xlsx(self):
+        """ Export the statement as an Excel file (bytes)
+        """
+        out = io.BytesIO()
+        summary = self.summary()
+        with pd.ExcelWriter(out, engine='openpyxl') as writer:
+            pd.DataFrame({
+                'Item': ['Project', 'Period start', 'Period end', 'Personnel hours', 'Personnel cost', 'Committed', 'Paid', 'Total cost'],
+                'Value': [
+                    self.period['project'],
+                    self.period['rp_start'],
+                    self.period['rp_end'],
+                    summary['hours'],
+                    summary['personnel'],
+                    summary['committed'],
+                    summary['paid'],
+                    summary['total'],
+                ],
+            }).to_excel(writer, sheet_name='Summary', index=False)
+            self.personnel.to_excel(writer, sheet_name='Personnel', index=False)
+            self.personnel_by('Workpackage').to_excel(writer, sheet_name='By workpackage', index=False)
+            self.personnel_by('Researcher').to_excel(writer, sheet_name='By researcher', index=False)
+            self.direct.to_excel(writer, sheet_name='Direct costs', index=False)
+        return out.getvalue()
+
+    def to_csv(self, section='personnel'):
+        """ Export a section of the statement (personnel or direct) as CSV (string)
+        """
+        if section == 'personnel':
+            return self.personnel.to_csv(index=False)
+        if section == 'direct':
+            return self.direct.to_csv(index=False)
+        raise ValueError(f"Unknown statement section '{section}'")
+
+
+def _personnel_costs(period, matrix):
+    work = pd.DataFrame(
+        list(
+            ReportedWork.objects
+            .filter(period=period)
+            .order_by()
+            .values_list('pk', 'researcher', 'researcher__surname', 'researcher__name', 'year', 'month', 'hours')
+        ),
+        columns=['report', 'researcher', 'surname', 'name', 'Year', 'Month', 'Hours'],
+    )
+    # Split over WPs (zero fractions are ignored), with the normalized hours stored on the split
+    wps = pd.DataFrame(
+        list(
+            ReportedWorkWorkpackage.objects
+            .filter(report__period=period)
+            .exclude(fraction=0)
+            .order_by()
+            .values_list('report', 'workpackage__name', 'hours')
+        ),
+        columns=['report', 'Workpackage', 'wp_hours'],
+    )
+    df = work.merge(wps, on='report', how='left')
+    split = df['wp_hours'].notna().to_numpy()
+    df.loc[split, 'Hours'] = df.loc[split, 'wp_hours']
+    df['Workpackage'] = df['Workpackage'].fillna("")
+    df['Researcher'] = df['surname'] + " " + df['name']
+
+    df['Rate'] = matrix.hourly_rates(df['researcher'].to_numpy(), df['Year'].to_numpy(), is_horizon_eu(period.project))
+    df['Cost'] = df['Rate'] * df['Hours']
+    missing = df.loc[df['Rate'].isna(), ['Researcher', 'Year']].drop_duplicates().sort_values(['Researcher', 'Year'])
+    df = df.sort_values(['Researcher', 'Year', 'Month', 'Workpackage'], kind='stable').reset_index(drop=True)
+    return df[PERSONNEL_COLUMNS], [(r, int(y)) for r, y in missing.itertuples(index=False)]
+
+
+def _direct_costs(period):
+    years = range(period.rp_start.year, period.rp_end.year + 1)
+    committed = pd.DataFrame(
+        list(
+            Impegno.objects
+            .filter(gae__project=period.project, esercizio_orig__in=years, esercizio=F('esercizio_orig'))
+            .order_by()
+            .values_list('voce__voce', 'voce__description', 'im_competenza')
+        ),
+        columns=['Voce', 'Description', 'Committed'],
+    )
+    paid = pd.DataFrame(
+        list(
+            Mandato.objects
+            .filter(
+                impegno__gae__project=period.project,
+                data__gte=period.rp_start,
+                data__lt=period.rp_end + datetime.timedelta(days=1),
+            )
+            .order_by()
+            .values_list('impegno__voce__voce', 'impegno__voce__description', 'importo')
+        ),
+        columns=['Voce', 'Description', 'Paid'],
+    )
+    df = pd.concat([
+        committed.groupby(['Voce', 'Description'])['Committed'].sum(),
+        paid.groupby(['Voce', 'Description'])['Paid'].sum(),
+    ], axis=1).fillna(0.0)
+    df = df.reset_index().sort_values('Voce', kind='stable').reset_index(drop=True)
+    return df.reindex(columns=DIRECT_COLUMNS)
+
+
+def build_statement(period):
+    """ Build the financial statement of a reporting period
+    """
+    personnel, missing = _personnel_costs(period, get_cost_matrix())
+    return Statement(period, personnel, _direct_costs(period), missing)
+
+
+def _cache_version():
+    version = cache.get(CACHE_KEY + '.version')
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(CACHE_KEY + '.version', version, None)
+    return version
+
+
+def get_statement(period):
+    """ Financial statement of a reporting period from the cache (built if needed)
+    """
+    key = f"{CACHE_KEY}.{_cache_version()}.{period.pk}"
+    statement = cache.get(key)
+    if statement is None:
+        statement = build_statement(period)
+        cache.set(key, statement, CACHE_TIMEOUT)
+    return statement
+
+
+def invalidate_statements():
+    cache.set(CACHE_KEY + '.version', uuid.uuid4().hex, None)
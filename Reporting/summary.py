@@ -0,0 +1,166 @@
+from django.db import transaction
+from django.db.models import Count, Sum, Q, F, Value
+from django.db.models.functions import ExtractMonth, Floor, Least, Coalesce
+
+from .models import EpasCode, PresenceData, ReportedWork, ReportedWorkWorkpackage, ReportedMission, TimesheetHours, ReportingSummary, ReportingSummaryPending
+
+
+# Reporting summary
+# =================
+#
+# ReportingSummary holds the reporting data pre-aggregated by researcher, project, period, workpackage
+# and month. The lines of a set of researcher-months are computed with one aggregate query for each
+# source (presences, reported work and its split on workpackages, reported missions, timesheet hours)
+# and replaced in a single transaction. Saving a row only marks its researcher-month as pending (one insert,
+# see TimesheetStatusTracker and mark_reporting_summary): the pending researcher-months are refreshed by the
+# readers with refresh_reporting_summary, so that the cost of the refresh is paid once for many changes.
+# The summary can be rebuilt with the rebuild_reporting_summary command.
+
+def compute_reporting_summary(year, rid=None, months=None):
+    """ Compute the summary lines of a year, optionally only of a researcher and of some months
+    Return a list of (unsaved) ReportingSummary
+    """
+    lines = {}
+
+    def line(r, project, period, wp, month):
+        key = (r, project, period, wp, month)
+        if key not in lines:
+            lines[key] = ReportingSummary(researcher_id=r, project_id=project, period_id=period, workpackage_id=wp, year=year, month=month)
+        return lines[key]
+
+    def scope(qs, researcher_field, month_field=None):
+        # NOTE: date based querysets are already filtered on months with for_year()
+        if rid is not None:
+            qs = qs.filter(**{researcher_field: rid})
+        if months is not None and month_field is not None:
+            qs = qs.filter(**{f"{month_field}__in": months})
+        return qs
+
+    # Presences
+    working = Q(code__ts_code=EpasCode.NONE) | Q(code__isnull=True)
+    presences = (
+        scope(PresenceData.objects.for_year(year, months), 'researcher')
+        .annotate(
+            month=ExtractMonth('day'),
+            hd=Floor(F('hours') / Value(3.6)),
+            uh=Least(F('hours'), Value(7.2)),
+        )
+        .order_by()
+        .values('researcher', 'month')
+        .annotate(
+            worked=Coalesce(Sum('hours', filter=working), Value(0.0)),
+            usable=Coalesce(Sum('uh', filter=working), Value(0.0)),
+            half_days=Coalesce(Sum('hd', filter=working), Value(0.0)),
+            epas_missions=Count('code', filter=Q(code__ts_code=EpasCode.MISSION)),
+        )
+    )
+    for p in presences:
+        s = line(p['researcher'], None, None, None, p['month'])
+        s.worked_hours = p['worked']
+        s.usable_hours = p['usable']
+        s.half_days = int(p['half_days'])
+        s.epas_missions = p['epas_missions']
+
+    # Reported work, split on workpackages with the stored hours (zero fractions are ignored)
+    work = scope(ReportedWork.objects.filter(year=year), 'researcher', 'month').order_by()
+    split = {}
+    wps = (
+        scope(ReportedWorkWorkpackage.objects.filter(report__year=year), 'report__researcher', 'report__month')
+        .exclude(fraction=0)
+        .order_by()
+        .values_list('report', 'workpackage', 'hours')
+    )
+    for report, wp, hours in wps:
+        split.setdefault(report, []).append((wp, hours))
+    for pk, r, period, project, month, hours in work.values_list('pk', 'researcher', 'period', 'period__project', 'month', 'hours'):
+        for wp, wp_hours in split.get(pk, [(None, hours)]):
+            line(r, project, period, wp, month).reported_hours += wp_hours
+
+    # Reported missions
+    missions = (
+        scope(ReportedMission.objects.for_year(year, months), 'day__researcher')
+        .annotate(month=ExtractMonth('day__day'))
+        .order_by()
+        .values('day__researcher', 'period', 'period__project', 'workpackage', 'month')
+        .annotate(days=Count('day'), hours=Coalesce(Sum('day__hours'), Value(0.0)))
+    )
+    for m in missions:
+        s = line(m['day__researcher'], m['period__project'], m['period'], m['workpackage'], m['month'])
+        s.missions += m['days']
+        s.mission_hours += m['hours']
+
+    # Timesheet hours
+    ts_hours = (
+        scope(TimesheetHours.objects.for_year(year, months), 'report__researcher')
+        .annotate(month=ExtractMonth('day'))
+        .order_by()
+        .values('report__researcher', 'report__period', 'report__period__project', 'report_wp__workpackage', 'month')
+        .annotate(hours=Coalesce(Sum('hours'), Value(0.0)))
+    )
+    for t in ts_hours:
+        s = line(t['report__researcher'], t['report__period__project'], t['report__period'], t['report_wp__workpackage'], t['month'])
+        s.ts_hours += t['hours']
+
+    return list(lines.values())
+
+
+def update_reporting_summary(year, rid=None, months=None):
+    """ Replace the summary lines of a year, optionally only of a researcher and of some months
+    """
+    lines = compute_reporting_summary(year, rid, months)
+    old = ReportingSummary.objects.for_year(year, months)
+    if rid is not None:
+        old = old.filter(researcher=rid)
+    with transaction.atomic():
+        old.delete()
+        ReportingSummary.objects.bulk_create(lines, batch_size=1000)
+    return len(lines)
+
+
+def mark_reporting_summary(keys):
+    """ Mark the researcher-months (rid, year, month) as pending
+    """
+    ReportingSummaryPending.objects.bulk_create([
+        ReportingSummaryPending(researcher_id=r, year=year, month=month) for r, year, month in keys
+    ], ignore_conflicts=True)
+
+
+def refresh_reporting_summary(year=None, rid=None):
+    """ Refresh the pending researcher-months, optionally only of a year and of a researcher
+    Return the number of researcher-months refreshed
+    """
+    pending = ReportingSummaryPending.objects.all()
+    if year is not None:
+        pending = pending.filter(year=year)
+    if rid is not None:
+        pending = pending.filter(researcher=rid)
+    if not pending.exists():
+        return 0
+    with transaction.atomic():
+        # NOTE: marks added while refreshing are not deleted (they are not locked)
+        marks = list(pending.select_for_update().values_list('pk', 'researcher', 'year', 'month'))
+        groups = {}
+        for pk, r, y, month in marks:
+            groups.setdefault((r, y), set()).add(month)
+        for (r, y), months in groups.items():
+            update_reporting_summary(y, r, sorted(months))
+        if len(marks):
+            ReportingSummaryPending.objects.filter(pk__in=[m[0] for m in marks]).delete()
+    return len(marks)
+
+
+def rebuild_reporting_summary(years=None):
+    """ Rebuild the summary of the given years (all the years with data if None)
+    Return a dictionary year -> number of lines
+    """
+    if years is None:
+        years = set([d.year for d in PresenceData.objects.dates('day', 'year')])
+        years |= set(ReportedWork.objects.order_by().values_list('year', flat=True).distinct())
+        years |= set([d.year for d in TimesheetHours.objects.dates('day', 'year')])
+        years |= set(ReportingSummary.objects.order_by().values_list('year', flat=True).distinct())
+        years |= set(ReportingSummaryPending.objects.order_by().values_list('year', flat=True).distinct())
+    lines = {}
+    for year in sorted(years):
+        ReportingSummaryPending.objects.filter(year=year).delete()
+        lines[year] = update_reporting_summary(year)
+    return lines
@@ -0,0 +1,74 @@
+from Jobs.jobs import task
+from Projects.models import Project, Researcher
+from .models import ReportingPeriod
+from .batchprint import timesheet_print_jobs, iter_timesheets_zip, print_job_workers
+from .pdfcache import PrintCachedPDFTimesheet
+from .timesheets import GetTimesheetPrintContext
+from .staging import stage_presences
+from .epas import EpasFile
+from .ingest import ingest_presences as ingest_presences_files, ingest_job_workers
+
+
+# Background tasks (see Jobs app)
+# ===============================
+
+@task('Reporting.import_presences')
+def import_presences(job, researcher):
+    """ Parse the EPAS Excel file of a researcher
+    """
+    r = Researcher.objects.get(pk=researcher)
+    job.progress(0.0, "Parsing EPAS file")
+    presences = EpasFile(job.input_path).parse(f"{r.surname} {r.name}")
+    return {'researcher': researcher, 'token': stage_presences(presences, r)}
+
+
+@task('Reporting.ingest_presences')
+def ingest_presences(job):
+    """ Import the presences of many researchers from a ZIP archive of EPAS exports
+    """
+    job.progress(0.0, "Parsing EPAS files")
+    out = ingest_presences_files(job.input_path, max_workers=ingest_job_workers())
+    out['unknown'] = [[name, files] for name, files in sorted(out['unknown'].items())]
+    return out
+
+
+@task('Reporting.print_timesheet')
+def print_timesheet(job, researcher, year, months=None, project=None):
+    """ Print the timesheets of a researcher for a year
+    """
+    r = Researcher.objects.get(pk=researcher)
+    if project is not None:
+        project = Project.objects.get(pk=project)
+    job.progress(0.0, "Loading timesheet data")
+    good_months, context = GetTimesheetPrintContext(r, year, months, project)
+
+    job.progress(0.5, "Rendering")
+    if len(context) == 1:
+        filename = '{0:s}_{1:04d}_{2:02d}.pdf'.format(r.surname.lower(), year, good_months[0])
+    else:
+        filename = '{0:s}_{1:04d}.pdf'.format(r.surname.lower(), year)
+    with open(job.result_path('timesheet.pdf'), 'wb') as f:
+        f.write(PrintCachedPDFTimesheet(context).getvalue())
+    job.set_result_file('timesheet.pdf', filename)
+    return {'months': good_months}
+
+
+@task('Reporting.print_timesheets')
+def print_timesheets(job, year=None, period=None):
+    """ Print all the timesheets of a year or of a reporting period in a ZIP archive
+    """
+    if period is not None:
+        period = ReportingPeriod.objects.get(pk=period)
+        jobs = timesheet_print_jobs(period=period)
+        filename = "timesheets_{0:s}_{1!s}.zip".format(period.project.name.lower(), period.rp_start)
+    else:
+        jobs = timesheet_print_jobs(year=year)
+        filename = "timesheets_{0:04d}.zip".format(year)
+
+    errors = []
+    with open(job.result_path('timesheets.zip'), 'wb') as f:
+        for i, chunk in enumerate(iter_timesheets_zip(jobs, max_workers=print_job_workers(), errors=errors)):
+            f.write(chunk)
+            job.progress(min(i / max(len(jobs), 1), 1.0), "Printed {0:d} of {1:d} timesheets".format(min(i, len(jobs)), len(jobs)))
+    job.set_result_file('timesheets.zip', filename)
+    return {'printed': len(jobs) - len(errors), 'errors': [msg for f, msg in errors]}
@@ -1,3 +1,847 @@
-from django.test import TestCase
+import io
+import os
+import datetime
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from Accounting.models import GAE, VoceSpesa, Impegno, Mandato
+from Jobs.models import Job
+from Projects.models import Researcher, ResearcherRole, Project, WorkPackage
+from .models import EpasCode, BankHoliday, PersonnelCost, PresenceData, ReportingPeriod, ReportedWork, ReportedWorkWorkpackage, ReportedMission, ReportingSummary, ReportingSummaryPending, TimesheetHours, TimesheetStatus
+from .timesheets import status_tracker, TimesheetDataLoader, CheckTimesheetData, CheckTimesheetYear, EnsureTimesheetStatus, GetTimesheetData, GetTimesheetStatus, SaveTimesheetData
+from .allocation import allocate_hours, allocate_timesheets
+from .batchprint import timesheet_print_jobs
+from .costs import build_cost_matrix, get_cost_matrix, invalidate_cost_matrix
+from .statement import build_statement, get_statement
+from .exports import iter_export_rows
+from .pdfcache import TimesheetPDFCache
+from .epas import EpasFile, parse_codes
+from .ingest import count_epas_files, ingest_presences
+from .overview import build_reporting_overview, get_reporting_overview, filter_reporting_overview, invalidate_reporting_overview
+from .presences import import_presences
+from .staging import stage_presences, load_staged_presences, discard_staged_presences
+from .summary import refresh_reporting_summary
+from .utils import ReportingError, get_workpackages_fractions, get_workpackages_fractions_bulk
+from .workcalendar import get_year_calendar, holiday_mask, is_holiday
 
-# Create your tests here.
+
+class ReportingTestData(object):
+    """ Minimal reporting data: one researcher working on a project with two WPs and on a project without WPs
+    """
+    def create_data(self):
+        # Researcher
+        self.researcher = Researcher.objects.create(name='Mario', surname='Rossi')
+
+        # EPAS codes
+        self.mission_code = EpasCode.objects.create(code='92', ts_code=EpasCode.MISSION, description='Missione')
+
+        # Bank holidays
+        BankHoliday.objects.create(name='Liberation day', day=25, month=4)
+
+        # Projects
+        self.prj_wp = Project.objects.create(name='Alpha', agency='EU-H2020', reference='GA-1', pi=self.researcher)
+        self.wp1 = WorkPackage.objects.create(project=self.prj_wp, name='WP1', desc='First')
+        self.wp2 = WorkPackage.objects.create(project=self.prj_wp, name='WP2', desc='Second')
+        self.prj = Project.objects.create(name='Beta', agency='MUR', reference='PRIN')
+
+        # Reporting periods
+        self.rp_wp = ReportingPeriod.objects.create(project=self.prj_wp, rp_start=datetime.date(2023, 1, 1), rp_end=datetime.date(2023, 12, 31))
+        self.rp = ReportingPeriod.objects.create(project=self.prj, rp_start=datetime.date(2023, 1, 1), rp_end=datetime.date(2023, 12, 31))
+
+        # Presences for April 2023 (7.2 hours every working day, a mission on the 3rd)
+        day = datetime.date(2023, 4, 1)
+        while day.month == 4:
+            if day.weekday() < 5 and day.day != 25:
+                if day.day == 3:
+                    self.mission = PresenceData.objects.create(researcher=self.researcher, day=day, hours=7.2, code=self.mission_code, ts_code=EpasCode.MISSION)
+                else:
+                    PresenceData.objects.create(researcher=self.researcher, day=day, hours=7.2)
+            day += datetime.timedelta(days=1)
+
+        # Reported work
+        self.work_wp = ReportedWork.objects.create(period=self.rp_wp, researcher=self.researcher, year=2023, month=4, hours=20.0)
+        self.rwp1 = ReportedWorkWorkpackage.objects.create(report=self.work_wp, workpackage=self.wp1, fraction=3)
+        self.rwp2 = ReportedWorkWorkpackage.objects.create(report=self.work_wp, workpackage=self.wp2, fraction=1)
+        self.work = ReportedWork.objects.create(period=self.rp, researcher=self.researcher, year=2023, month=4, hours=10.0)
+
+        # Reported mission
+        ReportedMission.objects.create(period=self.rp_wp, workpackage=self.wp2, day=self.mission)
+
+    def fill_timesheet(self):
+        TimesheetHours.objects.create(report=self.work_wp, report_wp=self.rwp1, day=datetime.date(2023, 4, 4), hours=7.2)
+        TimesheetHours.objects.create(report=self.work_wp, report_wp=self.rwp1, day=datetime.date(2023, 4, 5), hours=7.2)
+        TimesheetHours.objects.create(report=self.work_wp, report_wp=self.rwp1, day=datetime.date(2023, 4, 6), hours=0.6)
+        TimesheetHours.objects.create(report=self.work_wp, report_wp=self.rwp2, day=datetime.date(2023, 4, 6), hours=5.0)
+        TimesheetHours.objects.create(report=self.work, report_wp=None, day=datetime.date(2023, 4, 7), hours=7.2)
+        TimesheetHours.objects.create(report=self.work, report_wp=None, day=datetime.date(2023, 4, 11), hours=2.8)
+
+
+class TimesheetDataLoaderTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_check_incomplete(self):
+        ok, reported, projects = CheckTimesheetData(self.researcher.pk, 2023, 4)
+        self.assertFalse(ok)
+        self.assertTrue(reported)
+        self.assertEqual(projects, {'Alpha': [False, self.prj_wp.pk], 'Beta': [False, self.prj.pk]})
+
+        # Printing is not allowed until the timesheet is complete
+        with self.assertRaises(ReportingError):
+            GetTimesheetData(self.researcher.pk, 2023, 4)
+
+    def test_timesheet(self):
+        self.fill_timesheet()
+        ts = GetTimesheetData(self.researcher.pk, 2023, 4)
+        self.assertTrue(ts['ok'])
+        self.assertEqual(ts['numdays'], 30)
+        self.assertEqual(ts['days'][24]['code'], 'PH')
+        self.assertEqual(ts['days'][2]['code'], 'BT')
+        self.assertEqual([p['name'] for p in ts['projects']], ['Alpha', 'Beta', 'Internal activities'])
+
+        alpha = ts['projects'][0]
+        self.assertTrue(alpha['has_wps'])
+        self.assertEqual([wp['name'] for wp in alpha['wps']], ['WP1', 'WP2'])
+        self.assertAlmostEqual(alpha['wps'][0]['total'], 15.0)
+        # Mission is added to WP2
+        self.assertAlmostEqual(alpha['wps'][1]['total'], 5.0 + 7.2)
+        self.assertAlmostEqual(alpha['days'][2], 7.2)
+        self.assertTrue(alpha['wps'][-1]['last'])
+
+        internal = ts['projects'][-1]
+        self.assertAlmostEqual(internal['days'][5], 7.2 - 5.6)
+        self.assertAlmostEqual(internal['days'][6], 0.0)
+
+        # Single project timesheet
+        ts = GetTimesheetData(self.researcher.pk, 2023, 4, project=self.prj)
+        self.assertEqual([p['name'] for p in ts['projects']], ['Beta', 'Internal activities'])
+
+    def test_constant_queries(self):
+        self.fill_timesheet()
+        with self.assertNumQueries(7):
+            loader = TimesheetDataLoader(self.researcher.pk, 2023)
+            for m in range(1, 13):
+                loader.get(m, generate=True)
+
+
+class CheckTimesheetYearTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_year_check(self):
+        # Incomplete timesheet
+        with self.assertNumQueries(4):
+            check = CheckTimesheetYear(2023)
+        self.assertEqual(check[self.researcher.pk][4], CheckTimesheetData(self.researcher.pk, 2023, 4))
+        self.assertEqual(check[self.researcher.pk][5], (True, False, {}))
+
+        # Complete timesheet
+        self.fill_timesheet()
+        check = CheckTimesheetYear(2023, self.researcher.pk)
+        self.assertEqual(check[self.researcher.pk][4], (True, True, {'Alpha': [True, self.prj_wp.pk], 'Beta': [True, self.prj.pk]}))
+
+        # Hours of a WP not matching the report
+        TimesheetHours.objects.filter(report_wp=self.rwp2).update(hours=4.0)
+        check = CheckTimesheetYear(2023, self.researcher.pk)
+        self.assertEqual(check[self.researcher.pk][4], (False, True, {'Alpha': [False, self.prj_wp.pk], 'Beta': [True, self.prj.pk]}))
+
+
+class WorkingCalendarTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_calendar(self):
+        cal = get_year_calendar(2023)
+        self.assertEqual(cal.ndays, 365)
+        self.assertTrue(is_holiday(datetime.date(2023, 4, 25)))
+        self.assertTrue(is_holiday(datetime.date(2023, 4, 1)))
+        self.assertFalse(is_holiday(datetime.date(2023, 4, 3)))
+
+        # Cached
+        with self.assertNumQueries(0):
+            mask = holiday_mask([datetime.date(2023, 4, 24), datetime.date(2023, 4, 25), datetime.date(2023, 4, 29)])
+        self.assertEqual(mask.tolist(), [False, True, True])
+
+        # Invalidated on change
+        BankHoliday.objects.create(name='Patron saint', day=24, month=4, year=2023)
+        self.assertTrue(is_holiday(datetime.date(2023, 4, 24)))
+        self.assertFalse(is_holiday(datetime.date(2024, 4, 24)))
+
+
+class DateRangeQuerySetTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+        # Days at the boundaries of April
+        PresenceData.objects.create(researcher=self.researcher, day=datetime.date(2023, 3, 31), hours=7.2)
+        PresenceData.objects.create(researcher=self.researcher, day=datetime.date(2023, 5, 1), hours=7.2)
+        PresenceData.objects.create(researcher=self.researcher, day=datetime.date(2023, 12, 31), hours=0.0)
+
+    def test_ranges(self):
+        self.assertEqual(PresenceData.objects.for_month(2023, 4).count(), 19)
+        self.assertEqual(PresenceData.objects.for_month(2023, 3).count(), 1)
+        self.assertEqual(PresenceData.objects.for_year(2023).count(), 22)
+        self.assertEqual(PresenceData.objects.for_year(2024).count(), 0)
+        self.assertEqual(PresenceData.objects.for_year(2023, [3, 4]).count(), 20)
+        self.assertEqual(PresenceData.objects.for_year(2023, [3, 5, 12]).count(), 3)
+        self.assertEqual(PresenceData.objects.for_year(2023, []).count(), 0)
+        self.assertEqual(PresenceData.objects.for_period(self.rp).count(), 22)
+
+    def test_related(self):
+        self.fill_timesheet()
+        self.assertEqual(TimesheetHours.objects.for_month(2023, 4).count(), 6)
+        self.assertEqual(TimesheetHours.objects.for_year(2023, [5]).count(), 0)
+        self.assertEqual(ReportedMission.objects.for_month(2023, 4).count(), 1)
+        self.assertEqual(ReportedMission.objects.for_year(2023, [1, 2, 3]).count(), 0)
+
+        # Filters on the date range, not on extracted year and month
+        sql = str(PresenceData.objects.for_month(2023, 4).query).upper()
+        self.assertNotIn("EXTRACT", sql)
+        self.assertNotIn("STRFTIME", sql)
+
+
+class ReportingOverviewTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+        self.other = Researcher.objects.create(name='Luigi', surname='Bianchi')
+        ReportedWork.objects.create(period=self.rp, researcher=self.other, year=2023, month=5, hours=15.0)
+        ReportedWork.objects.create(period=self.rp, researcher=self.other, year=2023, month=6, hours=5.0)
+
+    def test_overview(self):
+        with self.assertNumQueries(3):
+            projects = build_reporting_overview()
+        self.assertEqual(list(projects.keys()), ['Alpha', 'Beta'])
+        alpha = projects['Alpha']['periods'][0]['researchers']
+        self.assertEqual(list(alpha.keys()), ['Mario Rossi'])
+        self.assertEqual(alpha['Mario Rossi']['hours'], 20.0)
+        self.assertEqual(alpha['Mario Rossi']['missions'], 1)
+        self.assertAlmostEqual(alpha['Mario Rossi']['mission_hours'], 7.2)
+        beta = projects['Beta']['periods'][0]['researchers']
+        self.assertEqual(beta['Mario Rossi']['hours'], 10.0)
+        self.assertEqual(beta['Mario Rossi']['missions'], 0)
+        self.assertEqual(beta['Luigi Bianchi']['hours'], 20.0)
+
+    def test_filter(self):
+        user = User.objects.create(username='lbianchi')
+        projects = build_reporting_overview()
+        own = filter_reporting_overview(projects, user, self.other.pk)
+        self.assertEqual(list(own.keys()), ['Beta'])
+        self.assertEqual(list(own['Beta']['periods'][0]['researchers'].keys()), ['Luigi Bianchi'])
+
+        # The PI sees all the researchers of the project
+        self.researcher.username = user
+        self.researcher.save()
+        own = filter_reporting_overview(build_reporting_overview(), user, self.other.pk)
+        self.assertEqual(list(own['Alpha']['periods'][0]['researchers'].keys()), ['Mario Rossi'])
+        self.assertEqual(list(own['Beta']['periods'][0]['researchers'].keys()), ['Luigi Bianchi'])
+
+    def test_cache(self):
+        invalidate_reporting_overview()
+        get_reporting_overview()
+        # Only the read of the shared cache
+        with self.assertNumQueries(1):
+            get_reporting_overview()
+        # Changes invalidate the cache
+        ReportedWork.objects.create(period=self.rp_wp, researcher=self.other, year=2023, month=5, hours=3.0)
+        projects = get_reporting_overview()
+        self.assertEqual(projects['Alpha']['periods'][0]['researchers']['Luigi Bianchi']['hours'], 3.0)
+
+
+class WorkpackagesFractionsTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_bulk(self):
+        with self.assertNumQueries(1):
+            fractions = get_workpackages_fractions_bulk([self.work_wp, self.work])
+        self.assertEqual(fractions[self.work.pk], [])
+        self.assertEqual([wp['wp'] for wp in fractions[self.work_wp.pk]], ['WP1', 'WP2'])
+        self.assertEqual([wp['hours'] for wp in fractions[self.work_wp.pk]], [15.0, 5.0])
+        self.assertEqual([wp['percent'] for wp in fractions[self.work_wp.pk]], [75.0, 25.0])
+        self.assertEqual(fractions[self.work_wp.pk], get_workpackages_fractions(self.work_wp))
+
+    def test_stored_hours(self):
+        # Hours of the report changed
+        self.work_wp.hours = 40.0
+        self.work_wp.save()
+        self.assertEqual([wp['hours'] for wp in get_workpackages_fractions(self.work_wp)], [30.0, 10.0])
+        # Split changed
+        self.rwp2.fraction = 3
+        self.rwp2.save()
+        self.assertEqual([wp['hours'] for wp in get_workpackages_fractions(self.work_wp)], [20.0, 20.0])
+        self.rwp1.delete()
+        self.assertEqual([wp['hours'] for wp in get_workpackages_fractions(self.work_wp)], [40.0])
+
+
+class CostMatrixTest(TestCase):
+    def setUp(self):
+        self.r1 = Researcher.objects.create(name='Mario', surname='Rossi')
+        self.r2 = Researcher.objects.create(name='Luigi', surname='Bianchi')
+        self.r3 = Researcher.objects.create(name='Anna', surname='Verdi')
+        ResearcherRole.objects.create(researcher=self.r1, role=ResearcherRole.RESEARCHER, start_date=datetime.date(2005, 3, 1))
+        ResearcherRole.objects.create(researcher=self.r2, role=ResearcherRole.RESEARCHER_TD, start_date=datetime.date(2019, 9, 1))
+        ResearcherRole.objects.create(researcher=self.r2, role=ResearcherRole.RESEARCHER, start_date=datetime.date(2022, 1, 1))
+        for y in range(2019, 2025):
+            PersonnelCost.objects.create(researcher=self.r1, year=y, cost=70000.0 + y)
+            PersonnelCost.objects.create(researcher=self.r2, year=y, cost=45000.0 + y)
+        # No role: hourly rate not available
+        PersonnelCost.objects.create(researcher=self.r3, year=2023, cost=40000.0)
+
+    def test_matrix(self):
+        with self.assertNumQueries(2):
+            matrix = build_cost_matrix()
+        self.assertEqual(matrix.years, list(range(2019, 2025)))
+        for c in PersonnelCost.objects.filter(researcher__in=[self.r1, self.r2]):
+            self.assertEqual(matrix.hourly_rate(c.researcher_id, c.year), c.get_hourly_rate())
+            self.assertEqual(matrix.hours[matrix.researchers.index(c.researcher_id), matrix.years.index(c.year)], c.researcher.get_productive_hours(c.year))
+            self.assertEqual(matrix.hours_heu[matrix.researchers.index(c.researcher_id), matrix.years.index(c.year)], c.researcher.get_productive_hours(c.year, True))
+        self.assertIsNone(matrix.hourly_rate(self.r3.pk, 2023))
+        self.assertIsNone(matrix.hourly_rate(self.r1.pk, 2030))
+
+        # Pricing of many hours at once
+        cost = matrix.price([self.r1.pk, self.r2.pk, self.r2.pk], [2023, 2020, 2030], [10.0, 20.0, 5.0], is_horizon_eu=True)
+        self.assertAlmostEqual(cost[0], 10.0 * round(72023.0 / 1548 * 100.0) / 100.0)
+        self.assertAlmostEqual(cost[1], 20.0 * round(47020.0 / 1520 * 100.0) / 100.0)
+        self.assertTrue(np.isnan(cost[2]))
+
+    def test_cache(self):
+        invalidate_cost_matrix()
+        get_cost_matrix()
+        # Only the read of the shared cache
+        with self.assertNumQueries(1):
+            get_cost_matrix()
+        cost = PersonnelCost.objects.get(researcher=self.r1, year=2023)
+        cost.cost = 0.0
+        cost.save()
+        self.assertEqual(get_cost_matrix().hourly_rate(self.r1.pk, 2023), 0.0)
+        PersonnelCost.objects.get(researcher=self.r1, year=2024).delete()
+        self.assertIsNone(get_cost_matrix().hourly_rate(self.r1.pk, 2024))
+
+
+class StatementTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+        ResearcherRole.objects.create(researcher=self.researcher, role=ResearcherRole.RESEARCHER, start_date=datetime.date(2010, 1, 1))
+        PersonnelCost.objects.create(researcher=self.researcher, year=2023, cost=75300.0)
+        self.rate = round(75300.0 / 1506 * 100.0) / 100.0
+
+        gae = GAE.objects.create(project=self.prj_wp, name='P0001', description='Alpha')
+        voce = VoceSpesa.objects.create(voce='22010', description='Consumables')
+        im1 = Impegno.objects.create(gae=gae, esercizio=2023, esercizio_orig=2023, numero=1, description='Optics', voce=voce, im_competenza=1000.0)
+        # Residual of the same commitment in 2024: not counted again
+        Impegno.objects.create(gae=gae, esercizio=2024, esercizio_orig=2023, numero=1, description='Optics', voce=voce, im_residui=400.0)
+        Mandato.objects.create(impegno=im1, numero=1, description='Lenses', id_terzo=1, terzo='Supplier', importo=600.0, data=datetime.date(2023, 5, 10))
+        Mandato.objects.create(impegno=im1, numero=2, description='Mirrors', id_terzo=1, terzo='Supplier', importo=400.0, data=datetime.date(2024, 2, 1))
+
+    def test_statement(self):
+        statement = build_statement(self.rp_wp)
+        self.assertEqual(list(statement.personnel['Workpackage']), ['WP1', 'WP2'])
+        self.assertEqual(list(statement.personnel['Hours']), [15.0, 5.0])
+        self.assertEqual(list(statement.personnel['Rate']), [self.rate, self.rate])
+        self.assertEqual(statement.missing_rates, [])
+        self.assertEqual(statement.direct.to_dict('records'), [{'Voce': '22010', 'Description': 'Consumables', 'Committed': 1000.0, 'Paid': 600.0}])
+        summary = statement.summary()
+        self.assertEqual(summary['hours'], 20.0)
+        self.assertAlmostEqual(summary['personnel'], 20.0 * self.rate)
+        self.assertAlmostEqual(summary['total'], 20.0 * self.rate + 600.0)
+
+        # Project without WPs and without direct costs
+        statement = build_statement(self.rp)
+        self.assertEqual(list(statement.personnel['Workpackage']), [''])
+        self.assertEqual(list(statement.personnel['Hours']), [10.0])
+        self.assertEqual(len(statement.direct), 0)
+
+    def test_missing_rate(self):
+        PersonnelCost.objects.all().delete()
+        statement = build_statement(self.rp_wp)
+        self.assertEqual(statement.missing_rates, [('Rossi Mario', 2023)])
+        self.assertEqual(statement.summary()['personnel'], 0.0)
+
+    def test_export(self):
+        statement = get_statement(self.rp_wp)
+        book = load_workbook(io.BytesIO(statement.to_xlsx()), read_only=True)
+        self.assertEqual(book.sheetnames, ['Summary', 'Personnel', 'By workpackage', 'By researcher', 'Direct costs'])
+        book.close()
+        self.assertEqual(statement.to_csv('direct').splitlines(), ['Voce,Description,Committed,Paid', '22010,Consumables,1000.0,600.0'])
+
+        # Changes invalidate the cached statement
+        self.work_wp.hours = 40.0
+        self.work_wp.save()
+        self.assertEqual(get_statement(self.rp_wp).summary()['hours'], 40.0)
+
+
+class ExportTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+        self.fill_timesheet()
+
+    def test_rows(self):
+        rows = list(iter_export_rows('work', year=2023))
+        self.assertEqual(rows[0][:3], ['Researcher', 'Project', 'Period start'])
+        self.assertEqual([(r[1], r[6], r[7], r[9]) for r in rows[1:]], [('Alpha', 20.0, 'WP1', 15.0), ('Alpha', 20.0, 'WP2', 5.0), ('Beta', 10.0, None, None)])
+        self.assertEqual(len(list(iter_export_rows('presences', researcher=self.researcher.pk, year=2023))), 20)
+        self.assertEqual(len(list(iter_export_rows('presences', year=2022))), 1)
+        self.assertEqual(len(list(iter_export_rows('timesheets', project=self.prj.pk))), 3)
+        self.assertEqual(list(iter_export_rows('missions'))[1][:3], ('Rossi Mario', datetime.date(2023, 4, 3), 7.2))
+
+    def test_view(self):
+        user = User.objects.create(username='admin', is_superuser=True)
+        self.client.force_login(user)
+        response = self.client.get(reverse('reporting_export', kwargs={'name': 'timesheets'}), {'year': 2023})
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'Researcher,Date,Project,Workpackage,Hours')
+        self.assertEqual(lines[1], 'Rossi Mario,2023-04-04,Alpha,WP1,7.2')
+        self.assertEqual(len(lines), 7)
+
+        response = self.client.get(reverse('reporting_export', kwargs={'name': 'work'}), {'format': 'xlsx'})
+        book = load_workbook(io.BytesIO(b"".join(response.streaming_content)), read_only=True)
+        self.assertEqual(len(list(book.active.iter_rows())), 4)
+        book.close()
+        self.assertEqual(self.client.get(reverse('reporting_export', kwargs={'name': 'presences'}), {'project': self.prj.pk}).status_code, 404)
+
+
+class ImportPresencesTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+        self.holiday_code = EpasCode.objects.create(code='32', ts_code=EpasCode.HOLIDAYS, description='Ferie')
+
+    def test_import(self):
+        data = pd.DataFrame({
+            'Date': pd.to_datetime(['2023-04-03', '2023-04-04', '2023-04-05', '2023-05-02', '2023-05-03', '2023-05-03', None, '2023-05-04', '2023-05-05']),
+            'Hours': [7.2, 6.0, 0.0, 7.2, 7.2, 5.0, 7.2, -1.0, 3.0],
+            'Code': ['92', '', '32', '', '', '', '', '', 'XX'],
+        })
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(6):
+                report = import_presences(self.researcher, data)
+
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(report['updated'], 2)
+        self.assertEqual(report['unchanged'], 1)
+        self.assertEqual([r['reason'] for r in report['rejected']], ["Duplicated date", "Duplicated date", "Invalid date", "Invalid hours"])
+        self.assertEqual(report['missing_codes'], ['XX'])
+
+        p = PresenceData.objects.get(researcher=self.researcher, day=datetime.date(2023, 4, 5))
+        self.assertEqual((p.hours, p.code, p.ts_code), (0.0, self.holiday_code, EpasCode.HOLIDAYS))
+        self.assertEqual(PresenceData.objects.get(researcher=self.researcher, day=datetime.date(2023, 4, 4)).hours, 6.0)
+        p = PresenceData.objects.get(researcher=self.researcher, day=datetime.date(2023, 5, 5))
+        self.assertEqual((p.hours, p.code, p.ts_code), (3.0, None, EpasCode.NONE))
+        self.assertFalse(PresenceData.objects.filter(day=datetime.date(2023, 5, 3)).exists())
+
+        # Importing again changes nothing
+        report = import_presences(self.researcher, data)
+        self.assertEqual((report['created'], report['updated'], report['unchanged']), (0, 0, 5))
+
+
+class EpasParserTest(TestCase):
+    def make_xlsx(self):
+        import openpyxl
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        for month, name in ((4, 'aprile'), (5, 'maggio')):
+            ws = wb.create_sheet(f"Rossi Mario_{name}2023")
+            ws.append(["Data", "Lavoro effettivo (hh:mm)", "Tutti i codici di assenza"])
+            ws.append([datetime.datetime(2023, month, 3), "07:12", None])
+            ws.append([datetime.datetime(2023, month, 4), "00:00", 32])
+            ws.append([datetime.datetime(2023, month, 5), "03:30", "31;92M"])
+            ws.append([None, None, None])
+        ws = wb.create_sheet("Bianchi Luca_aprile2023")
+        ws.append(["Data", "Lavoro effettivo (hh:mm)", "Tutti i codici di assenza"])
+        f = io.BytesIO()
+        wb.save(f)
+        return f.getvalue()
+
+    def test_codes(self):
+        codes = parse_codes([None, 32, 32.0, "09B1", "31;92M", "92;92E", "31;41", "nan"])
+        self.assertEqual(list(codes), ["", "32", "32", "09B1", "92M", "92E", "31", ""])
+
+    def test_xlsx(self):
+        epas = EpasFile(io.BytesIO(self.make_xlsx()), 'presences.xlsx')
+        self.assertEqual(epas.format, 'xlsx')
+        self.assertEqual([s[1:] for s in epas.sheets("Rossi Mario")], [(2023, 'aprile'), (2023, 'maggio')])
+        self.assertEqual(epas.sheets("Verdi Anna"), [])
+
+        for workers in (1, 2):
+            presences = epas.parse("Rossi Mario", max_workers=workers)
+            self.assertEqual(list(presences[2023].keys()), ['aprile', 'maggio'])
+            df = presences[2023]['maggio']
+            self.assertEqual(list(df['Date'].dt.day), [3, 4, 5])
+            self.assertEqual(list(df['Hours']), [7.2, 0.0, 3.5])
+            self.assertEqual(list(df['Code']), ["", "32", "92M"])
+
+    def test_csv(self):
+        data = "Data;Lavoro effettivo (hh:mm);Tutti i codici di assenza\n03/04/2023;07:12;\n04/04/2023;00:00;32\n".encode('utf-8')
+        epas = EpasFile(data, 'Rossi Mario_aprile2023.csv')
+        self.assertEqual(epas.format, 'csv')
+        df = epas.parse("Rossi Mario")[2023]['aprile']
+        self.assertEqual(list(df['Date']), [pd.Timestamp(2023, 4, 3), pd.Timestamp(2023, 4, 4)])
+        self.assertEqual(list(df['Hours']), [7.2, 0.0])
+        self.assertEqual(list(df['Code']), ["", "32"])
+
+    def test_ods(self):
+        f = io.BytesIO()
+        with pd.ExcelWriter(f, engine='odf') as writer:
+            pd.DataFrame({
+                'Data': ["03/04/2023", "04/04/2023"],
+                'Lavoro effettivo (hh:mm)': ["07:12", "00:00"],
+                'Tutti i codici di assenza': [None, "32"],
+            }).to_excel(writer, sheet_name='Rossi Mario_aprile2023', index=False)
+        epas = EpasFile(f.getvalue(), 'presences.ods')
+        self.assertEqual(epas.format, 'ods')
+        df = epas.parse("Rossi Mario")[2023]['aprile']
+        self.assertEqual(list(df['Date']), [pd.Timestamp(2023, 4, 3), pd.Timestamp(2023, 4, 4)])
+        self.assertEqual(list(df['Hours']), [7.2, 0.0])
+        self.assertEqual(list(df['Code']), ["", "32"])
+
+    def test_invalid(self):
+        with self.assertRaises(ReportingError):
+            EpasFile(b'PK\x03\x04garbage', 'presences.xlsx')
+
+
+class IngestPresencesTest(TestCase):
+    def make_xlsx(self, names):
+        import openpyxl
+        wb = openpyxl.Workbook()
+        wb.remove(wb.active)
+        for name in names:
+            ws = wb.create_sheet(f"{name}_aprile2023")
+            ws.append(["Data", "Lavoro effettivo (hh:mm)", "Tutti i codici di assenza"])
+            ws.append([datetime.datetime(2023, 4, 3), "07:12", None])
+            ws.append([datetime.datetime(2023, 4, 4), "06:00", None])
+        f = io.BytesIO()
+        wb.save(f)
+        return f.getvalue()
+
+    def test_ingest(self):
+        rossi = Researcher.objects.create(name='Mario', surname='Rossi')
+        bianchi = Researcher.objects.create(name='Luca', surname='Bianchi')
+        PresenceData.objects.create(researcher=rossi, day=datetime.date(2023, 4, 4), hours=7.2)
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('rossi.xlsx', self.make_xlsx(["Rossi Mario"]))
+            z.writestr('others/bianchi_verdi.xlsx', self.make_xlsx(["Bianchi Luca", "Verdi Anna"]))
+            z.writestr('broken.xlsx', b"not an excel file")
+            z.writestr('notes.txt', b"ignored")
+        archive.seek(0)
+
+        self.assertEqual(count_epas_files(archive), 3)
+        self.assertEqual(archive.tell(), 0)
+        out = ingest_presences(archive, max_workers=2)
+
+        self.assertEqual([(r['researcher'], r['created'], r['updated'], r['unchanged']) for r in out['researchers']], [('Luca Bianchi', 2, 0, 0), ('Mario Rossi', 1, 1, 0)])
+        self.assertEqual(out['researchers'][0]['files'], ['others/bianchi_verdi.xlsx'])
+        self.assertEqual(out['unknown'], {'Verdi Anna': ['others/bianchi_verdi.xlsx']})
+        self.assertEqual([e[0] for e in out['errors']], ['broken.xlsx'])
+        self.assertEqual(PresenceData.objects.get(researcher=rossi, day=datetime.date(2023, 4, 4)).hours, 6.0)
+        self.assertEqual(PresenceData.objects.filter(researcher=bianchi).count(), 2)
+
+        # Parsed in this process, without a pool
+        archive.seek(0)
+        out = ingest_presences(archive, max_workers=1)
+        self.assertEqual([(r['researcher'], r['created'], r['unchanged']) for r in out['researchers']], [('Luca Bianchi', 0, 2), ('Mario Rossi', 0, 2)])
+        self.assertEqual([e[0] for e in out['errors']], ['broken.xlsx'])
+
+
+class PresenceStagingTest(TestCase):
+    def setUp(self):
+        self.researcher = Researcher.objects.create(name='Mario', surname='Rossi')
+        self.presences = {
+            2023: {
+                'aprile': pd.DataFrame({
+                    'Date': pd.to_datetime(['2023-04-03', '2023-04-04']),
+                    'Hours': [7.2, 0.0],
+                    'Code': ['', '32'],
+                }),
+                'maggio': pd.DataFrame({'Date': pd.to_datetime([]), 'Hours': [], 'Code': []}),
+            },
+            2024: {
+                'gennaio': pd.DataFrame({'Date': pd.to_datetime(['2024-01-02']), 'Hours': [6.5], 'Code': ['92']}),
+            },
+        }
+
+    def test_stage(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with override_settings(PRESENCE_STAGING_DIR=tmp):
+                token = stage_presences(self.presences, self.researcher)
+                rid, presences = load_staged_presences(token)
+                self.assertEqual(rid, self.researcher.pk)
+                self.assertEqual(list(presences.keys()), [2023, 2024])
+                self.assertEqual(list(presences[2023].keys()), ['aprile', 'maggio'])
+                self.assertEqual(len(presences[2023]['maggio']), 0)
+                pd.testing.assert_frame_equal(presences[2023]['aprile'], self.presences[2023]['aprile'], check_dtype=False)
+                pd.testing.assert_frame_equal(presences[2024]['gennaio'], self.presences[2024]['gennaio'], check_dtype=False)
+
+                discard_staged_presences(token)
+                with self.assertRaises(ReportingError):
+                    load_staged_presences(token)
+                with self.assertRaises(ReportingError):
+                    load_staged_presences("../../etc/passwd")
+
+            # Expired imports are not loaded
+            with override_settings(PRESENCE_STAGING_DIR=tmp, PRESENCE_STAGING_EXPIRY=-1):
+                token = stage_presences(self.presences, self.researcher)
+                with self.assertRaises(ReportingError):
+                    load_staged_presences(token)
+                self.assertEqual(os.listdir(tmp), [])
+
+
+class ReportingSummaryTest(ReportingTestData, TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_data()
+            self.fill_timesheet()
+        refresh_reporting_summary()
+
+    def summary(self):
+        return list(ReportingSummary.objects.rollup('researcher', 'project', 'period', 'workpackage', 'year', 'month'))
+
+    def test_summary(self):
+        # Presences
+        presences = ReportingSummary.objects.get(project=None)
+        self.assertEqual((presences.year, presences.month), (2023, 4))
+        self.assertAlmostEqual(presences.worked_hours, 18 * 7.2)
+        self.assertAlmostEqual(presences.usable_hours, 18 * 7.2)
+        self.assertEqual(presences.half_days, 18 * 2)
+        self.assertEqual(presences.epas_missions, 1)
+
+        # Roll-up by workpackage
+        wps = {w['workpackage']: w for w in ReportingSummary.objects.filter(project=self.prj_wp).rollup('workpackage')}
+        self.assertEqual(wps[self.wp1.pk]['reported_hours'], 15.0)
+        self.assertAlmostEqual(wps[self.wp1.pk]['ts_hours'], 15.0)
+        self.assertEqual(wps[self.wp2.pk]['reported_hours'], 5.0)
+        self.assertEqual(wps[self.wp2.pk]['missions'], 1)
+        self.assertAlmostEqual(wps[self.wp2.pk]['mission_hours'], 7.2)
+
+        # Roll-up by project over the period
+        projects = {p['project']: p for p in ReportingSummary.objects.for_period(self.rp).exclude(project=None).rollup('project')}
+        self.assertEqual(projects[self.prj.pk]['reported_hours'], 10.0)
+        self.assertAlmostEqual(projects[self.prj.pk]['ts_hours'], 10.0)
+        self.assertEqual(ReportingSummary.objects.for_year(2023, [5]).count(), 0)
+
+    def test_incremental(self):
+        # Reported work moved to another month: the months are marked and refreshed when read
+        with self.captureOnCommitCallbacks(execute=True):
+            self.work.month = 5
+            self.work.save()
+        self.assertEqual(sorted(ReportingSummaryPending.objects.values_list('year', 'month')), [(2023, 4), (2023, 5)])
+        self.assertEqual(refresh_reporting_summary(2023), 2)
+        self.assertEqual(ReportingSummaryPending.objects.count(), 0)
+        may = ReportingSummary.objects.for_year(2023, [5]).rollup('project')
+        self.assertEqual([(m['project'], m['reported_hours']) for m in may], [(self.prj.pk, 10.0)])
+        expected = self.summary()
+        call_command('rebuild_reporting_summary', stdout=io.StringIO())
+        self.assertEqual(self.summary(), expected)
+
+        # Presences imported in bulk
+        with self.captureOnCommitCallbacks(execute=True):
+            import_presences(self.researcher, pd.DataFrame({'Date': [datetime.datetime(2023, 5, 2)], 'Hours': [6.0], 'Code': [""]}))
+        refresh_reporting_summary()
+        self.assertEqual(ReportingSummary.objects.get(project=None, month=5).worked_hours, 6.0)
+
+    def test_year_view(self):
+        # Presences of the yearly view are read from the summary
+        with self.captureOnCommitCallbacks(execute=True):
+            PresenceData.objects.create(researcher=self.researcher, day=datetime.date(2023, 5, 2), hours=9.0)
+        self.client.force_login(User.objects.create(username='admin', is_superuser=True))
+        response = self.client.get(reverse('reporting_ajax_year'), {'year': 2023, 'rid': self.researcher.pk})
+        work = response.context['details']['work']
+        self.assertEqual([c['value'] for c in work[3][-3:]], [f"{18 * 7.2:.1f}", f"36 ({36 * 3.6:.1f})", f"{18 * 7.2:.1f}"])
+        self.assertEqual([c['value'] for c in work[4][-3:]], ["7.2", "2 (7.2)", "9.0"])
+        self.assertEqual(response.context['details']['missions'][3][-1]['value'], "1")
+        self.assertEqual(ReportingSummaryPending.objects.count(), 0)
+
+
+class TimesheetStatusTest(ReportingTestData, TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_data()
+
+    def test_status(self):
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+
+        # Timesheet filled
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fill_timesheet()
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+        status = TimesheetStatus.objects.get(researcher=self.researcher, year=2023, month=4, project=self.prj_wp)
+        self.assertTrue(status.ok)
+        self.assertAlmostEqual(status.reported_hours, 20.0)
+        self.assertAlmostEqual(status.ts_hours, 20.0)
+        self.assertAlmostEqual(status.presence_hours, 19 * 7.2)
+
+        # Hours of a WP not matching the report
+        with self.captureOnCommitCallbacks(execute=True):
+            ts = TimesheetHours.objects.get(report_wp=self.rwp2)
+            ts.hours = 4.0
+            ts.save()
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+        self.assertFalse(TimesheetStatus.objects.get(researcher=self.researcher, year=2023, month=4, project=self.prj_wp).ok)
+
+        # Reported work moved to another month
+        with self.captureOnCommitCallbacks(execute=True):
+            self.work.month = 5
+            self.work.save()
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+
+    def test_tracker(self):
+        # The refresh is registered once for each transaction
+        with self.captureOnCommitCallbacks() as callbacks:
+            for p in PresenceData.objects.filter(researcher=self.researcher):
+                p.save()
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertIsNone(status_tracker.local.pending)
+
+        # Marks of a rolled back transaction are discarded
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                status_tracker.mark(self.researcher.pk, 2023, 6)
+                raise ValueError()
+        with self.captureOnCommitCallbacks() as callbacks:
+            status_tracker.mark(self.researcher.pk, 2023, 7)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(status_tracker.local.pending['keys'], set([(self.researcher.pk, 2023, 7)]))
+        callbacks[0]()
+
+    def test_rebuild(self):
+        self.fill_timesheet()
+        TimesheetStatus.objects.all().delete()
+        call_command('rebuild_timesheet_status', stdout=io.StringIO())
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+
+    def test_missing_year(self):
+        # Years missing from the table (e.g. right after the migration) are computed when read
+        self.fill_timesheet()
+        TimesheetStatus.objects.all().delete()
+        self.assertEqual(EnsureTimesheetStatus([2022]), [])
+        self.assertEqual(GetTimesheetStatus(2023), CheckTimesheetYear(2023))
+        self.assertTrue(TimesheetStatus.objects.filter(year=2023).exists())
+        with self.assertNumQueries(1):
+            self.assertEqual(EnsureTimesheetStatus([2023]), [])
+
+
+class SaveTimesheetDataTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def get_rows(self):
+        return set(TimesheetHours.objects.values_list('report', 'report_wp', 'day', 'hours'))
+
+    def test_save(self):
+        self.fill_timesheet()
+        expected = self.get_rows()
+        TimesheetHours.objects.all().delete()
+
+        # Same data as fill_timesheet
+        d = lambda n: datetime.date(2023, 4, n)
+        projects = {self.prj.pk: {d(7): 7.2, d(11): 2.8}}
+        workpackages = {self.wp1.pk: {d(4): 7.2, d(5): 7.2, d(6): 0.6}, self.wp2.pk: {d(6): 5.0}}
+        self.assertEqual(SaveTimesheetData(self.researcher.pk, 2023, 4, projects, workpackages), (6, 0, 0))
+        self.assertEqual(self.get_rows(), expected)
+
+        # Move hours from a day to another
+        projects = {self.prj.pk: {d(7): 7.2, d(12): 2.8}}
+        workpackages = {self.wp1.pk: {d(4): 7.2, d(5): 7.0, d(6): 0.8}}
+        with self.assertNumQueries(10):
+            self.assertEqual(SaveTimesheetData(self.researcher.pk, 2023, 4, projects, workpackages), (1, 2, 1))
+        self.assertEqual(TimesheetHours.objects.filter(report=self.work).count(), 2)
+        self.assertTrue(TimesheetHours.objects.filter(report=self.work, day=d(12)).exists())
+
+        # Errors roll back everything
+        expected = self.get_rows()
+        with self.assertRaises(ReportingError):
+            SaveTimesheetData(self.researcher.pk, 2023, 4, {self.prj.pk: {d(7): 1.0}}, {self.wp2.pk + 100: {d(7): 1.0}})
+        with self.assertRaises(ReportingError):
+            SaveTimesheetData(self.researcher.pk, 2023, 4, {self.prj.pk: {d(7): 1.0}, self.prj_wp.pk + 100: {d(7): 1.0}}, {})
+        self.assertEqual(self.get_rows(), expected)
+
+
+class AllocationTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_allocate_hours(self):
+        masks = np.array([[True, True, True, False], [True, True, True, True]])
+        alloc = allocate_hours([10.0, 2.05], masks, [7.2, 3.6, 0.0, 7.2])
+        self.assertAlmostEqual(alloc[0].sum(), 10.0)
+        self.assertAlmostEqual(alloc[1].sum(), 2.05)
+        self.assertTrue(np.all(alloc.sum(axis=0) <= np.array([7.2, 3.6, 0.0, 7.2]) + 1e-6))
+        self.assertEqual(alloc[0, 3], 0.0)
+
+        with self.assertRaises(ReportingError):
+            allocate_hours([11.0, 10.0], masks, [7.2, 3.6, 0.0, 7.2])
+
+    def test_allocate_timesheets(self):
+        out = allocate_timesheets(2023)
+        self.assertEqual(list(out[self.researcher.pk].keys()), [4])
+        ok, reported, projects = CheckTimesheetData(self.researcher.pk, 2023, 4)
+        self.assertTrue(ok)
+
+        # Hours within the worked hours, never on holidays or on missions
+        ts = GetTimesheetData(self.researcher.pk, 2023, 4)
+        internal = ts['projects'][-1]
+        self.assertTrue(min(internal['days']) > -0.001)
+        self.assertFalse(TimesheetHours.objects.filter(day__in=[datetime.date(2023, 4, 3), datetime.date(2023, 4, 25), datetime.date(2023, 4, 1)]).exists())
+
+        # Consistent months are skipped
+        self.assertEqual(allocate_timesheets(2023)[self.researcher.pk], {})
+
+
+class BatchPrintTest(ReportingTestData, TestCase):
+    def setUp(self):
+        self.create_data()
+
+    def test_jobs(self):
+        jobs = timesheet_print_jobs(year=2023)
+        self.assertEqual([(j[0], j[2], j[3], j[4]) for j in jobs], [('rossi-mario-2023.pdf', 2023, None, None)])
+
+        jobs = timesheet_print_jobs(period=self.rp)
+        self.assertEqual([(j[0], j[2], j[3], j[4]) for j in jobs], [('beta/rossi-mario-2023.pdf', 2023, [4], self.prj)])
+
+    def test_large_batch(self):
+        # Batches too large to be printed in the request are sent to a background job
+        self.client.force_login(User.objects.create(username='admin', is_superuser=True))
+        with tempfile.TemporaryDirectory() as tmp:
+            with override_settings(JOBS_ROOT=tmp, TIMESHEET_PRINT_INLINE_MAX=0):
+                response = self.client.get(reverse('timesheets_batch_print'), {'year': 2023})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual((response.json()['task'], response.json()['state']), ('Reporting.print_timesheets', Job.PENDING))
+
+
+class TimesheetPDFCacheTest(TestCase):
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = TimesheetPDFCache(tmp, max_size=2500)
+            context = {'month': 4, 'year': 2023, 'sign_day': datetime.date(2023, 5, 2), 'ts': {'days': [1.0, 2.0]}}
+            key = cache.key(context)
+            self.assertEqual(key, cache.key(dict(reversed(list(context.items())))))
+            self.assertNotEqual(key, cache.key(dict(context, month=5)))
+
+            self.assertIsNone(cache.get(key))
+            cache.put(key, b'a' * 1000)
+            self.assertEqual(cache.get(key), b'a' * 1000)
+
+            # Least recently used entries are evicted
+            cache.put('b' * 64, b'b' * 1000)
+            os.utime(cache.path('b' * 64), (0, 0))
+            cache.put('c' * 64, b'c' * 1000)
+            self.assertIsNone(cache.get('b' * 64))
+            self.assertIsNotNone(cache.get(key))
+
+            # The directory is scanned again only when the estimated size exceeds the maximum (the entries
+            # written by other processes are not seen before)
+            os.makedirs(os.path.dirname(cache.path('f' * 64)))
+            with open(cache.path('f' * 64), 'wb') as f:
+                f.write(b'f' * 1000)
+            cache.put('d' * 64, b'd' * 400)
+            self.assertEqual(sum([f.stat().st_size for d in os.scandir(tmp) for f in os.scandir(d.path)]), 3400)
+            cache.put('e' * 64, b'e' * 200)
+            self.assertLessEqual(sum([f.stat().st_size for d in os.scandir(tmp) for f in os.scandir(d.path)]), 2250)
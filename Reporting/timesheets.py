@@ -1,14 +1,24 @@
 import datetime
 import calendar
-
-from django.db.models import Q, F, Sum, Value, Subquery, OuterRef
-from django.db.models.functions import ExtractYear, ExtractMonth, Coalesce
-from .models import EpasCode, PresenceData, ReportedWork, ReportedMission, TimesheetHours
-from .utils import check_bank_holiday, get_workpackages_fractions
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Q, Sum, Value
+from django.db.models.functions import ExtractMonth, ExtractYear, Coalesce
+from Projects.models import Researcher, ResearcherRole, WorkPackage, ConflictOfInterest
+from .models import EpasCode, PresenceData, ReportedWork, ReportedWorkWorkpackage, ReportedMission, TimesheetHours, TimesheetStatus
+from .utils import get_workpackages_fractions_bulk
+from .summary import mark_reporting_summary
 from .utils import ReportingError
+from .workcalendar import get_year_calendar
 from Tags.templatetags import tr_month
 
 
+logger = logging.getLogger(__name__)
+
+
 # Structure of TS data for display/printing
 #
 # ts = {
@@ -95,500 +105,1010 @@ def round2first(value):
     return round(value * 10.0) / 10.0
 
 
-def CheckTimesheetData(rid, year, month):
-    """ Check that the TS data is consistent with the reported work and returns:
+def CheckReportedWork(work, fractions, ts_totals, missions):
+    """ Check that the TS data of a researcher-month is consistent with the reported work and returns:
      - ok: true if TS data is consistent
      - reported: true if month has anything reported
      - projects: projects IDs that have something reported in the month
+    Input data:
+     - work: list of (report pk, project name, project pk, hours) ordered by project name and period start
+     - fractions: dict report pk -> list of (reported WP pk, WP name, normalized fraction)
+     - ts_totals: dict report pk -> dict reported WP pk (None if not splitted) -> total TS hours in the month
+     - missions: list of (project name, project pk) of the reported missions
     """
-
-    # Get reported work
-    work = (
-        ReportedWork.objects
-        .filter(
-            researcher=rid,
-            year=year,
-            month=month,
-        )
-        .order_by(
-            'period__project__name',
-            'period__rp_start',
-        )
-    )
-
-    # Count reported missions
-    missions = (
-        ReportedMission.objects
-        .annotate(
-            year=ExtractYear('day__day'),
-            month=ExtractMonth('day__day'),
-        )
-        .filter(Q(day__researcher=rid) & Q(year=year) & Q(month=month))
-        .annotate(
-            project_id=F('period__project__id'),
-            project_name=F('period__project__name'),
-        )
-        .distinct()
-    )
-
-    # Get timesheet hours summary
-    ts_data_summary = (
-        TimesheetHours.objects
-        .annotate(
-            year=ExtractYear('day'),
-            month=ExtractMonth('day')
-        )
-        .filter(
-            Q(report__researcher=rid) &
-            Q(year=year) &
-            Q(month=month)
-        )
-        .order_by(
-            'report__period__project__name',
-            'report__period__rp_start',
-            'report_wp__workpackage__name',
-            'day',
-        )
-        .values('report', 'report_wp')
-        .annotate(total_hours=Coalesce(Sum('hours'), Value(0.0)))
-        .order_by()
-    )
-
     all_good = True
     projects_good = {}
 
     # Check that TS hours match reported work
-    for w in work:
-        pname = w.period.project.name
+    for pk, pname, ppk, hours in work:
         if pname not in projects_good:
-            projects_good[pname] = [True, w.period.project.pk]
+            projects_good[pname] = [True, ppk]
         elif not projects_good[pname][0]:
             # Skip incomplete project
             continue
 
-        # Get WPs
-        wps = get_workpackages_fractions(w)
-        f = list(filter(lambda x: x['report'] == w.pk, ts_data_summary))
-
-        if not len(f):
+        totals = ts_totals.get(pk, {})
+        if not len(totals):
             # Work reported but no TS data
             projects_good[pname][0] = False
             all_good = False
             continue
 
+        wps = fractions.get(pk, [])
         if wps:
             # Splitted on WPs
-            for wp in wps:
-                for ts in f:
-                    if ts['report_wp'] == wp['pk']:
-                        if abs(w.hours * wp['fraction'] - ts['total_hours']) > 0.01:
-                            print("TS hours does not match report. Project: {0:s}, Workpackage: {1:s} ({2:.1f} != {3:.1f})".format(w.period.project.name, wp['wp'], w.hours * wp['fraction'], ts['total_hours']))
-                            # Failed!
-                            projects_good[pname][0] = False
-                            all_good = False
-                        break
-                if not projects_good[pname][0]:
-                    # Check failed on a previous WP, skip the others
+            for wp_pk, wp_name, fraction in wps:
+                if wp_pk in totals and abs(hours * fraction - totals[wp_pk]) > 0.01:
+                    logger.debug("TS hours does not match report. Project: {0:s}, Workpackage: {1:s} ({2:.1f} != {3:.1f})".format(pname, wp_name, hours * fraction, totals[wp_pk]))
+                    # Failed! Skip the other WPs
+                    projects_good[pname][0] = False
+                    all_good = False
                     break
         else:
-            ts = f[0]
-            if abs(ts['total_hours'] - w.hours) > 0.01:
+            total = totals[None] if None in totals else next(iter(totals.values()))
+            if abs(total - hours) > 0.01:
                 projects_good[pname][0] = False
                 all_good = False
 
-    # We also need to check that we havent reported more hours in a day that worked hours
-    worked_and_reported_hours = (
-        PresenceData.objects
-        .annotate(
-            year=ExtractYear('day'),
-            month=ExtractMonth('day')
-        )
-        .filter(
-            Q(researcher=rid) &
-            Q(year=year) &
-            Q(month=month)
-        )
-        .order_by('day')
-        .annotate(
-            ts_hours=Coalesce(
-                Subquery(
-                    TimesheetHours.objects
-                    .filter(Q(report__researcher=rid) & Q(day=OuterRef('day')))
-                    .values('day')
-                    .annotate(tot_hours=Sum('hours'))
-                    .values('tot_hours')
-                ),
-                Value(0.0),
-            )
-        )
-    )
-
-    # If any day has more hours reported that worked, we return false but cannot link the error to a specific project
-    for day in worked_and_reported_hours:
-        # We need to approximate worked hours to one decimal digit
-        if abs(round2first(day.hours) - round2first(day.ts_hours)) < -0.01:
-            all_good = False
+    # NOTE: hours reported in excess of the worked hours of a single day are not checked here
 
     # Check missions
-    for m in missions:
-        if m.project_name not in projects_good:
-            projects_good[m.project_name] = [True, m.project_id]
+    for pname, ppk in missions:
+        if pname not in projects_good:
+            projects_good[pname] = [True, ppk]
 
-    # Everything matched!
     return (all_good, len(projects_good) > 0, projects_good)
 
 
-def GetTimesheetData(rid, year, month, project=None, generate=False):
-    """ Get timesheet data for the given researcher, year, month
-    Return timesheet data
-    Raise ReportingError on error
+def LoadTimesheetSummary(year, rid=None, months=None):
+    """ Load the data needed to check the TS data of a whole year (or of some months of it), for a researcher
+    or for all researchers at once, with a fixed number of grouped queries.
+    Return a tuple with:
+     - work: dict (rid, month) -> list of (report pk, project name, project pk, hours)
+     - fractions: dict report pk -> list of (reported WP pk, WP name, normalized fraction)
+     - ts_totals: dict report pk -> dict reported WP pk (None if not splitted) -> total TS hours in the month
+     - missions: dict (rid, month) -> list of (project name, project pk)
     """
-
-    # If we are not generating and the data is not consistent return
-    ok, reported, projects = CheckTimesheetData(rid, year, month)
-    if not ok and not generate:
-        raise ReportingError(f"Timesheet data for RID {rid} for {tr_month.month_num2en(month)} {year} is not consistent")
-
-    if not generate and (not reported or (project is not None and project.name not in projects)):
-        raise ReportingError(f"Nothing to report for RID {rid} for {tr_month.month_num2en(month)} {year}.")
-
-    if generate and project is not None:
-        raise ReportingError(f"Generation cannot be done for a single project")
-
-    # Get reported work
+    # Reported work
+    work = ReportedWork.objects.filter(year=year)
+    if rid is not None:
+        work = work.filter(researcher=rid)
+    if months is not None:
+        work = work.filter(month__in=months)
     work = (
-        ReportedWork.objects
-        .filter(
-            researcher=rid,
-            year=year,
-            month=month,
-        )
+        work
         .order_by(
             'period__project__name',
             'period__rp_start',
         )
+        .values_list('pk', 'researcher', 'month', 'period__project__name', 'period__project', 'hours')
+    )
+    work_by_month = {}
+    reports = {}
+    for pk, r, month, pname, ppk, hours in work:
+        work_by_month.setdefault((r, month), []).append((pk, pname, ppk, hours))
+        reports[pk] = month
+
+    # Split over workpackages (zero fractions are ignored)
+    fractions = {}
+    wps = ReportedWorkWorkpackage.objects.filter(~Q(fraction=0)).filter(report__year=year)
+    if rid is not None:
+        wps = wps.filter(report__researcher=rid)
+    if months is not None:
+        wps = wps.filter(report__month__in=months)
+    wps = wps.order_by('workpackage__name').values_list('report', 'pk', 'workpackage__name', 'fraction')
+    for report, pk, name, fraction in wps:
+        fractions.setdefault(report, []).append([pk, name, fraction])
+    for report, v in fractions.items():
+        total = sum([wp[2] for wp in v])
+        fractions[report] = [(pk, name, fraction / total) for pk, name, fraction in v]
+
+    # Timesheet hours summary by report, reported WP and month
+    ts_data_summary = TimesheetHours.objects.for_year(year, months)
+    if rid is not None:
+        ts_data_summary = ts_data_summary.filter(report__researcher=rid)
+    if months is not None:
+        ts_data_summary = ts_data_summary.filter(report__month__in=months)
+    ts_data_summary = (
+        ts_data_summary
+        .annotate(month=ExtractMonth('day'))
+        .values('report', 'report_wp', 'month')
+        .annotate(total_hours=Coalesce(Sum('hours'), Value(0.0)))
+        .order_by()
+    )
+    ts_totals = {}
+    for ts in ts_data_summary:
+        # Only hours in the month of the report are taken into account
+        if reports.get(ts['report']) == ts['month']:
+            ts_totals.setdefault(ts['report'], {})[ts['report_wp']] = ts['total_hours']
+
+    # Projects with reported missions
+    missions = ReportedMission.objects.for_year(year, months)
+    if rid is not None:
+        missions = missions.filter(day__researcher=rid)
+    missions = (
+        missions
+        .annotate(month=ExtractMonth('day__day'))
+        .values_list('day__researcher', 'month', 'period__project__name', 'period__project')
+        .order_by()
+        .distinct()
     )
+    missions_by_month = {}
+    for r, month, pname, ppk in missions:
+        missions_by_month.setdefault((r, month), []).append((pname, ppk))
 
-    # If project is set filter on it
-    if project is not None:
-        work = work.filter(Q(period__project=project))
+    return (work_by_month, fractions, ts_totals, missions_by_month)
 
-    # Get timesheet hours
-    ts_data = (
-        TimesheetHours.objects
-        .annotate(
-            year=ExtractYear('day'),
-            month=ExtractMonth('day'),
-        )
-        .filter(
-            Q(report__researcher=rid) &
-            Q(year=year) &
-            Q(month=month)
-        )
-        .order_by(
-            'report__period__project__name',
-            'report__period__rp_start',
-            'report_wp__workpackage__name',
-            'day',
-        )
-    )
 
-    # Get presences
+def CheckTimesheetYear(year, rid=None):
+    """ Check the consistency of the TS data for a whole year, for a researcher or for all researchers at once
+    The data is loaded with a fixed number of grouped queries and checked in memory.
+    Return a dictionary rid -> month -> (ok, reported, projects) as returned by CheckTimesheetData.
+    Researchers with nothing reported in the year are not included.
+    """
+    work, fractions, ts_totals, missions = LoadTimesheetSummary(year, rid)
+
+    out = {}
+    for r, month in set(work.keys()) | set(missions.keys()):
+        if r not in out:
+            out[r] = {m: (True, False, {}) for m in range(1, 13)}
+        out[r][month] = CheckReportedWork(work.get((r, month), []), fractions, ts_totals, missions.get((r, month), []))
+
+    return out
+
+
+def UpdateTimesheetStatus(year, rid=None, months=None):
+    """ Recompute the TimesheetStatus rows of a year (or of some months of it), for a researcher or for
+    all researchers at once. Rows of researcher-months with nothing reported are removed.
+    """
+    work, fractions, ts_totals, missions = LoadTimesheetSummary(year, rid, months)
+
+    # Worked hours by researcher and month
+    presences = PresenceData.objects.for_year(year, months)
+    if rid is not None:
+        presences = presences.filter(researcher=rid)
     presences = (
-        PresenceData.objects
-        .filter(researcher=rid)
-        .annotate(
-            year=ExtractYear('day'),
-            month=ExtractMonth('day'),
-        )
-        .filter(
-            Q(year=year) &
-            Q(month=month)
-        )
-        .order_by('day')
+        presences
+        .annotate(month=ExtractMonth('day'))
+        .values_list('researcher', 'month')
+        .annotate(total_hours=Coalesce(Sum('hours'), Value(0.0)))
+        .order_by()
     )
+    presence_hours = {(r, month): hours for r, month, hours in presences}
+
+    status = []
+    for r, month in set(work.keys()) | set(missions.keys()):
+        ok, reported, projects = CheckReportedWork(work.get((r, month), []), fractions, ts_totals, missions.get((r, month), []))
+        hours = {}
+        for pk, pname, ppk, h in work.get((r, month), []):
+            rh, th = hours.get(ppk, (0.0, 0.0))
+            hours[ppk] = (rh + h, th + sum(ts_totals.get(pk, {}).values()))
+        for pname, (project_ok, ppk) in projects.items():
+            rh, th = hours.get(ppk, (0.0, 0.0))
+            status.append(TimesheetStatus(
+                researcher_id=r,
+                year=year,
+                month=month,
+                project_id=ppk,
+                reported_hours=rh,
+                ts_hours=th,
+                presence_hours=presence_hours.get((r, month), 0.0),
+                ok=project_ok,
+            ))
+
+    # Replace old rows
+    old = TimesheetStatus.objects.filter(year=year)
+    if rid is not None:
+        old = old.filter(researcher=rid)
+    if months is not None:
+        old = old.filter(month__in=months)
+    with transaction.atomic():
+        old.delete()
+        TimesheetStatus.objects.bulk_create(status)
+
+
+def TimesheetYears():
+    """ Years with reported work or missions
+    """
+    years = set(ReportedWork.objects.order_by().values_list('year', flat=True).distinct())
+    years |= set(
+        ReportedMission.objects
+        .annotate(year=ExtractYear('day__day'))
+        .order_by()
+        .values_list('year', flat=True)
+        .distinct()
+    )
+    return years
 
-    # Initialize data
-    data = {}
-    ndays = calendar.monthrange(year, month)[1]
-    data['numdays'] = ndays
-    data['days'] = []
-    data['projects'] = []
-    data['grand_total'] = 0.0
-    data['ok'] = ok
-
-    # Setup days and holiday tag
-    for d in range(1, ndays + 1, 1):
-        date = datetime.date(year=year, month=month, day=d)
-
-        we = False
-        # Check Saturday and Sunday
-        if date.weekday() > 4:
-            we = True
-
-        # Check bank holiday
-        bh = False
-        if check_bank_holiday(date):
-            bh = True
-
-        # Append day with holiday tag, mission tag, absence code and total hours
-        data['days'].append({
-            'n': d,
-            'holiday': we | bh,
-            'mission': False,
-            'code': "PH" if bh else "",
-            'total': 0.0,
-        })
 
-    # Process presences
-    available_hours = [0.0 for i in range(ndays)]
-    for p in presences:
-        # Day index
-        d = p.day.day - 1
-
-        # Store hours (only for working days)
-        if p.hours > 0 and p.ts_code is None or p.ts_code == EpasCode.NONE:
-            h = round2first(p.hours)
-            data['days'][d]['total'] = h
-            available_hours[d] = h
-
-        # Set mission flag
-        if p.ts_code == EpasCode.MISSION:
-            data['days'][d]['mission'] = True
-
-        # Store absence code
-        if p.ts_code == EpasCode.ILLNESS:
-            data['days'][d]['code'] = "IL"
-        elif data['days'][d]['code'] != "PH":
-            if p.ts_code == EpasCode.MISSION:
-                data['days'][d]['code'] = "BT"
-            elif p.ts_code == EpasCode.HOLIDAYS:
-                data['days'][d]['code'] = "AH"
-
-    # Add projects
-    p_names = []
-    for w in work:
-        name = w.period.project.name
-        if name not in p_names:
-            # First time we got the project. Create new.
-            p_names.append(name)
-
-            new_p = {}
-            new_p['id'] = w.period.project.pk           # Project ID
-            new_p['name'] = name                        # Project name
-            new_p['ref'] = w.period.project.reference   # Project reference
-            new_p['pi_id'] = w.period.project.pi.pk if w.period.project.pi is not None else None    # Project PI
-            new_p['days'] = [0.0 for i in range(ndays)]
-            new_p['total'] = 0.0
-            new_p['sum'] = 0.0
-            new_p['has_wps'] = False                    # Set has_wps False by default
-            data['projects'].append(new_p)
+def EnsureTimesheetStatus(years=None):
+    """ Compute the TimesheetStatus rows of the years (all the years with reported work or missions if None)
+    that are not in the table yet, e.g. right after the migration that created the table.
+    Return the list of years computed.
+    """
+    reported = TimesheetYears() if years is None else None
+    if years is None:
+        years = reported
+    computed = set(TimesheetStatus.objects.filter(year__in=years).order_by().values_list('year', flat=True).distinct())
+    missing = set(years) - computed
+    if len(missing) and reported is None:
+        # Years without reported work or missions have no rows
+        missing &= TimesheetYears()
+    missing = sorted(missing)
+    for year in missing:
+        UpdateTimesheetStatus(year)
+    return missing
+
+
+def GetTimesheetStatus(year, rid=None):
+    """ Read the status of the timesheets of a year from the TimesheetStatus table (the year is computed
+    first if missing from the table)
+    Return the same structure of CheckTimesheetYear
+    """
+    EnsureTimesheetStatus([year])
+    status = TimesheetStatus.objects.filter(year=year)
+    if rid is not None:
+        status = status.filter(researcher=rid)
+    status = (
+        status
+        .order_by('project__name')
+        .values_list('researcher', 'month', 'project__name', 'project', 'ok')
+    )
+    out = {}
+    for r, month, pname, ppk, ok in status:
+        if r not in out:
+            out[r] = {m: [True, False, {}] for m in range(1, 13)}
+        out[r][month][0] &= ok
+        out[r][month][1] = True
+        out[r][month][2][pname] = [ok, ppk]
+
+    return {r: {m: tuple(v) for m, v in months.items()} for r, months in out.items()}
+
+
+class TimesheetStatusTracker(object):
+    """ Collect the researcher-months whose TimesheetStatus and ReportingSummary should be refreshed (see
+    signals.py) and, once the current transaction is committed, refresh their TimesheetStatus and mark
+    their ReportingSummary as pending. Each researcher-month is handled only once, even if many of its
+    rows were changed.
+    """
 
-        else:
-            # Project already created. We get it from the list
-            new_p = data['projects'][p_names.index(name)]
-
-        # Get report workpackages
-        wps = get_workpackages_fractions(w)
-        if len(wps):
-            # Project has WPs
-            new_p['has_wps'] = True   # Period has split over WPs
-            if 'wps' not in new_p:
-                # Add WP list if not present
-                new_p['wps'] = []
-
-            for wp in wps:
-                # Cycle over WPs
-
-                # First check if we already have the WP
-                for new_wp in new_p['wps']:
-                    if new_wp['id'] == wp['wp_pk']:
-                        break
-                else:
-                    # New workpackage
-                    new_wp = {}
-                    new_wp['id'] = wp['wp_pk']   # WP ID to check for duplicates
-                    new_wp['name'] = wp['wp']    # WP name
-                    new_wp['desc'] = wp['desc']  # WP description
-                    new_wp['days'] = [0.0 for i in range(ndays)]
-                    new_wp['last'] = False       # Set by default as 'not the last' (NB: needed for rendering...)
-                    new_wp['total'] = 0.0
-                    new_wp['sum'] = 0.0
-                    new_p['wps'].append(new_wp)  # Append WP
+    def __init__(self):
+        self.local = threading.local()
+
+    def _pending(self):
+        scheduled = getattr(self.local, 'scheduled', None)
+        if scheduled is not None and not any([func is scheduled for sids, func, robust in transaction.get_connection().run_on_commit]):
+            # The callback was dropped, as the transaction that scheduled it was rolled back: discard its marks
+            self.local.pending = None
+            self.local.scheduled = None
+        if getattr(self.local, 'pending', None) is None:
+            self.local.pending = {'keys': set(), 'reports': set(), 'presences': set()}
+        return self.local.pending
+
+    def _schedule(self):
+        # The flush is registered once for each transaction
+        if getattr(self.local, 'deferred', 0) or getattr(self.local, 'scheduled', None) is not None:
+            return
+
+        def callback():
+            self.flush()
+
+        self.local.scheduled = callback
+        transaction.on_commit(callback)
+
+    def mark(self, rid, year, month):
+        """ Mark a researcher-month
+        """
+        self._pending()['keys'].add((rid, year, month))
+        self._schedule()
+
+    def mark_report(self, report):
+        """ Mark the researcher-month of a reported work (resolved when flushing)
+        """
+        self._pending()['reports'].add(report)
+        self._schedule()
+
+    def mark_presence(self, presence):
+        """ Mark the researcher-month of a presence (resolved when flushing)
+        """
+        self._pending()['presences'].add(presence)
+        self._schedule()
+
+    @contextmanager
+    def deferred(self):
+        """ Postpone the refresh to the end of the block (to be used when saving many rows outside of a transaction)
+        """
+        self.local.deferred = getattr(self.local, 'deferred', 0) + 1
+        try:
+            yield
+        finally:
+            self.local.deferred -= 1
+            if getattr(self.local, 'pending', None) is not None:
+                self._schedule()
+
+    def flush(self):
+        """ Refresh the marked researcher-months
+        """
+        pending = getattr(self.local, 'pending', None)
+        self.local.pending = None
+        self.local.scheduled = None
+        if pending is None:
+            return
+
+        keys = pending['keys']
+        if len(pending['reports']):
+            keys |= set(
+                ReportedWork.objects
+                .filter(pk__in=pending['reports'])
+                .values_list('researcher', 'year', 'month')
+            )
+        if len(pending['presences']):
+            keys |= set([
+                (r, day.year, day.month)
+                for r, day in PresenceData.objects.filter(pk__in=pending['presences']).values_list('researcher', 'day')
+            ])
 
-                # Add total hours
-                new_wp['total'] += wp['hours']
-                new_p['total'] += wp['hours']
+        # Group months by researcher and year
+        groups = {}
+        for r, year, month in keys:
+            groups.setdefault((r, year), set()).add(month)
 
-                # Filter already saved TS data
-                ts = ts_data.filter(Q(report=w) & Q(report_wp__workpackage__pk=new_wp['id']))
+        for (r, year), months in groups.items():
+            try:
+                UpdateTimesheetStatus(year, r, sorted(months))
+            except Exception as e:
+                logger.error("Failed to update timesheet status for RID {0!s}, year {1:d} (Error: {2!s})".format(r, year, e))
 
-                # Store saved hours if any
-                for d in ts:
-                    # Add hours
-                    new_wp['days'][d.day.day-1] += d.hours
-                    new_p['days'][d.day.day-1] += d.hours
-                    new_wp['sum'] += d.hours
-                    new_p['sum'] += d.hours
-                    # Subtract from available hours
-                    available_hours[d.day.day-1] -= d.hours
+        # The reporting summary is refreshed when read
+        try:
+            mark_reporting_summary(keys)
+        except Exception as e:
+            logger.error("Failed to mark reporting summary as pending (Error: {0!s})".format(e))
 
-        else:
-            # Add total hours
-            new_p['total'] += w.hours
-
-            # Filter already saved TS data
-            ts = ts_data.filter(report=w, report_wp=None)
-
-            # Store saved hours if any
-            for d in ts:
-                h = d.hours
-                # Add hours
-                new_p['days'][d.day.day-1] += h
-                new_p['sum'] += h
-                # Subtract from available hours
-                available_hours[d.day.day-1] -= h
-
-    # Tag last WP in all projects
-    for prj in data['projects']:
-        if 'wps' in prj:
-            # Tag last WP
-            prj['wps'][-1]['last'] = True
-
-    # Add reported missions
-    rep_m = (
-        ReportedMission.objects
-        .filter(Q(day__researcher=rid))
-        .annotate(
-            year=ExtractYear('day__day'),
-            month=ExtractMonth('day__day')
+
+status_tracker = TimesheetStatusTracker()
+
+
+class TimesheetDataLoader(object):
+    """ Load all the data needed to check and assemble the timesheets of a researcher for a set of months
+    of the same year. The data is fetched with a fixed number of queries (independent of the number of
+    projects, workpackages and missions) and then indexed in memory by month.
+    """
+
+    def __init__(self, rid, year, months=None):
+        self.rid = rid
+        self.year = year
+        self.months = sorted(months) if months is not None else list(range(1, 13))
+
+        # Reported work
+        self.work = {m: [] for m in self.months}
+        work = (
+            ReportedWork.objects
+            .filter(
+                researcher=rid,
+                year=year,
+                month__in=self.months,
+            )
+            .select_related('period__project')
+            .order_by(
+                'period__project__name',
+                'period__rp_start',
+            )
         )
-        .filter(year=year, month=month)
-        .order_by(
-            'period__project__name',
-            'period__rp_start',
-            'day__day',
+        for w in work:
+            self.work[w.month].append(w)
+        reports = [w for v in self.work.values() for w in v]
+
+        # Split of reported work over workpackages
+        self.fractions = get_workpackages_fractions_bulk(reports)
+
+        # Timesheet hours, indexed by report
+        self.ts_hours = {w.pk: [] for w in reports}
+        ts_hours = (
+            TimesheetHours.objects
+            .for_year(year, self.months)
+            .filter(report__researcher=rid)
+            .order_by('day')
+            .values_list('report', 'report_wp', 'report_wp__workpackage', 'day', 'hours')
         )
-    )
+        for report, report_wp, wp, day, hours in ts_hours:
+            if report in self.ts_hours:
+                self.ts_hours[report].append((report_wp, wp, day, hours))
+
+        # Presences
+        self.presences = {m: [] for m in self.months}
+        presences = (
+            PresenceData.objects
+            .for_year(year, self.months)
+            .filter(researcher=rid)
+            .order_by('day')
+            .values_list('day', 'hours', 'ts_code')
+        )
+        for day, hours, ts_code in presences:
+            if day.month in self.presences:
+                self.presences[day.month].append((day, hours, ts_code))
+
+        # Reported missions
+        self.missions = {m: [] for m in self.months}
+        missions = (
+            ReportedMission.objects
+            .for_year(year, self.months)
+            .filter(day__researcher=rid)
+            .select_related('period__project', 'workpackage', 'day')
+            .order_by(
+                'period__project__name',
+                'period__rp_start',
+                'day__day',
+            )
+        )
+        for m in missions:
+            if m.day.day.month in self.missions:
+                self.missions[m.day.day.month].append(m)
+
+        # Projects with WPs among the ones with reported missions
+        mission_projects = set([m.period.project_id for v in self.missions.values() for m in v])
+        if len(mission_projects):
+            self.projects_with_wps = set(
+                WorkPackage.objects
+                .filter(project__in=mission_projects)
+                .values_list('project', flat=True)
+                .distinct()
+            )
+        else:
+            self.projects_with_wps = set()
+
+        # Working days calendar
+        self.calendar = get_year_calendar(year)
+
+    def check(self, month):
+        """ Check that the TS data is consistent with the reported work (see CheckReportedWork)
+        """
+        work = [(w.pk, w.period.project.name, w.period.project.pk, w.hours) for w in self.work[month]]
+        fractions = {w[0]: [(wp['pk'], wp['wp'], wp['fraction']) for wp in self.fractions[w[0]]] for w in work}
+        ts_totals = {}
+        for w in work:
+            ts_totals[w[0]] = {}
+            for report_wp, wp, day, hours in self.ts_hours[w[0]]:
+                ts_totals[w[0]][report_wp] = ts_totals[w[0]].get(report_wp, 0.0) + hours
+        missions = [(m.period.project.name, m.period.project.pk) for m in self.missions[month]]
+        return CheckReportedWork(work, fractions, ts_totals, missions)
+
+    def get(self, month, project=None, generate=False):
+        """ Assemble timesheet data for the given month
+        Return timesheet data
+        Raise ReportingError on error
+        """
+        # If we are not generating and the data is not consistent return
+        ok, reported, projects = self.check(month)
+        if not ok and not generate:
+            raise ReportingError(f"Timesheet data for RID {self.rid} for {tr_month.month_num2en(month)} {self.year} is not consistent")
+
+        if not generate and (not reported or (project is not None and project.name not in projects)):
+            raise ReportingError(f"Nothing to report for RID {self.rid} for {tr_month.month_num2en(month)} {self.year}.")
+
+        if generate and project is not None:
+            raise ReportingError(f"Generation cannot be done for a single project")
+
+        year = self.year
+
+        # Reported work (filtered on project if needed)
+        work = self.work[month]
+        if project is not None:
+            work = [w for w in work if w.period.project_id == project.pk]
+
+        # Initialize data
+        data = {}
+        ndays = calendar.monthrange(year, month)[1]
+        data['numdays'] = ndays
+        data['days'] = []
+        data['projects'] = []
+        data['grand_total'] = 0.0
+        data['ok'] = ok
+
+        # Setup days and holiday tag
+        month_range = self.calendar.range(datetime.date(year, month, 1), datetime.date(year, month, ndays))
+        weekends = self.calendar.weekend[month_range]
+        bank_holidays = self.calendar.bank_holiday[month_range]
+        for d in range(1, ndays + 1, 1):
+            we = bool(weekends[d - 1])
+            bh = bool(bank_holidays[d - 1])
+
+            # Append day with holiday tag, mission tag, absence code and total hours
+            data['days'].append({
+                'n': d,
+                'holiday': we | bh,
+                'mission': False,
+                'code': "PH" if bh else "",
+                'total': 0.0,
+            })
+
+        # Process presences
+        available_hours = [0.0 for i in range(ndays)]
+        for day, hours, ts_code in self.presences[month]:
+            # Day index
+            d = day.day - 1
+
+            # Store hours (only for working days)
+            if hours > 0 and ts_code is None or ts_code == EpasCode.NONE:
+                h = round2first(hours)
+                data['days'][d]['total'] = h
+                available_hours[d] = h
+
+            # Set mission flag
+            if ts_code == EpasCode.MISSION:
+                data['days'][d]['mission'] = True
+
+            # Store absence code
+            if ts_code == EpasCode.ILLNESS:
+                data['days'][d]['code'] = "IL"
+            elif data['days'][d]['code'] != "PH":
+                if ts_code == EpasCode.MISSION:
+                    data['days'][d]['code'] = "BT"
+                elif ts_code == EpasCode.HOLIDAYS:
+                    data['days'][d]['code'] = "AH"
+
+        # Add projects
+        p_names = []
+        for w in work:
+            name = w.period.project.name
+            if name not in p_names:
+                # First time we got the project. Create new.
+                p_names.append(name)
+
+                new_p = {}
+                new_p['id'] = w.period.project.pk           # Project ID
+                new_p['name'] = name                        # Project name
+                new_p['ref'] = w.period.project.reference   # Project reference
+                new_p['pi_id'] = w.period.project.pi_id     # Project PI
+                new_p['days'] = [0.0 for i in range(ndays)]
+                new_p['total'] = 0.0
+                new_p['sum'] = 0.0
+                new_p['has_wps'] = False                    # Set has_wps False by default
+                data['projects'].append(new_p)
 
-    # If project is set filter on it
-    if project is not None:
-        rep_m = rep_m.filter(Q(period__project=project))
-
-    q = Q()  # Query used later to select business travels not reported
-    for m in rep_m:
-        # Add day to query
-        q |= Q(day=m.day.day)
-        pname = m.period.project.name
-        if pname not in p_names:
-            # Project has only business travels. We have to add it
-            new_p = {}
-            new_p['id'] = m.period.project.pk           # Project ID
-            new_p['name'] = pname                       # Project name
-            new_p['ref'] = m.period.project.reference   # Project reference
-            new_p['pi_id'] = m.period.project.pi.pk if m.period.project.pi is not None else None     # Project PI
-            if m.period.project.workpackage_set.all().count() > 0:
-                new_p['has_wps'] = True   # Project has WPs
-                new_p['wps'] = []
             else:
-                new_p['has_wps'] = False
-            new_p['days'] = [0.0 for i in range(ndays)]
-            new_p['sum'] = 0.0
-            new_p['total'] = 0.0
-
-            # Insert project in the right place
-            if len(p_names):
-                for i, p in enumerate(p_names):
-                    if pname > p:
+                # Project already created. We get it from the list
+                new_p = data['projects'][p_names.index(name)]
+
+            # Get report workpackages
+            wps = self.fractions[w.pk]
+            if len(wps):
+                # Project has WPs
+                new_p['has_wps'] = True   # Period has split over WPs
+                if 'wps' not in new_p:
+                    # Add WP list if not present
+                    new_p['wps'] = []
+
+                for wp in wps:
+                    # Cycle over WPs
+
+                    # First check if we already have the WP
+                    for new_wp in new_p['wps']:
+                        if new_wp['id'] == wp['wp_pk']:
+                            break
+                    else:
+                        # New workpackage
+                        new_wp = {}
+                        new_wp['id'] = wp['wp_pk']   # WP ID to check for duplicates
+                        new_wp['name'] = wp['wp']    # WP name
+                        new_wp['desc'] = wp['desc']  # WP description
+                        new_wp['days'] = [0.0 for i in range(ndays)]
+                        new_wp['last'] = False       # Set by default as 'not the last' (NB: needed for rendering...)
+                        new_wp['total'] = 0.0
+                        new_wp['sum'] = 0.0
+                        new_p['wps'].append(new_wp)  # Append WP
+
+                    # Add total hours
+                    new_wp['total'] += wp['hours']
+                    new_p['total'] += wp['hours']
+
+                    # Store saved hours if any
+                    for report_wp, wp_pk, day, h in self.ts_hours[w.pk]:
+                        if wp_pk != new_wp['id']:
+                            continue
+                        # Add hours
+                        new_wp['days'][day.day-1] += h
+                        new_p['days'][day.day-1] += h
+                        new_wp['sum'] += h
+                        new_p['sum'] += h
+                        # Subtract from available hours
+                        available_hours[day.day-1] -= h
+
+            else:
+                # Add total hours
+                new_p['total'] += w.hours
+
+                # Store saved hours if any
+                for report_wp, wp_pk, day, h in self.ts_hours[w.pk]:
+                    if report_wp is not None:
                         continue
+                    # Add hours
+                    new_p['days'][day.day-1] += h
+                    new_p['sum'] += h
+                    # Subtract from available hours
+                    available_hours[day.day-1] -= h
+
+        # Tag last WP in all projects
+        for prj in data['projects']:
+            if 'wps' in prj:
+                # Tag last WP
+                prj['wps'][-1]['last'] = True
+
+        # Add reported missions (filtered on project if needed)
+        rep_m = self.missions[month]
+        if project is not None:
+            rep_m = [m for m in rep_m if m.period.project_id == project.pk]
+
+        reported_days = set()  # Days used later to select business travels not reported
+        for m in rep_m:
+            # Add day to reported days
+            reported_days.add(m.day.day)
+            pname = m.period.project.name
+            if pname not in p_names:
+                # Project has only business travels. We have to add it
+                new_p = {}
+                new_p['id'] = m.period.project.pk           # Project ID
+                new_p['name'] = pname                       # Project name
+                new_p['ref'] = m.period.project.reference   # Project reference
+                new_p['pi_id'] = m.period.project.pi_id     # Project PI
+                if m.period.project.pk in self.projects_with_wps:
+                    new_p['has_wps'] = True   # Project has WPs
+                    new_p['wps'] = []
+                else:
+                    new_p['has_wps'] = False
+                new_p['days'] = [0.0 for i in range(ndays)]
+                new_p['sum'] = 0.0
+                new_p['total'] = 0.0
+
+                # Insert project in the right place
+                if len(p_names):
+                    for i, p in enumerate(p_names):
+                        if pname > p:
+                            continue
+                        else:
+                            p_names.insert(i, pname)
+                            data['projects'].insert(i, new_p)
+                            break
                     else:
-                        p_names.insert(i, pname)
-                        data['projects'].insert(i, new_p)
-                        break
+                        p_names.append(pname)
+                        data['projects'].append(new_p)
                 else:
                     p_names.append(pname)
                     data['projects'].append(new_p)
-            else:
-                p_names.append(pname)
-                data['projects'].append(new_p)
 
-        mh = m.day.hours
-        if m.workpackage is not None:
-            wid = m.workpackage.pk
-            for wp in data['projects'][p_names.index(pname)]['wps']:
-                if wp['id'] == wid:
-                    break
-            else:
-                # WP not found! There are no hours reported on this WP, we have to add it
-                wp = {}
-                wp['id'] = wid                   # WP ID to check for duplicates
-                wp['name'] = m.workpackage.name  # WP name
-                wp['desc'] = m.workpackage.desc  # WP description
-                wp['days'] = [0.0 for i in range(ndays)]
-                wp['last'] = False       # Set by default as 'not the last'
-                wp['total'] = 0.0
-                wp['sum'] = 0.0
-
-                # Insert WP in the right place
-                if len(data['projects'][p_names.index(pname)]['wps']):
-                    for i, old_wp in enumerate(data['projects'][p_names.index(pname)]['wps']):
-                        if wp['name'] > old_wp['name']:
-                            continue
+            mh = m.day.hours
+            if m.workpackage is not None:
+                wid = m.workpackage.pk
+                for wp in data['projects'][p_names.index(pname)]['wps']:
+                    if wp['id'] == wid:
+                        break
+                else:
+                    # WP not found! There are no hours reported on this WP, we have to add it
+                    wp = {}
+                    wp['id'] = wid                   # WP ID to check for duplicates
+                    wp['name'] = m.workpackage.name  # WP name
+                    wp['desc'] = m.workpackage.desc  # WP description
+                    wp['days'] = [0.0 for i in range(ndays)]
+                    wp['last'] = False       # Set by default as 'not the last'
+                    wp['total'] = 0.0
+                    wp['sum'] = 0.0
+
+                    # Insert WP in the right place
+                    if len(data['projects'][p_names.index(pname)]['wps']):
+                        for i, old_wp in enumerate(data['projects'][p_names.index(pname)]['wps']):
+                            if wp['name'] > old_wp['name']:
+                                continue
+                            else:
+                                data['projects'][p_names.index(pname)]['wps'].insert(i, wp)
+                                break
                         else:
-                            data['projects'][p_names.index(pname)]['wps'].insert(i, wp)
-                            break
+                            data['projects'][p_names.index(pname)]['wps'].append(wp)
                     else:
                         data['projects'][p_names.index(pname)]['wps'].append(wp)
+
+                # Add business travel to WP
+                wp['days'][m.day.day.day - 1] = mh
+                # Update WP total
+                wp['total'] += mh
+                wp['sum'] += mh
+                # Update project day
+                data['projects'][p_names.index(pname)]['days'][m.day.day.day - 1] = mh
+                # Update project total
+                data['projects'][p_names.index(pname)]['total'] += mh
+                data['projects'][p_names.index(pname)]['sum'] += mh
+
+            else:
+                # Add business travel to project
+                data['projects'][p_names.index(pname)]['days'][m.day.day.day - 1] = mh
+                data['projects'][p_names.index(pname)]['total'] += mh
+                data['projects'][p_names.index(pname)]['sum'] += mh
+
+            # Update day total
+            data['days'][m.day.day.day - 1]['total'] += mh
+
+        # Add internal activities
+        internal = {
+            'name': 'Internal activities',
+            'ref': '',
+            'id': -1,
+            'has_wps': False,
+            'days': available_hours,
+            'total': sum(available_hours),
+        }
+
+        # Add business travels not assigned to any period
+        for day, hours, ts_code in self.presences[month]:
+            if ts_code != EpasCode.MISSION or not hours > 0 or day in reported_days:
+                continue
+            # Add business travel
+            internal['days'][day.day - 1] = hours
+            # Update internal activities total
+            internal['total'] += hours
+            # Update day total
+            data['days'][day.day - 1]['total'] += hours
+
+        # Add internal activities as last project
+        data['projects'].append(internal)
+
+        # Compute grand total
+        for d in data['days']:
+            data['grand_total'] += d['total']
+
+        return data
+
+
+def CheckTimesheetData(rid, year, month):
+    """ Check that the TS data is consistent with the reported work and returns:
+     - ok: true if TS data is consistent
+     - reported: true if month has anything reported
+     - projects: projects IDs that have something reported in the month
+    """
+    return TimesheetDataLoader(rid, year, [month, ]).check(month)
+
+
+def GetTimesheetData(rid, year, month, project=None, generate=False):
+    """ Get timesheet data for the given researcher, year, month
+    Return timesheet data
+    Raise ReportingError on error
+    """
+    return TimesheetDataLoader(rid, year, [month, ]).get(month, project, generate)
+
+
+def SaveTimesheetData(rid, year, month, projects, workpackages):
+    """ Save the TS hours of a month for the given researcher
+    Input data:
+     - projects: dict project pk -> dict day (date) -> hours, for projects not splitted on WPs
+     - workpackages: dict WP pk -> dict day (date) -> hours
+    Only the given projects and WPs are modified: their days not included in the data are deleted.
+    The existing rows are loaded once and the changes are applied in bulk in a single transaction, with
+    the reported work of the month locked to serialize concurrent saves.
+    Return a tuple with the number of (created, updated, deleted) rows
+    Raise ReportingError on error (nothing is saved)
+    """
+    with transaction.atomic():
+        # Reported work of the month
+        reports = list(
+            ReportedWork.objects
+            .select_for_update(of=('self', ))
+            .filter(
+                Q(researcher=rid) &
+                Q(year=year) &
+                Q(month=month)
+            )
+            .select_related('period')
+            .order_by()
+        )
+        report_wps = dict([
+            ((report, wp), pk)
+            for pk, report, wp in ReportedWorkWorkpackage.objects.filter(report__in=reports).order_by().values_list('pk', 'report', 'workpackage')
+        ])
+
+        # Projects of workpackages
+        wp_projects = dict(WorkPackage.objects.filter(pk__in=list(workpackages.keys())).order_by().values_list('pk', 'project'))
+        for wid in workpackages.keys():
+            if wid not in wp_projects:
+                raise ReportingError("Failed to retrieve workpackage with ID {0:d}".format(wid))
+
+        # Existing TS hours of the month, indexed by project and by WP
+        existing = (
+            TimesheetHours.objects
+            .for_month(year, month)
+            .filter(report__researcher=rid)
+            .select_related('report__period', 'report_wp')
+        )
+        by_project = {}
+        by_wp = {}
+        for ts in existing:
+            by_project.setdefault(ts.report.period.project_id, {}).setdefault(ts.day, []).append(ts)
+            if ts.report_wp is not None:
+                by_wp.setdefault(ts.report_wp.workpackage_id, {}).setdefault(ts.day, []).append(ts)
+
+        def get_report(pid, day):
+            found = [r for r in reports if r.period.project_id == pid and r.period.rp_start <= day and r.period.rp_end >= day]
+            if len(found) == 0:
+                raise ReportingError("Cannot find corresponding reported work for project ID {0:d}, day {1!s}".format(pid, day))
+            if len(found) > 1:
+                raise ReportingError("Found more than one corresponding reported work for project ID {0:d}, day {1!s}".format(pid, day))
+            return found[0]
+
+        to_create = []
+        to_update = []
+        to_delete = []
+
+        def diff(rows, hours, name, create):
+            # Compare the existing rows of a project/WP with the submitted hours
+            for day, h in hours.items():
+                old = rows.get(day, [])
+                if len(old) > 1:
+                    raise ReportingError("Got multiple elements for {0:s}, day {1!s}".format(name, day))
+                if len(old):
+                    if old[0].hours != h:
+                        old[0].hours = h
+                        to_update.append(old[0])
                 else:
-                    data['projects'][p_names.index(pname)]['wps'].append(wp)
-
-            # Add business travel to WP
-            wp['days'][m.day.day.day - 1] = mh
-            # Update WP total
-            wp['total'] += mh
-            wp['sum'] += mh
-            # Update project day
-            data['projects'][p_names.index(pname)]['days'][m.day.day.day - 1] = mh
-            # Update project total
-            data['projects'][p_names.index(pname)]['total'] += mh
-            data['projects'][p_names.index(pname)]['sum'] += mh
+                    to_create.append(create(day, h))
+            # Unused days
+            for day, old in rows.items():
+                if day not in hours:
+                    to_delete.extend([ts.pk for ts in old])
+
+        for pid, hours in projects.items():
+            diff(
+                by_project.get(pid, {}),
+                hours,
+                "project ID {0:d}".format(pid),
+                lambda day, h: TimesheetHours(report=get_report(pid, day), report_wp=None, day=day, hours=h),
+            )
+
+        for wid, hours in workpackages.items():
+            def create(day, h):
+                report = get_report(wp_projects[wid], day)
+                if (report.pk, wid) not in report_wps:
+                    raise ReportingError("Cannot find corresponding reported work for workpackage ID {0:d}, day {1!s}".format(wid, day))
+                return TimesheetHours(report=report, report_wp_id=report_wps[(report.pk, wid)], day=day, hours=h)
+
+            diff(by_wp.get(wid, {}), hours, "workpackage ID {0:d}".format(wid), create)
+
+        # Apply changes
+        if len(to_delete):
+            TimesheetHours.objects.filter(pk__in=to_delete).delete()
+        if len(to_update):
+            TimesheetHours.objects.bulk_update(to_update, ['hours'])
+        if len(to_create):
+            TimesheetHours.objects.bulk_create(to_create)
+
+        # Bulk operations do not send signals
+        status_tracker.mark(rid, year, month)
+
+    return (len(to_create), len(to_update), len(to_delete))
+
 
+def GetTimesheetPrintContext(researcher, year, months=None, project=None, loader=None):
+    """ Build the context needed by PrintPFDTimesheet to print the timesheets of a researcher for the given
+    months (all the year if None), optionally only for a project.
+    Months with nothing to report are skipped. A TimesheetDataLoader already covering the months can be passed.
+    Return a tuple with the list of printed months and the list of contextes
+    Raise ReportingError if a timesheet is not complete or if there is nothing to report
+    """
+    if months is None:
+        months = list(range(1, 13))
+
+    # Load timesheet data for all the months at once
+    if loader is None:
+        loader = TimesheetDataLoader(researcher.pk, year, months)
+
+    good_months = []
+    for month in months:
+        ok, reported, projects = loader.check(month)
+
+        # Timesheet is not complete
+        if not ok:
+            raise ReportingError(f"Timesheet not available for {tr_month.month_num2en(month)}/{year}. Please generate it.")
+
+        # Add month only if there's something reported
+        if reported and (project is None or project.name in projects):
+            good_months.append(month)
+
+    if not len(good_months):
+        raise ReportingError('Nothing to report')
+
+    # Function to check the incompatibility between a researcher and the director
+    # TODO: what we do when the director and the researcher are the same person?
+    def check_incompatibility(researcher, director, year, month):
+        s = datetime.date(year, month, 1)
+        e = datetime.date(year, month, calendar.monthrange(year, month)[1])
+        q = (
+            ConflictOfInterest.objects
+            .filter(researcher=researcher, director=director)
+            .filter(Q(start_date__lte=e) | (Q(end_date__isnull=True) | Q(end_date__gte=s)))
+        )
+        if len(q):
+            return (str(q[0].delegate), 'Delegate of IFN Director')
+        else:
+            return (str(director), 'IFN Director')
+
+    # Roles of the researcher
+    roles = list(ResearcherRole.objects.filter(researcher=researcher).order_by('start_date'))
+
+    context = []
+    for month in good_months:
+        # Get number of days in month
+        ndays = calendar.monthrange(year, month)[1]
+
+        # Get role from ResearcherRole table
+        current_role = None
+        for role in roles:
+            # TODO: check criteria to switch to another role based on date
+            if role.start_date <= datetime.date(year, month, 1):
+                current_role = role.get_role_display()
+            else:
+                break
+        # Default to researcher if nothing is set in ResearcherRole
+        if current_role is None:
+            current_role = "Researcher"
+
+        # Load timesheet data
+        ts_data = loader.get(month, project)
+
+        # Director
+        director = (
+            ResearcherRole.objects
+            .filter(role=ResearcherRole.INSTITUTE_DIRECTOR)
+            .filter(start_date__lt=datetime.date(year, month, ndays))
+            .order_by('-start_date')
+            .first()
+            .researcher
+        )
+
+        # Check incompatibilities
+        supervisor_signer = check_incompatibility(researcher, director, year, month)
+
+        # Check needed signatures
+        signatures = {}
+        for p in ts_data['projects']:
+            if 'pi_id' in p:
+                try:
+                    pi = Researcher.objects.get(pk=p['pi_id'])
+                except Researcher.DoesNotExist:
+                    pi = None
+
+                if pi is not None and pi != researcher:
+                    name = str(pi)
+                    if name not in signatures:
+                        signatures[name] = []
+                    signatures[name].append(p['name'])
+
+        for k, v in signatures.items():
+            signatures[k] = ", ".join(sorted(v))
+
+        # Search for a proper signature day
+        sign_day = (
+            PresenceData.objects
+            .filter(
+                Q(researcher=researcher) &
+                Q(day__gt=datetime.date(year, month, ndays)) &
+                (Q(code=None) | Q(code__ts_code=EpasCode.NONE)) &
+                Q(hours__gt=0)
+            )
+            .order_by('day')
+            .first()
+        )
+        if sign_day:
+            sign_day = sign_day.day
         else:
-            # Add business travel to project
-            data['projects'][p_names.index(pname)]['days'][m.day.day.day - 1] = mh
-            data['projects'][p_names.index(pname)]['total'] += mh
-            data['projects'][p_names.index(pname)]['sum'] += mh
-
-        # Update day total
-        data['days'][m.day.day.day - 1]['total'] += mh
-
-    # Add internal activities
-    internal = {
-        'name': 'Internal activities',
-        'ref': '',
-        'id': -1,
-        'has_wps': False,
-        'days': available_hours,
-        'total': sum(available_hours),
-    }
-
-    # Add business travels not assigned to any period
-    missions = presences.filter(Q(ts_code=EpasCode.MISSION) & Q(hours__gt=0) & ~q).order_by('day')
-    for m in missions:
-        mh = m.hours
-        # Add business travel
-        internal['days'][m.day.day - 1] = mh
-        # Update internal activities total
-        internal['total'] += mh
-        # Update day total
-        data['days'][m.day.day - 1]['total'] += mh
-
-    # Add internal activities as last project
-    data['projects'].append(internal)
-
-    # Compute grand total
-    for d in data['days']:
-        data['grand_total'] += d['total']
-    data['grand_total'] = data['grand_total']
-
-    return data
+            sign_day = None
+
+        context.append({
+            'title': f"Timesheets for {researcher} for year {year}",
+            'month': month,
+            'year': year,
+            'researcher': f"{researcher.name} {researcher.surname}",
+            'director': supervisor_signer,
+            'employment': current_role,
+            'beneficiary': "CNR-IFN",
+            'ts': ts_data,
+            'signatures': signatures,
+            'sign_day': sign_day,
+        })
+
+    return (good_months, context)
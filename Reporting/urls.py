@@ -20,21 +20,27 @@ urlpatterns = [
     path('costs/add', views.PersonnelCostCreate.as_view(), name='cost_add'),
     path('costs/<int:pk>/modify', views.PersonnelCostUpdate.as_view(), name='cost_mod'),
     path('costs/<int:pk>/delete', views.PersonnelCostDelete.as_view(), name='cost_del'),
+    path('costs/ajax/rates', views.PersonnelCostAjaxRates.as_view(), name='cost_ajax_rates'),
 
     path('presences/', views.PresenceDataList.as_view(), name='presencedata_view'),
     path('presences/detail/<int:researcher>/<int:year>', views.PresenceDataDetail.as_view(), name='presencedata_detailyear'),
     path('presences/detail/<int:researcher>/<int:year>/<int:month>', views.PresenceDataDetail.as_view(), name='presencedata_detailmonth'),
     path('presences/import', views.PresenceDataImport.as_view(), name='presencedata_import'),
+    path('presences/import/job/<int:pk>', views.PresenceDataImportJob.as_view(), name='presencedata_import_job'),
+    path('presences/import/bulk', views.PresenceDataBulkImport.as_view(), name='presencedata_import_bulk'),
     path('presences/store', views.PresenceDataStore.as_view(), name='presencedata_store'),
 
     path('periods/', views.ReportingPeriodList.as_view(), name='reporting_periods'),
     path('periods/add', views.ReportingCreate.as_view(), name='reporting_add'),
     path('periods/<int:pk>/modify', views.ReportingUpdate.as_view(), name='reporting_mod'),
     path('periods/<int:pk>/delete', views.ReportingDelete.as_view(), name='reporting_del'),
+    path('periods/<int:pk>/statement', views.ReportingStatement.as_view(), name='reporting_statement'),
+    path('export/<str:name>', views.ReportingExport.as_view(), name='reporting_export'),
 
     path('reporting/', views.ReportingList.as_view(), name='reporting_list'),
     path('reporting/byresearcher/<int:rid>/', views.ReportingByResearcher.as_view(), name='reporting_byresearcher'),
 
+    path('reporting/ajax/overview', views.ReportingListAjax.as_view(), name="reporting_ajax_overview"),
     path('reporting/ajax/period', views.ReportingAjaxPeriod.as_view(), name="reporting_ajax_period"),
     path('reporting/ajax/year', views.ReportingAjaxYear.as_view(), name="reporting_ajax_year"),
     path('reporting/ajax/byresearcher/<int:rid>/<int:pid>/add_work', views.ReportingAddWork.as_view(), name='reporting_add_work'),
@@ -47,6 +53,7 @@ urlpatterns = [
     path('timesheets/', views.TimeSheetsView.as_view(), name='timesheets_view'),
     path('timesheets/<int:rid>/<int:year>/generate', views.TimeSheetsGenerate.as_view(), name='timesheets_generate'),
     path('timesheets/<int:rid>/<int:year>/print', views.TimeSheetsPrint.as_view(), name='timesheets_print'),
+    path('timesheets/print', views.TimeSheetsBatchPrint.as_view(), name='timesheets_batch_print'),
 
     path('timesheets/ajax/<int:rid>/<int:year>/generate', views.TimesheetAjaxDenied.as_view(), name='timesheets_ajax_generate_base'),
     path('timesheets/ajax/<int:rid>/<int:year>/generate/<int:month>', views.TimeSheetsAjaxGenerate.as_view(), name='timesheets_ajax_generate'),
@@ -2,24 +2,35 @@ from typing import OrderedDict
 import logging
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse_lazy
-from django.http import JsonResponse, Http404, FileResponse
+from django.http import JsonResponse, Http404, FileResponse, StreamingHttpResponse
 from django.core.exceptions import MultipleObjectsReturned, PermissionDenied, ValidationError
 
 from django.db.models import Count, Sum, Q, F, Value, ExpressionWrapper, BooleanField, CharField
 
-from django.db.models.functions import ExtractYear, ExtractMonth, Concat, Coalesce, Floor, Least
+from django.db.models.functions import ExtractYear, ExtractMonth, Concat, Coalesce
 
 from Projects.models import Project, Researcher, ResearcherRole, WorkPackage, ConflictOfInterest
-from .models import EpasCode, BankHoliday, PersonnelCost, PresenceData, ReportingPeriod, ReportedWork, ReportedWorkWorkpackage, ReportedMission, TimesheetHours
+from .models import EpasCode, BankHoliday, PersonnelCost, PresenceData, ReportingPeriod, ReportedWork, ReportedWorkWorkpackage, ReportedMission, ReportingSummary, TimesheetHours, TimesheetStatus
 
-from .forms import AddReportedMissionForm, EpasCodeUpdateForm, PresenceInputForm, ReportedWorkForm  #, ReportingAddForm
+from .forms import AddReportedMissionForm, EpasCodeUpdateForm, PresenceInputForm, PresenceBulkInputForm, ReportedWorkForm  #, ReportingAddForm
 
-from .utils import process_presences, summarize_presences, serialize_presences
-from .utils import unserialize_presences, check_presences_unique, check_bank_holiday
-from .utils import get_workpackages_fractions
+from .utils import summarize_presences, check_bank_holiday
+from .utils import get_workpackages_fractions_bulk
 from .utils import ReportingError
-from .timesheets import CheckTimesheetData, GetTimesheetData
-from .print import PrintPFDTimesheet
+from .timesheets import EnsureTimesheetStatus, GetTimesheetStatus, GetTimesheetData, GetTimesheetPrintContext, SaveTimesheetData
+from .pdfcache import PrintCachedPDFTimesheet
+from .batchprint import timesheet_print_jobs, iter_timesheets_zip, print_inline, print_workers
+from .presences import import_presences
+from .ingest import ingest_presences, ingest_inline, ingest_workers
+from .overview import get_reporting_overview, filter_reporting_overview
+from .costs import get_cost_matrix
+from .statement import get_statement
+from .summary import refresh_reporting_summary
+from .exports import EXPORTS, iter_export_rows, iter_csv, write_xlsx
+from .staging import stage_presences, load_staged_presences, discard_staged_presences
+from Jobs.jobs import enqueue
+from Jobs.models import Job
+from Jobs.views import job_status
 
 from Tags.templatetags import tr_month
 
@@ -31,6 +42,7 @@ from UdyniManagement.views import AjaxPermissionRequiredMixin, ObjectValidationM
 
 from django.contrib.auth.mixins import PermissionRequiredMixin
 
+import io
 import re
 import pandas as pd
 from lxml import etree
@@ -220,14 +232,31 @@ class PersonnelCostList(PermissionRequiredMixin, ListViewMenu):
     permission_required = 'Reporting.costs_view'
 
     def get_queryset(self):
-        return PersonnelCost.objects.all().order_by('researcher', 'year')
+        return PersonnelCost.objects.all().select_related('researcher').order_by('researcher', 'year')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        # Hourly rates from the cost matrix
+        matrix = get_cost_matrix()
+        for cost in context['object_list']:
+            cost.hourly_rate = matrix.hourly_rate(cost.researcher_id, cost.year)
         context['title'] = "Personnel cost"
         return context
 
 
+class PersonnelCostAjaxRates(AjaxPermissionRequiredMixin, View):
+    permission_required = 'Reporting.costs_view'
+    http_method_names = ['get', ]
+
+    def get(self, request, *args, **kwargs):
+        matrix = get_cost_matrix()
+        data = matrix.as_dict()
+        names = {r.pk: str(r) for r in Researcher.objects.filter(pk__in=matrix.researchers)}
+        data['names'] = [names.get(pk, "") for pk in matrix.researchers]
+        data['status'] = 'ok'
+        return JsonResponse(data)
+
+
 class PersonnelCostCreate(PermissionRequiredMixin, CreateViewMenu):
     model = PersonnelCost
     fields = ['researcher', 'year', 'cost']
@@ -347,24 +376,15 @@ class PresenceDataDetail(PermissionRequiredMixin, ListViewMenu):
         if 'month' in self.kwargs:
             qs = (
                 PresenceData.objects
-                .annotate(year=ExtractYear('day'), month=ExtractMonth('day'))
-                .filter(
-                    researcher=self.kwargs['researcher'],
-                    year=self.kwargs['year'],
-                    month=self.kwargs['month'],
-                )
+                .for_month(self.kwargs['year'], self.kwargs['month'])
+                .filter(researcher=self.kwargs['researcher'])
                 .annotate(code_name=F('code__code'))
                 .order_by('day')
             )
             cs = (
                 PresenceData.objects
-                .annotate(year=ExtractYear('day'), month=ExtractMonth('day'))
-                .filter(
-                    researcher=self.kwargs['researcher'],
-                    year=self.kwargs['year'],
-                    month=self.kwargs['month'],
-                    code__isnull=False,
-                )
+                .for_month(self.kwargs['year'], self.kwargs['month'])
+                .filter(researcher=self.kwargs['researcher'], code__isnull=False)
                 .values('code')
                 .annotate(
                     code_name=F('code__code'),
@@ -378,8 +398,8 @@ class PresenceDataDetail(PermissionRequiredMixin, ListViewMenu):
         else:
             qs = (
                 PresenceData.objects
-                .annotate(year=ExtractYear('day'))
-                .filter(researcher=self.kwargs['researcher'], year=self.kwargs['year'])
+                .for_year(self.kwargs['year'])
+                .filter(researcher=self.kwargs['researcher'])
                 .annotate(month=ExtractMonth('day'))
                 .values('month')
                 .annotate(
@@ -394,8 +414,8 @@ class PresenceDataDetail(PermissionRequiredMixin, ListViewMenu):
             )
             cs = (
                 PresenceData.objects
-                .annotate(year=ExtractYear('day'))
-                .filter(researcher=self.kwargs['researcher'], year=self.kwargs['year'], code__isnull=False)
+                .for_year(self.kwargs['year'])
+                .filter(researcher=self.kwargs['researcher'], code__isnull=False)
                 .values('code')
                 .annotate(
                     code_name=F('code__code'),
@@ -432,11 +452,9 @@ class PresenceDataImport(PermissionRequiredMixin, View):
         return False
 
     def get(self, request, *args, **kwargs):
-        # Clear session
-        try:
-            del request.session['presences']
-        except KeyError:
-            pass
+        # Clear staged import
+        if 'presences_token' in request.session:
+            discard_staged_presences(request.session.pop('presences_token'))
         if self.manage_only_own:
             try:
                 r = Researcher.objects.get(username=request.user)
@@ -473,11 +491,15 @@ class PresenceDataImport(PermissionRequiredMixin, View):
             if self.manage_only_own and r.username != request.user:
                 raise PermissionDenied()
 
-            # Load excel file
-            xls = pd.ExcelFile(request.FILES['file'])
-            # Process excel file
-            presences = process_presences(xls, f"{r.surname} {r.name}")
-            request.session['presences'] = serialize_presences(presences)
+            if 'background' in request.POST:
+                # Parse the file in a background job (see PresenceDataImportJob)
+                epas = form.cleaned_data['epas']
+                job = enqueue('Reporting.import_presences', user=request.user, input_file=io.BytesIO(epas.data), input_name=epas.name, researcher=r.pk)
+                return JsonResponse(job_status(job))
+
+            # Parse the file (already opened by the form)
+            presences = form.cleaned_data['epas'].parse(f"{r.surname} {r.name}")
+            request.session['presences_token'] = stage_presences(presences, r)
             context = {
                 'title': f"Confirm presence data for {r}",
                 'summary': summarize_presences(presences),
@@ -494,6 +516,79 @@ class PresenceDataImport(PermissionRequiredMixin, View):
         return render(request, 'Reporting/presencedata_form.html', context)
 
 
+class PresenceDataImportJob(PresenceDataImport):
+    """ Show the summary of presence data parsed in a background job
+    """
+    http_method_names = ['get', ]
+
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(Job, pk=self.kwargs['pk'], task='Reporting.import_presences')
+        if job.user_id != request.user.pk:
+            raise PermissionDenied()
+        if job.state != Job.DONE:
+            raise Http404('Job not completed')
+
+        try:
+            rid, presences = load_staged_presences(job.result['token'])
+        except ReportingError as e:
+            raise Http404(str(e))
+        r = get_object_or_404(Researcher, pk=rid)
+        if self.manage_only_own and r.username != request.user:
+            raise PermissionDenied()
+
+        request.session['presences_token'] = job.result['token']
+        context = {
+            'title': f"Confirm presence data for {r}",
+            'summary': summarize_presences(presences),
+            'researcher': r,
+            'menu': UdyniMenu().getMenu(request.user),
+        }
+        return render(request, 'Reporting/presencedata_summary.html', context)
+
+
+class PresenceDataBulkImport(PermissionRequiredMixin, View):
+    """ Import the presences of many researchers from a ZIP archive of EPAS exports
+    With the 'background' parameter, or when the archive has too many files to import in the request (see
+    ingest.py), the archive is imported by a background job and the status of the job is returned
+    """
+    http_method_names = ['get', 'post']
+    permission_required = 'Reporting.presences_manage'
+
+    def get(self, request, *args, **kwargs):
+        context = {
+            'title': "Bulk import of presence data",
+            'form': PresenceBulkInputForm(),
+            'menu': UdyniMenu().getMenu(request.user),
+        }
+        return render(request, 'Reporting/presencedata_form.html', context)
+
+    def post(self, request, *args, **kwargs):
+        form = PresenceBulkInputForm(data=request.POST, files=request.FILES)
+        if form.is_valid():
+            # Large archives are always imported in background
+            if 'background' in request.POST or not ingest_inline(request.FILES['file']):
+                job = enqueue('Reporting.ingest_presences', user=request.user, input_file=request.FILES['file'], input_name="presences.zip")
+                return JsonResponse(job_status(job))
+
+            try:
+                out = ingest_presences(request.FILES['file'], max_workers=ingest_workers())
+            except ReportingError as e:
+                raise Http404(str(e))
+            context = {
+                'title': "Presence data imported",
+                'out': out,
+                'menu': UdyniMenu().getMenu(request.user),
+            }
+            return render(request, 'Reporting/presencedata_bulkreport.html', context)
+
+        context = {
+            'title': "Bulk import of presence data",
+            'form': form,
+            'menu': UdyniMenu().getMenu(request.user),
+        }
+        return render(request, 'Reporting/presencedata_form.html', context)
+
+
 class PresenceDataStore(PermissionRequiredMixin, View):
 
     http_method_names = ['post', ]
@@ -508,65 +603,37 @@ class PresenceDataStore(PermissionRequiredMixin, View):
         return False
 
     def post(self, request, *args, **kwargs):
-        if 'presences' in request.session:
-            # Unserialize presences
-            presences = unserialize_presences(request.session['presences'])
+        if 'presences_token' in request.session:
+            # Load staged presences
+            try:
+                rid, presences = load_staged_presences(request.session['presences_token'])
+            except ReportingError as e:
+                raise Http404(str(e))
             researcher = get_object_or_404(Researcher, pk=request.POST['researcher'])
 
             # Verify permissions
-            if self.manage_only_own and researcher.username != request.user:
+            if rid != researcher.pk or (self.manage_only_own and researcher.username != request.user):
                 raise PermissionDenied()
 
-            check_presences_unique(presences)
-
-            # data = []
+            # Selected months
+            data = []
             for year, v1 in presences.items():
                 for month, v2 in v1.items():
-                    # Check post data
                     checkbox = "i_{0:d}_{1:s}".format(year, month)
                     if checkbox in request.POST and request.POST[checkbox] == 'on':
-                        # Insert data in DB
-                        for i, row in v2.iterrows():
-                            # Convert code
-                            if row['Code'] != "":
-                                try:
-                                    code = EpasCode.objects.get(code=row['Code'])
-                                except EpasCode.DoesNotExist:
-                                    print("Missing code:", year, month, row['Date'], row['Code'])
-                                    code = None
-                            else:
-                                code = None
-
-                            # Check if data is already in DB
-                            try:
-                                obj = PresenceData.objects.get(researcher=researcher, day=row['Date'])
-                                update = False
-                                if obj.hours != row['Hours']:
-                                    obj.hours = row['Hours']
-                                    update = True
-                                if obj.code != code:
-                                    obj.code = code
-                                    if code is not None and code.ts_code:
-                                        obj.ts_code=code.ts_code
-                                    update = True
-                                if update:
-                                    obj.save()
-
-                            except PresenceData.MultipleObjectsReturned:
-                                print("ERROR: more that one result! This should never happen!")
-
-                            except PresenceData.DoesNotExist:
-                                p = PresenceData(researcher=researcher,
-                                                 day=row['Date'],
-                                                 hours=row['Hours'],
-                                                 code=code)
-                                if code is not None and code.ts_code:
-                                    p.ts_code=code.ts_code
-                                p.save()
-                                # data.append(p) NOTE: disabled bulk create as it was impossibile to debug an integrity violation
-
-                # if len(data):
-                    # PresenceData.objects.bulk_create(data)
+                        data.append(v2)
+
+            discard_staged_presences(request.session.pop('presences_token'))
+
+            if len(data):
+                report = import_presences(researcher, pd.concat(data, ignore_index=True))
+                context = {
+                    'title': f"Presence data imported for {researcher}",
+                    'report': report,
+                    'researcher': researcher,
+                    'menu': UdyniMenu().getMenu(request.user),
+                }
+                return render(request, 'Reporting/presencedata_report.html', context)
 
         return redirect('presencedata_view')
 
@@ -597,6 +664,71 @@ class ReportingPeriodList(PermissionRequiredMixin, ListViewMenu):
         return context
 
 
+class ReportingStatement(PermissionRequiredMixin, TemplateViewMenu):
+    template_name = 'Reporting/reportingperiod_statement.html'
+    permission_required = ('Reporting.reporting_view', 'Reporting.costs_view')
+
+    @staticmethod
+    def records(df):
+        # NaN to None for templates
+        return df.astype(object).where(df.notna(), None).to_dict('records')
+
+    def get(self, request, *args, **kwargs):
+        self.period = get_object_or_404(ReportingPeriod.objects.select_related('project'), pk=self.kwargs['pk'])
+        self.statement = get_statement(self.period)
+        filename = "statement_{0:s}_{1:s}".format(re.sub(r"[^A-Za-z0-9_\-]+", "_", self.period.project.name), self.period.rp_start.isoformat())
+
+        fmt = request.GET.get('format', 'html')
+        if fmt == 'xlsx':
+            return FileResponse(io.BytesIO(self.statement.to_xlsx()), as_attachment=True, filename=filename + '.xlsx')
+        elif fmt == 'csv':
+            section = request.GET.get('section', 'personnel')
+            if section not in ('personnel', 'direct'):
+                raise Http404('Unknown section')
+            return FileResponse(io.BytesIO(self.statement.to_csv(section).encode('utf-8')), as_attachment=True, filename=f"{filename}_{section}.csv")
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['period'] = self.period
+        context['summary'] = self.statement.summary()
+        context['by_researcher'] = self.records(self.statement.personnel_by('Researcher'))
+        context['by_workpackage'] = self.records(self.statement.personnel_by('Workpackage'))
+        context['direct'] = self.records(self.statement.direct)
+        context['missing_rates'] = self.statement.missing_rates
+        context['title'] = "Statement of {0:s} ({1!s} - {2!s})".format(self.period.project.name, self.period.rp_start, self.period.rp_end)
+        return context
+
+
+class ReportingExport(PermissionRequiredMixin, View):  # name='reporting_export'  <str:name>
+    http_method_names = ['get', ]
+
+    def has_permission(self):
+        if self.kwargs['name'] not in EXPORTS:
+            raise Http404('Unknown export')
+        return self.request.user.has_perm(EXPORTS[self.kwargs['name']].permission)
+
+    def get(self, request, *args, **kwargs):
+        name = self.kwargs['name']
+        filters = {}
+        try:
+            for k in ('researcher', 'project', 'year'):
+                if request.GET.get(k, '') != '':
+                    filters[k] = int(request.GET[k])
+        except ValueError:
+            raise Http404('Invalid filter')
+        if 'project' in filters and EXPORTS[name].project is None:
+            raise Http404('Filter by project is not available for this export')
+
+        filename = "_".join([name, ] + ["{0:s}{1:d}".format(k, v) for k, v in filters.items()])
+        rows = iter_export_rows(name, **filters)
+        if request.GET.get('format', 'csv') == 'xlsx':
+            return FileResponse(write_xlsx(rows, name), as_attachment=True, filename=filename + '.xlsx')
+        response = StreamingHttpResponse(iter_csv(rows), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="{0:s}.csv"'.format(filename)
+        return response
+
+
 class ReportingCreate(PermissionRequiredMixin, CreateViewMenu):
     model = ReportingPeriod
     fields = ['project', 'rp_start', 'rp_end']
@@ -694,8 +826,7 @@ class ReportingDelete(PermissionRequiredMixin, DeleteViewMenu):
 # REPORTED WORK AND MISSIONS
 #
 
-class ReportingList(PermissionRequiredMixin, TemplateViewMenu):
-    template_name = 'Reporting/reportingperiod_list_byproject.html'
+class ReportingOverviewMixin(object):
     only_own = False
 
     def has_permission(self):
@@ -717,80 +848,14 @@ class ReportingList(PermissionRequiredMixin, TemplateViewMenu):
             except Researcher.MultipleObjectsReturned:
                 raise PermissionDenied('User is not associated with with multiple researchers. This should not happen.')
 
-        projects = OrderedDict()
-        for rp in ReportingPeriod.objects.all().order_by('project__name', 'rp_start'):
-            has_own = False
-            is_own = (rp.project.pi is not None and rp.project.pi.username == self.request.user)
-
-            if rp.project.name not in projects:
-                projects[rp.project.name] = {
-                    'project': rp.project,
-                    'periods': [],
-                }
-            new_period = {
-                'rp': rp,
-                'researchers': OrderedDict(),
-            }
-
-            work = (
-                rp.reported_work
-                .order_by('researcher')
-                .values('researcher')
-                .annotate(
-                    fullname=Concat(F('researcher__name'), Value(' '), F('researcher__surname')),
-                    rid=F('researcher__pk'),
-                    total=Sum('hours'),
-                )
-
-            )
-            for w in work:
-                if not is_own and self.only_own and w['rid'] != self_rid:
-                    continue
-                new_period['researchers'][w['fullname']] = {
-                    'name': w['fullname'],
-                    'hours': w['total'],
-                    'rid': w['rid'],
-                    'missions': 0,
-                }
-                has_own = True
+        projects = get_reporting_overview()
+        if self.only_own:
+            projects = filter_reporting_overview(projects, self.request.user, self_rid)
+        return projects
 
-            missions = (
-                rp.reported_missions
-                .values('day__researcher')
-                .annotate(
-                    fullname=Concat(F('day__researcher__name'), Value(' '), F('day__researcher__surname')),
-                    rid=F('day__researcher__pk'),
-                    missions=Count('day'),
-                    mission_hours=Coalesce(Sum('day__hours'), Value(0.0)),
-                )
-                .order_by('day__researcher')
-            )
-            for m in missions:
-                if not is_own and self.only_own and m['rid'] != self_rid:
-                    continue
-                if m['fullname'] not in new_period['researchers']:
-                    new_period['researchers'][m['fullname']] = {
-                        'name': m['fullname'],
-                        'rid': m['rid'],
-                        'hours': 0.0,
-                        'mission_hours': 0.0,
-                        'missions': 0,
-                    }
-                new_period['researchers'][m['fullname']]['missions'] = m['missions']
-                new_period['researchers'][m['fullname']]['mission_hours'] = m['mission_hours']
-                has_own = True
-
-            # Check if period has to be appended
-            if self.only_own and not has_own:
-                continue
-            projects[rp.project.name]['periods'].append(new_period)
-
-        # Purge empty projects
-        for name in list(projects.keys()):
-            if not len(projects[name]['periods']):
-                del projects[name]
 
-        return projects
+class ReportingList(ReportingOverviewMixin, PermissionRequiredMixin, TemplateViewMenu):
+    template_name = 'Reporting/reportingperiod_list_byproject.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -818,6 +883,23 @@ class ReportingList(PermissionRequiredMixin, TemplateViewMenu):
         return context
 
 
+class ReportingListAjax(ReportingOverviewMixin, AjaxPermissionRequiredMixin, View):
+    http_method_names = ['get', ]
+
+    def get(self, request, *args, **kwargs):
+        projects = self.create_reporting_list()
+        return JsonResponse({
+            'status': 'ok',
+            'projects': [
+                {
+                    'project': p['project'],
+                    'periods': [{'rp': period['rp'], 'researchers': list(period['researchers'].values())} for period in p['periods']],
+                }
+                for p in projects.values()
+            ],
+        })
+
+
 class ReportingByResearcher(PermissionRequiredMixin, TemplateViewMenu):  # name='reporting_byresearcher'  <int:rid>
     template_name = 'Reporting/reportingperiod_list_byresearcher.html'
     only_own = False
@@ -1041,6 +1123,7 @@ class ReportingAjaxPeriod(PermissionRequiredMixin, View):
 
         # Get all work
         work = ReportedWork.objects.filter(researcher=researcher, period=period).order_by('year', 'month')
+        fractions = get_workpackages_fractions_bulk(work)
         missions = ReportedMission.objects.filter(Q(day__researcher=researcher) & Q(period=period)).annotate(year=ExtractYear('day__day'), month=ExtractMonth('day__day')).order_by('day__day')
 
         data = {}
@@ -1055,7 +1138,7 @@ class ReportingAjaxPeriod(PermissionRequiredMixin, View):
                 line.append({'val': ''})
             line.append({'val': tr_month.month_num2en(w.month)})
             line.append({'val': w.hours})
-            line.append({'wps': get_workpackages_fractions(w)})
+            line.append({'wps': fractions[w.pk]})
             line.append({'pk': w.pk})
             data['work'].append(line)
 
@@ -1126,34 +1209,21 @@ class ReportingAjaxYear(PermissionRequiredMixin, View):
         # Get missions
         missions = (
             ReportedMission.objects
+            .for_year(year)
             .filter(Q(day__researcher=researcher))
             .annotate(year=ExtractYear('day__day'), month=ExtractMonth('day__day'))
-            .filter(year=year)
         )
         if self.only_own and not is_self:
             missions = missions.filter(Q(period__project__pi__username=self.request.user))
         missions = missions.order_by('day__day')
 
-        # Get also the aggregate presences
+        # Get also the aggregate presences (from the reporting summary)
+        refresh_reporting_summary(year, researcher.pk)
         presences = (
-            PresenceData.objects
-            .filter(researcher=researcher)
-            .annotate(
-                year=ExtractYear('day'),
-                month=ExtractMonth('day'),
-                hd=Floor(F('hours') / Value(3.6)),
-                uh=Least(F('hours'), Value(7.2)),
-            )
-            .filter(year=year)
-            .order_by('day')
-            .values('month')
-            .annotate(
-                tot_hours=Coalesce(Sum('hours', filter=Q(code__ts_code=EpasCode.NONE) | Q(code__isnull=True)), Value(0.0)),
-                missions=Count('code', filter=Q(code__ts_code=EpasCode.MISSION)),
-                half_days=Coalesce(Sum('hd', filter=Q(code__ts_code=EpasCode.NONE) | Q(code__isnull=True)), Value(0.0)),
-                usable_hours=Coalesce(Sum('uh', filter=Q(code__ts_code=EpasCode.NONE) | Q(code__isnull=True)), Value(0.0))
-            )
-            .order_by('month')
+            ReportingSummary.objects
+            .for_year(year)
+            .filter(researcher=researcher, project=None)
+            .rollup('month', measures=('worked_hours', 'usable_hours', 'half_days', 'epas_missions'))
         )
 
         data = {}
@@ -1177,12 +1247,13 @@ class ReportingAjaxYear(PermissionRequiredMixin, View):
         total_by_month = [0.0 for i in range(12)]
 
         # Reported hours
+        fractions = get_workpackages_fractions_bulk(work)
         for w in work:
             is_own = is_self or (w.period.project.pi is not None and w.period.project.pi.username == self.request.user)
             data['work'][w.month - 1][periods_pk.index(w.period.pk) + 1]['pk'] = w.pk
             data['work'][w.month - 1][periods_pk.index(w.period.pk) + 1]['can_edit'] = can_edit or (can_edit_own and is_own)
             data['work'][w.month - 1][periods_pk.index(w.period.pk) + 1]['hours'] = w.hours
-            data['work'][w.month - 1][periods_pk.index(w.period.pk) + 1]['wps'] = get_workpackages_fractions(w)
+            data['work'][w.month - 1][periods_pk.index(w.period.pk) + 1]['wps'] = fractions[w.pk]
             total_by_month[w.month - 1] += w.hours
 
         # Totals by month
@@ -1193,8 +1264,8 @@ class ReportingAjaxYear(PermissionRequiredMixin, View):
         for p in presences:
             data['work'][p['month'] - 1][-3]['value'] = f"{p['usable_hours']:.1f}"
             data['work'][p['month'] - 1][-2]['value'] = f"{int(p['half_days']):d} ({int(p['half_days']) * 3.6:.1f})"
-            data['work'][p['month'] - 1][-1]['value'] = f"{p['tot_hours']:.1f}"
-            data['missions'][p['month'] - 1][-1]['value'] = f"{p['missions']:d}"
+            data['work'][p['month'] - 1][-1]['value'] = f"{p['worked_hours']:.1f}"
+            data['missions'][p['month'] - 1][-1]['value'] = f"{p['epas_missions']:d}"
 
         totals = []
         totals.append('Totals')
@@ -1519,12 +1590,14 @@ class TimeSheetsView(PermissionRequiredMixin, TemplateViewMenu):
     def get_list(self):
         out = {}
         # We need to get the list of researcher that have reported work/missions and for which years
-        work = ReportedWork.objects
+        # NOTE: years not yet in the status table are computed first
+        EnsureTimesheetStatus()
+        status = TimesheetStatus.objects
         if self.only_own:
             # Filter on username
-            work = work.filter(Q(researcher__username=self.request.user))
-        work = (
-            work
+            status = status.filter(Q(researcher__username=self.request.user))
+        status = (
+            status
             .annotate(
                 name=F('researcher__name'),
                 surname=F('researcher__surname'),
@@ -1534,35 +1607,11 @@ class TimeSheetsView(PermissionRequiredMixin, TemplateViewMenu):
             .order_by('surname', 'name', 'year')
             .distinct()
         )
-        for w in work:
-            full_name = "{0:s} {1:s}".format(w['name'], w['surname'])
-            if full_name not in out:
-                out[full_name] = {'rid': w['rid'], 'years': []}
-            out[full_name]['years'].append(w['year'])
-
-        missions = ReportedMission.objects
-        if self.only_own:
-            # Filter on username
-            missions = missions.filter(Q(day__researcher__username=self.request.user))
-        missions = (
-            missions
-            .annotate(
-                name=F('day__researcher__name'),
-                surname=F('day__researcher__surname'),
-                rid=F('day__researcher__pk'),
-                year=ExtractYear('day__day'),
-            )
-            .values('name', 'surname', 'rid', 'year')
-            .order_by('surname', 'name', 'year')
-            .distinct()
-        )
-        for m in missions:
-            full_name = "{0:s} {1:s}".format(m['name'], m['surname'])
+        for s in status:
+            full_name = "{0:s} {1:s}".format(s['name'], s['surname'])
             if full_name not in out:
-                out[full_name] = {'rid': m['rid'], 'years': []}
-            if m['year'] not in out[full_name]['years']:
-                out[full_name]['years'].append(m['year'])
-                out[full_name]['years'].sort()
+                out[full_name] = {'rid': s['rid'], 'years': []}
+            out[full_name]['years'].append(s['year'])
         return out
 
     def get_context_data(self, **kwargs):
@@ -1645,156 +1694,20 @@ class TimeSheetsAjaxGenerate(PermissionRequiredMixin, View):
         # Decode json data submitted
         try:
             data = json.loads(request.body.decode("utf-8"))
+            projects = {}
             for k, v in data['projects'].items():
-                used_days = Q()
-                pid = int(k)
-                for d, h in v.items():
-                    day = datetime.date(year, month, int(d) + 1)
-                    print("Saving project {0:d}, day {1!s}".format(pid, day))
-                    used_days |= Q(day=day)
-                    try:
-                        ts = (
-                            TimesheetHours.objects
-                            .get(
-                                Q(report__researcher=self.researcher) &
-                                Q(day=day) &
-                                Q(report__period__project__pk=pid)
-                            )
-                        )
-                        if ts.hours != h:
-                            ts.hours = h
-                            ts.save()
-                    except TimesheetHours.DoesNotExist:
-                        # Get report
-                        try:
-                            report = (
-                                ReportedWork.objects.get(
-                                    Q(researcher=self.researcher) &
-                                    Q(year=year) &
-                                    Q(month=month) &
-                                    Q(period__project__pk=pid) &
-                                    Q(period__rp_start__lte=day) &
-                                    Q(period__rp_end__gte=day)
-                                )
-                            )
-                        except ReportedWork.DoesNotExist:
-                            return JsonResponse({'saveok': False, 'error': "Cannot find corresponding reported work for project ID {0:d}, day {1!s}".format(pid, day)})
-                        except MultipleObjectsReturned:
-                            return JsonResponse({'saveok': False, 'error': "Found more than one corresponding reported work for project ID {0:d}, day {1!s}".format(pid, day)})
-
-                        ts = TimesheetHours()
-                        ts.report = report
-                        ts.report_wp = None
-                        ts.day = day
-                        ts.hours = h
-                        ts.save()
-
-                    except MultipleObjectsReturned:
-                        return JsonResponse({'saveok': False, 'error': "Got multiple elements for project ID {0:d}, day {1!s}".format(pid, day)})
-
-                # Delete old unused days from TimesheetHours
-                (
-                    TimesheetHours.objects
-                    .annotate(
-                        year=ExtractYear('day'),
-                        month=ExtractMonth('day'),
-                    )
-                    .filter(
-                        Q(report__researcher=self.researcher) &
-                        Q(year=year) &
-                        Q(month=month) &
-                        Q(report__period__project__pk=pid) &
-                        ~used_days
-                    )
-                    .delete()
-                )
-
+                projects[int(k)] = {datetime.date(year, month, int(d) + 1): h for d, h in v.items()}
+            workpackages = {}
             for k, v in data['workpackages'].items():
-                used_days = Q()
-                wid = int(k)
-                try:
-                    wp = WorkPackage.objects.get(pk=wid)
-                except WorkPackage.DoesNotExist:
-                    return JsonResponse({'saveok': False, 'error': "Failed to retrieve workpackage with ID {0:d}".format(wid)})
-
-                for d, h in v.items():
-                    day = datetime.date(year, month, int(d) + 1)
-                    log.info(f"Saving workpackage {wp}, day {day}")
-                    used_days |= Q(day=day)
-                    try:
-                        ts = (
-                            TimesheetHours.objects
-                            .get(
-                                Q(report__researcher=self.researcher) &
-                                Q(day=day) &
-                                Q(report_wp__workpackage=wp)
-                            )
-                        )
-                        if ts.hours != h:
-                            ts.hours = h
-                            ts.save()
-                    except TimesheetHours.DoesNotExist:
-                        # Get report
-                        try:
-                            report = (
-                                ReportedWork.objects.get(
-                                    Q(researcher=self.researcher) &
-                                    Q(year=year) &
-                                    Q(month=month) &
-                                    Q(period__project=wp.project) &
-                                    Q(period__rp_start__lte=day) &
-                                    Q(period__rp_end__gte=day)
-                                )
-                            )
-                        except ReportedWork.DoesNotExist:
-                            msg = f"Cannot find corresponding reported work for project {wp.project.name} (ID: {wp.project.pk}), day {day}"
-                            log.exception(msg)
-                            return JsonResponse({'saveok': False, 'error': msg})
-                        except MultipleObjectsReturned:
-                            msg = f"Found more than one corresponding reported work for project {wp.project.name} (ID: {wp.project.pk}), day {day}"
-                            log.exception(msg)
-                            return JsonResponse({'saveok': False, 'error': msg})
-
-                        # Get report WP
-                        try:
-                            report_wp = ReportedWorkWorkpackage.objects.get(report=report, workpackage=wp)
-                        except ReportedWork.DoesNotExist:
-                            msg = f"Cannot find corresponding reported work for workpackage {wp.name} (ID: {wp.pk}) of project {wp.project.name} (ID: {wp.project.name}), day {day}"
-                            log.exception(msg)
-                            return JsonResponse({'saveok': False, 'error': msg})
-                        except MultipleObjectsReturned:
-                            msg = f"Found more than one corresponding reported work for workpackage {wp.name} (ID: {wp.pk}) of project {wp.project.name} (ID: {wp.project.name}), day {day}"
-                            log.exception(msg)
-                            return JsonResponse({'saveok': False, 'error': msg})
-
-                        ts = TimesheetHours()
-                        ts.report = report
-                        ts.report_wp = report_wp
-                        ts.day = day
-                        ts.hours = h
-                        ts.save()
-
-                    except MultipleObjectsReturned:
-                        msg = f"Got multiple elements for workpackage ID {wid}, day {day}"
-                        log.exception(msg)
-                        return JsonResponse({'saveok': False, 'error': msg})
-
-                # Delete old unused days from TimesheetHours
-                (
-                    TimesheetHours.objects
-                    .annotate(
-                        year=ExtractYear('day'),
-                        month=ExtractMonth('day'),
-                    )
-                    .filter(
-                        Q(report__researcher=self.researcher) &
-                        Q(year=year) &
-                        Q(month=month) &
-                        Q(report_wp__workpackage=wp) &
-                        ~used_days
-                    )
-                    .delete()
-                )
+                workpackages[int(k)] = {datetime.date(year, month, int(d) + 1): h for d, h in v.items()}
+
+            created, updated, deleted = SaveTimesheetData(self.researcher.pk, year, month, projects, workpackages)
+            log.info(f"Saved timesheet of {self.researcher} for {month}/{year}: {created} created, {updated} updated, {deleted} deleted")
+
+        except ReportingError as e:
+            msg = str(e)
+            log.exception(msg)
+            return JsonResponse({'saveok': False, 'error': msg})
 
         except json.JSONDecodeError:
             msg = "Failed to decode JSON submitted"
@@ -1837,10 +1750,13 @@ class TimeSheetsAjaxCheck(PermissionRequiredMixin, View):
         except:
             raise Http404('Invalid year')
 
+        # Status of the whole year from the materialized table
+        check = GetTimesheetStatus(year, researcher.pk).get(researcher.pk, {})
+
         out = []
         allgood = True
         for m in range(1, 13, 1):
-            ok, reported, projects = CheckTimesheetData(researcher.pk, year, m)
+            ok, reported, projects = check.get(m, (True, False, {}))
             if not ok:
                 allgood = False
             out.append({
@@ -1902,127 +1818,59 @@ class TimeSheetsPrint(PermissionRequiredMixin, View):
         except:
             project = None
 
-        good_months = []
-        for month in months:
-            ok, reported, projects = CheckTimesheetData(self.researcher.pk, year, month)
-
-            # Timesheet is not complete
-            if not ok:
-                raise Http404(f"Timesheet not available for {tr_month.month_num2en(month)}/{year}. Please generate it.")
-
-            # Add month only if there's something reported
-            if reported and (project is None or project.name in projects):
-                good_months.append(month)
-
-        if not len(good_months):
-            raise Http404('Nothing to report')
-
-        # Function to check the incompatibility between a researcher and the director
-        # TODO: what we do when the director and the researcher are the same person?
-        def check_incompatibility(researcher, director, year, month):
-            s = datetime.date(year, month, 1)
-            e = datetime.date(year, month, calendar.monthrange(year, month)[1])
-            q = (
-                ConflictOfInterest.objects
-                .filter(researcher=researcher, director=director)
-                .filter(Q(start_date__lte=e) | (Q(end_date__isnull=True) | Q(end_date__gte=s)))
-            )
-            if len(q):
-                return (str(q[0].delegate), 'Delegate of IFN Director')
-            else:
-                return (str(director), 'IFN Director')
+        if 'background' in request.GET:
+            job = enqueue('Reporting.print_timesheet', user=request.user, researcher=self.researcher.pk, year=year, months=months, project=project.pk if project is not None else None)
+            return JsonResponse(job_status(job))
 
         try:
-            context = []
-            for month in good_months:
-                print("Processing month", month)
-
-                # Get number of days in month
-                ndays = calendar.monthrange(year, month)[1]
-
-                # Get role from ResearcherRole table
-                current_role = None
-                roles = ResearcherRole.objects.filter(researcher=self.researcher).order_by('start_date')
-                for role in roles:
-                    # TODO: check criteria to switch to another role based on date
-                    if role.start_date <= datetime.date(year, month, 1):
-                        current_role = role.get_role_display()
-                    else:
-                        break
-                # Default to researcher if nothing is set in ResearcherRole
-                if current_role is None:
-                    current_role = "Researcher"
-
-                # Load timesheet data
-                ts_data = GetTimesheetData(self.researcher.pk, year, month, project)
-
-                # Director
-                director = (
-                    ResearcherRole.objects
-                    .filter(role=ResearcherRole.INSTITUTE_DIRECTOR)
-                    .filter(start_date__lt=datetime.date(year, month, ndays))
-                    .order_by('-start_date')
-                    .first()
-                    .researcher
-                )
-
-                # Check incompatibilities
-                supervisor_signer = check_incompatibility(self.researcher, director, year, month)
-
-                # Check needed signatures
-                signatures = {}
-                for p in ts_data['projects']:
-                    if 'pi_id' in p:
-                        try:
-                            pi = Researcher.objects.get(pk=p['pi_id'])
-                        except Researcher.DoesNotExist:
-                            pi = None
-
-                        if pi is not None and pi != self.researcher:
-                            name = str(pi)
-                            if name not in signatures:
-                                signatures[name] = []
-                            signatures[name].append(p['name'])
-
-                for k, v in signatures.items():
-                    signatures[k] = ", ".join(sorted(v))
-
-                # Search for a proper signature day
-                sign_day = (
-                    PresenceData.objects
-                    .filter(
-                        Q(researcher=self.researcher) &
-                        Q(day__gt=datetime.date(year, month, ndays)) &
-                        (Q(code=None) | Q(code__ts_code=EpasCode.NONE)) &
-                        Q(hours__gt=0)
-                    )
-                    .order_by('day')
-                    .first()
-                )
-                if sign_day:
-                    sign_day = sign_day.day
-                else:
-                    sign_day = None
-
-                context.append({
-                    'title': f"Timesheets for {self.researcher} for year {year}",
-                    'month': month,
-                    'year': year,
-                    'researcher': f"{self.researcher.name} {self.researcher.surname}",
-                    'director': supervisor_signer,
-                    'employment': current_role,
-                    'beneficiary': "CNR-IFN",
-                    'ts': ts_data,
-                    'signatures': signatures,
-                    'sign_day': sign_day,
-                })
+            # Build context for each month
+            good_months, context = GetTimesheetPrintContext(self.researcher, year, months, project)
 
             if len(context) == 1:
-                return FileResponse(PrintPFDTimesheet(context), as_attachment=True, filename='{0:s}_{1:04d}_{2:02d}.pdf'.format(self.researcher.surname.lower(), year, good_months[0]))
+                return FileResponse(PrintCachedPDFTimesheet(context), as_attachment=True, filename='{0:s}_{1:04d}_{2:02d}.pdf'.format(self.researcher.surname.lower(), year, good_months[0]))
             else:
-                return FileResponse(PrintPFDTimesheet(context), as_attachment=True, filename='{0:s}_{1:04d}.pdf'.format(self.researcher.surname.lower(), year))
+                return FileResponse(PrintCachedPDFTimesheet(context), as_attachment=True, filename='{0:s}_{1:04d}.pdf'.format(self.researcher.surname.lower(), year))
+
+        except ReportingError as e:
+            raise Http404(str(e))
 
         except Exception as e:
             import traceback
             traceback.print_exc()
             raise Http404(str(e))
+
+
+class TimeSheetsBatchPrint(PermissionRequiredMixin, View):
+    """ Print all the timesheets of a year or of a reporting period as a ZIP archive
+    With the 'background' parameter, or when there are too many timesheets to print in the request (see
+    batchprint.py), the archive is produced by a background job and the status of the job is returned
+    """
+    http_method_names = ['get', ]
+    permission_required = 'Reporting.timesheet_view'
+
+    def get(self, request, *args, **kwargs):
+        if 'period' in request.GET:
+            period = get_object_or_404(ReportingPeriod, pk=request.GET.get('period'))
+            params = {'period': period.pk}
+            filename = "timesheets_{0:s}_{1!s}.zip".format(period.project.name.lower(), period.rp_start)
+        else:
+            try:
+                year = int(request.GET.get('year'))
+            except:
+                raise Http404('Invalid year')
+            params = {'year': year}
+            filename = "timesheets_{0:04d}.zip".format(year)
+
+        if 'background' in request.GET:
+            return JsonResponse(job_status(enqueue('Reporting.print_timesheets', user=request.user, **params)))
+
+        jobs = timesheet_print_jobs(period=period) if 'period' in params else timesheet_print_jobs(year=year)
+        if not len(jobs):
+            raise Http404('Nothing to report')
+        if not print_inline(jobs):
+            # Too many timesheets to print in the request
+            return JsonResponse(job_status(enqueue('Reporting.print_timesheets', user=request.user, **params)))
+
+        response = StreamingHttpResponse(iter_timesheets_zip(jobs, max_workers=print_workers()), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="{0:s}"'.format(filename)
+        return response
@@ -0,0 +1,133 @@
+import time
+import datetime
+import threading
+import numpy as np
+
+from .models import BankHoliday
+
+
+# Working days calendar
+# =====================
+#
+# For each year the calendar is materialized as NumPy boolean arrays (one element per day of the year)
+# flagging weekends, bank holidays (both fixed, i.e. with year=0, and year-specific) and their union.
+# Years are cached in process and invalidated by the signals on BankHoliday (see signals.py). As other
+# processes cannot be notified, cached years are also reloaded after CACHE_TIMEOUT seconds.
+
+CACHE_TIMEOUT = 600
+
+
+class YearCalendar(object):
+    """ Calendar of a single year
+    """
+    def __init__(self, year, holidays):
+        self.year = year
+        self.start = np.datetime64(datetime.date(year, 1, 1), 'D')
+        self.ndays = 366 if (year % 4 == 0 and year % 100 != 0) or year % 400 == 0 else 365
+        self.loaded = time.time()
+
+        days = self.start + np.arange(self.ndays)
+
+        # Weekends (1970-01-01 was a Thursday)
+        self.weekend = ((days.astype(np.int64) + 3) % 7) >= 5
+
+        # Bank holidays
+        self.bank_holiday = np.zeros(self.ndays, dtype=bool)
+        for month, day in holidays:
+            try:
+                self.bank_holiday[self.index(datetime.date(year, month, day))] = True
+            except ValueError:
+                # Fixed holiday not existing in this year (i.e. 29/2)
+                pass
+
+        # Non working days
+        self.holiday = self.weekend | self.bank_holiday
+
+    def index(self, date):
+        """ Index of the given date in the year arrays
+        """
+        return (np.datetime64(date, 'D') - self.start).astype(np.int64)
+
+    def range(self, start, end):
+        """ Slice of the year arrays between two dates (included)
+        """
+        return slice(int(self.index(start)), int(self.index(end)) + 1)
+
+
+_calendars = {}
+_lock = threading.Lock()
+
+
+def get_year_calendar(year):
+    """ Return the calendar of the given year, loading it if needed
+    """
+    cal = _calendars.get(year)
+    if cal is None or time.time() - cal.loaded > CACHE_TIMEOUT:
+        holidays = (
+            BankHoliday.objects
+            .filter(year__in=[0, year])
+            .values_list('month', 'day')
+        )
+        cal = YearCalendar(year, holidays)
+        with _lock:
+            _calendars[year] = cal
+    return cal
+
+
+def invalidate_calendar(year=None):
+    """ Drop cached calendars (all of them if year is None or 0, as fixed holidays affect every year)
+    """
+    with _lock:
+        if not year:
+            _calendars.clear()
+        else:
+            _calendars.pop(year, None)
+
+
+def is_bank_holiday(date):
+    cal = get_year_calendar(date.year)
+    return bool(cal.bank_holiday[cal.index(date)])
+
+
+def is_holiday(date):
+    """ True if the date is a weekend day or a bank holiday
+    """
+    cal = get_year_calendar(date.year)
+    return bool(cal.holiday[cal.index(date)])
+
+
+def _mask(dates, attr):
+    # Convert dates to an array of days
+    d = np.asarray(dates)
+    if d.dtype == object:
+        d = np.array([np.datetime64(x, 'D') if x is not None else np.datetime64('NaT') for x in d.ravel()], dtype='datetime64[D]').reshape(d.shape)
+    else:
+        d = d.astype('datetime64[D]')
+
+    out = np.zeros(d.shape, dtype=bool)
+    valid = ~np.isnat(d)
+    years = d.astype('datetime64[Y]').astype(np.int64) + 1970
+    for y in np.unique(years[valid]):
+        sel = valid & (years == y)
+        cal = get_year_calendar(int(y))
+        out[sel] = getattr(cal, attr)[(d[sel] - cal.start).astype(np.int64)]
+    return out
+
+
+def holiday_mask(dates):
+    """ Boolean mask of non working days (weekends and bank holidays) for an array-like of dates
+    (datetime.date list, numpy datetime64 array or pandas Series). Invalid dates are set to False.
+    """
+    return _mask(dates, 'holiday')
+
+
+def bank_holiday_mask(dates):
+    """ Boolean mask of bank holidays for an array-like of dates
+    """
+    return _mask(dates, 'bank_holiday')
+
+
+def holiday_range(start, end):
+    """ Boolean mask of non working days between two dates (included)
+    """
+    return holiday_mask(np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 1))
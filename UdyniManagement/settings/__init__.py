@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'Tags.apps.TagsConfig',
     'LabLogbook.apps.LablogbookConfig',
     'sigla.apps.SiglaConfig',
+    'Jobs.apps.JobsConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -152,6 +153,19 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# NOTE: the cache must be shared by all the processes (web workers and management commands), as the data
+# cached by Reporting (overview, cost matrix, statements) is invalidated by signals in the process that
+# changed the data. The table is created by the Reporting migrations (or with 'manage.py createcachetable').
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'udyni_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -212,6 +226,7 @@ CRISPY_FAIL_SILENTLY = not DEBUG
 # SIGLA
 SIGLA_USERNAME = "app.ifn"
 SIGLA_PASSWORD = "********"
+SIGLA_JOBS = 4  # Maximum number of concurrent requests to SIGLA
 
 # Default email configuration
 DEFAULT_FROM_EMAIL = 'UDynI Management <no-reply@udyni.lab>'
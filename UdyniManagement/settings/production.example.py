@@ -17,6 +17,16 @@ AUTH_LDAP_BIND_PASSWORD = "*****************"
 DATABASES['default']['HOST'] = '<set to database host>'
 DATABASES['default']['PASSWORD'] = '<set to database password>'
 
+# Cache (shared by all the processes, see settings/__init__.py)
+# The default is a database cache (table created by the migrations). A Redis server can be used instead:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#         'LOCATION': 'redis://<set to redis host>:6379',
+#     }
+# }
+# NOTE: do not use the local memory cache, it is not shared between processes and cached data would not be invalidated
+
 # SIGLA password
 SIGLA_PASSWORD = "<set to sigla password>"
 
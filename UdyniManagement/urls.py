@@ -28,6 +28,7 @@ urlpatterns = [
     path('reporting/', include('Reporting.urls')),
     path('lablogbook/', include('LabLogbook.urls')),
     path('sigla/', include('sigla.urls')),
+    path('jobs/', include('Jobs.urls')),
     path('admin/', admin.site.urls),
 ]
 
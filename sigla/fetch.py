@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent fetch of SIGLA data
+
+Each SIGLA request takes a few seconds, mostly waiting for the server. Independent requests
+can be run in parallel on a pool of threads: the requests are submitted as futures and the
+results are consumed by the caller (e.g. a single thread writing to the database).
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SIGLAFetcher(object):
+
+    def __init__(self, sigla, jobs=4):
+        """ Initialize the pool of threads (jobs is the maximum number of concurrent requests)
+        """
+        self.sigla = sigla
+        self.jobs = max(1, int(jobs))
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='SIGLA')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(wait=exc_type is None)
+        return False
+
+
+    def close(self, wait=True):
+        """ Shutdown the pool. If wait is False, the requests not yet started are cancelled
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+    def submit(self, method, *args, **kwargs):
+        """ Submit a request calling the method of the SIGLA interface with the given arguments.
+        Return a future
+        """
+        func = getattr(self.sigla, method)
+
+        def run():
+            s = time.time()
+            out = func(*args, **kwargs)
+            self.sigla.logger.debug("[SIGLA] {0:s}{1!s} completed in {2:.2f}s".format(method, args, time.time() - s))
+            return out
+
+        return self.executor.submit(run)
@@ -9,15 +9,73 @@ Python API for SIGLA
 
 import time
 import datetime
+import threading
 import requests
 import json
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Timeouts (connect, read) in seconds. Some queries take more than a minute on the SIGLA side.
+DEFAULT_TIMEOUT = (10, 300)
+
+# Retries on connection errors and on server errors, with exponential backoff (backoff * 2^n seconds)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+
+# Size of the connection pool (should be at least the number of threads using the session)
+DEFAULT_POOL_SIZE = 10
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, transport=None):
+    """ Create a session for SIGLA with a pool of keep-alive connections, compression and retries.
+    A different transport (a requests adapter, e.g. sigla.transports.ReplayTransport) can be given
+    to replace the HTTP adapter.
+    """
+    session = requests.Session()
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    if transport is None:
+        # NOTE: the SIGLA REST API use POST only for queries, so POST requests can be retried as well
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        transport = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', transport)
+    session.mount('http://', transport)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """ Return the session shared by all the SIGLA instances (created on first use)
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
 
 
 class SIGLA(object):
 
-    def __init__(self, username, password, logger=None):
+    def __init__(self, username, password, logger=None, session=None, transport=None, timeout=DEFAULT_TIMEOUT):
         """ Initialize object
+        By default the requests use a session shared by all the instances. A specific session or
+        transport (requests adapter) can be given instead.
         """
         # Check logger
         if logger is None:
@@ -44,6 +102,12 @@ class SIGLA(object):
         self.__cdr = "036.001.000"
         self.__base_url = "https://contab.cnr.it/SIGLA/"
 
+        # HTTP session
+        if session is None:
+            session = get_session() if transport is None else make_session(transport=transport)
+        self.session = session
+        self.timeout = timeout
+
 
     def getCds(self):
         return self.__cds
@@ -58,7 +122,7 @@ class SIGLA(object):
 
 
     def getRequest(self, url):
-        r = requests.get("{0:s}{1:s}?proxyUrl={1:s}".format(self.__base_url, url), auth=self.__credentials)
+        r = self.session.get("{0:s}{1:s}?proxyUrl={1:s}".format(self.__base_url, url), auth=self.__credentials, timeout=self.timeout)
         if r.status_code == 200:
             try:
                 data = json.loads(r.content)
@@ -109,7 +173,7 @@ class SIGLA(object):
         out = []
         total_items = None
         while True:
-            r = requests.post("{0:s}{1:s}?proxyUrl={1:s}".format(self.__base_url, url), json=request, auth=self.__credentials)
+            r = self.session.post("{0:s}{1:s}?proxyUrl={1:s}".format(self.__base_url, url), json=request, auth=self.__credentials, timeout=self.timeout)
             if r.status_code == 200:
                 try:
                     data = r.content.decode('utf-8')
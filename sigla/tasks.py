@@ -0,0 +1,13 @@
+from django.conf import settings
+
+from Jobs.jobs import task
+from .sigla import SIGLA
+
+
+@task('sigla.request')
+def sigla_request(job, action):
+    """ Execute a SIGLA REST request
+    """
+    job.progress(0.0, f"Requesting {action}")
+    s = SIGLA(settings.SIGLA_USERNAME, settings.SIGLA_PASSWORD)
+    return s.getRequest("{0:s}.json".format(action))
@@ -1,3 +1,82 @@
-from django.test import TestCase
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+import requests
+from django.test import SimpleTestCase
+
+from .sigla import SIGLA, make_session
+from .transports import FakeTransport, ReplayTransport, request_key
+
+
+class SIGLATransportTest(SimpleTestCase):
+
+    def test_pagination(self):
+        def handler(method, action, payload):
+            page = payload['activePage']
+            elements = [{'n': i} for i in range(page * 200, min((page + 1) * 200, 450))]
+            return 200, {'totalNumItems': 450, 'activePage': page, 'elements': elements}
+
+        transport = FakeTransport(handler)
+        s = SIGLA('user', 'password', transport=transport)
+        data = s.postRequest('ConsProgettiAction.json', filters=[('pg_progetto', 1)], esercizio=2023)
+        self.assertEqual([d['n'] for d in data], list(range(450)))
+        self.assertEqual([r[2]['activePage'] for r in transport.requests], [0, 1, 2])
+        self.assertEqual(transport.requests[0][1], 'ConsProgettiAction.json')
+        self.assertEqual(transport.requests[0][2]['context']['esercizio'], 2023)
+        self.assertEqual(transport.requests[0][2]['clauses'][0]['fieldName'], 'pg_progetto')
+
+    def test_error(self):
+        s = SIGLA('user', 'password', transport=FakeTransport(lambda m, a, p: (403, {'message': "Denied"})))
+        with self.assertRaisesMessage(requests.HTTPError, "[Error 403] Denied"):
+            s.getRequest('info.json')
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as d:
+            # Record a response by hand
+            request = requests.Request('POST', "https://contab.cnr.it/SIGLA/ConsGAEAction.json?proxyUrl=ConsGAEAction.json", json={'b': 1, 'a': 2}).prepare()
+            with open(f"{d}/{request_key(request)}.json", 'w') as f:
+                json.dump({'elements': [1, 2]}, f)
+
+            s = SIGLA('user', 'password', transport=ReplayTransport(d))
+            r = s.session.post("https://contab.cnr.it/SIGLA/ConsGAEAction.json?proxyUrl=ConsGAEAction.json", json={'a': 2, 'b': 1})
+            self.assertEqual(r.json(), {'elements': [1, 2]})
+            with self.assertRaises(requests.HTTPError):
+                s.getRequest('info.json')
+
+    def test_retry(self):
+        calls = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                calls.append(self.path)
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({'totalNumItems': 1, 'activePage': 0, 'elements': [{'ok': True}]}).encode('utf-8')
+                self.send_response(503 if len(calls) < 3 else 200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            s = SIGLA('user', 'password', session=make_session(retries=3, backoff=0))
+            s._SIGLA__base_url = f"http://127.0.0.1:{server.server_port}/"
+            self.assertEqual(s.postRequest('ConsGAEAction.json'), [{'ok': True}])
+            self.assertEqual(len(calls), 3)
+
+            # Retries exhausted
+            calls.clear()
+            s.session = make_session(retries=1, backoff=0)
+            with self.assertRaisesMessage(requests.HTTPError, "[Error 503]"):
+                s.postRequest('ConsGAEAction.json')
+            self.assertEqual(len(calls), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
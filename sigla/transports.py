@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Transports for the SIGLA client
+
+A transport is a requests adapter mounted on the session of the SIGLA client (see make_session).
+Besides the default HTTP adapter, these transports can be used in tests and benchmarks:
+ - FakeTransport: answers with a handler function, without network access
+ - RecordingTransport: HTTP adapter saving the responses to a directory
+ - ReplayTransport: answers with the responses saved by RecordingTransport
+"""
+
+import os
+import json
+import hashlib
+import posixpath
+from urllib.parse import urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+def request_key(request):
+    """ Key identifying a request: method, action and body (JSON normalized)
+    """
+    action = posixpath.basename(urlsplit(request.url).path)
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True).encode('utf-8')
+    except ValueError:
+        pass
+    digest = hashlib.sha1(request.method.encode('ascii') + b' ' + action.encode('utf-8') + b' ' + body).hexdigest()
+    return f"{action}-{digest[:16]}"
+
+
+def build_response(request, status, content, headers=None):
+    """ Build a requests Response
+    """
+    r = Response()
+    r.status_code = status
+    r._content = content
+    r.headers = CaseInsensitiveDict(headers or {'Content-Type': 'application/json'})
+    r.encoding = 'utf-8'
+    r.url = request.url
+    r.request = request
+    r.reason = 'OK' if status == 200 else 'Error'
+    return r
+
+
+class FakeTransport(BaseAdapter):
+
+    def __init__(self, handler):
+        """ Transport answering with handler(method, action, payload) -> (status, data), where
+        payload is the decoded JSON body of the request (None for GET) and data is encoded as JSON.
+        The requests received are stored in self.requests as (method, action, payload)
+        """
+        super().__init__()
+        self.handler = handler
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        action = posixpath.basename(urlsplit(request.url).path)
+        payload = json.loads(request.body) if request.body else None
+        self.requests.append((request.method, action, payload))
+        status, data = self.handler(request.method, action, payload)
+        return build_response(request, status, json.dumps(data).encode('utf-8'))
+
+    def close(self):
+        pass
+
+
+class RecordingTransport(HTTPAdapter):
+
+    def __init__(self, directory, *args, **kwargs):
+        """ HTTP transport saving every successful response in directory
+        """
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send(self, request, **kwargs):
+        r = super().send(request, **kwargs)
+        if r.status_code == 200:
+            with open(os.path.join(self.directory, request_key(request) + '.json'), 'wb') as f:
+                f.write(r.content)
+        return r
+
+
+class ReplayTransport(BaseAdapter):
+
+    def __init__(self, directory):
+        """ Transport answering with the responses saved by RecordingTransport in directory.
+        Requests that were not recorded get a 404 response
+        """
+        super().__init__()
+        self.directory = directory
+
+    def send(self, request, **kwargs):
+        try:
+            with open(os.path.join(self.directory, request_key(request) + '.json'), 'rb') as f:
+                return build_response(request, 200, f.read())
+        except FileNotFoundError:
+            return build_response(request, 404, json.dumps({'message': "Request not recorded"}).encode('utf-8'))
+
+    def close(self):
+        pass
@@ -14,6 +14,9 @@ from UdyniManagement.menu import UdyniMenu
 
 from .sigla import SIGLA
 
+from Jobs.jobs import enqueue
+from Jobs.views import job_status
+
 from Accounting.models import GAE
 
 
@@ -64,6 +67,10 @@ class SiglaAjaxManualView(PermissionRequiredMixin, View):
         if 'action' in request.GET:
             action = re.sub(r'\W+', '', request.GET['action'])
 
+            if 'background' in request.GET:
+                # Long requests can be executed by a background job
+                return JsonResponse(job_status(enqueue('sigla.request', user=request.user, action=action)))
+
             s = SIGLA(settings.SIGLA_USERNAME, settings.SIGLA_PASSWORD)
             try:
                 data = s.getRequest("{0:s}.json".format(action))